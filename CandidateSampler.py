@@ -0,0 +1,175 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+import time
+from Deadline import Deadline
+from Tracer import Tracer
+
+# the candidate index of the request in this thread, then SingleFlightGpt doesn't merge the candidates into one
+_local = threading.local()
+
+
+class _Candidate:
+    def __init__(self, index, parent=None):
+        self.index = index
+        # the rest are cancelled through this once the valid one comes
+        self.deadline = Deadline(None, parent)
+        self.partial = ""
+        self.content = None
+        self.response = None
+        self.error = None
+        self.is_rejected = False
+        self.is_done = False
+        self.done_time = None
+
+
+class CandidateSampler:
+    def __init__(self, client, n=3):
+        # client : IGpt. n candidates are requested at once instead of the sequential retries
+        self.client = client
+        self.n = max(n, 1)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.candidates = 0
+        self.cancelled = 0
+        self.native = 0
+
+    @staticmethod
+    def get_current_index():
+        return getattr(_local, "index", None)
+
+    def _query_native(self, system_prompt, user_prompt, n):
+        # one request with "n" of the API if the backend supports. [] if not
+        query_n = getattr(self.client, "query_n", None)
+        if not query_n:
+            return []
+        try:
+            results = query_n(system_prompt, user_prompt, n)
+        except Exception:
+            return []
+        if results:
+            with self._lock:
+                self.native += 1
+        return results
+
+    def sample(self, system_prompt, user_prompt, is_ok=None, is_ok_stream=None, score=None, is_ranked=False):
+        # is_ok(content) : True if valid, is_ok_stream(partial) : False to abort, True to stop as completed, None to continue
+        # score(content) : higher is better for is_ranked
+        # returns (content, response) of the first valid candidate, or [(content, response)] of the valid ones in the rank if is_ranked
+        is_ok = is_ok if is_ok else bool
+        with self._lock:
+            self.requests += 1
+
+        lock = threading.Condition()
+        candidates = []
+        state = {"winner": None}
+
+        def _is_valid(candidate):
+            if candidate.error or candidate.is_rejected:
+                return False
+            try:
+                return bool(is_ok(candidate.content))
+            except Exception:
+                return False
+
+        def _finish(candidate):
+            # with lock
+            candidate.is_done = True
+            candidate.done_time = time.time()
+            if state["winner"] is None and not is_ranked and _is_valid(candidate):
+                state["winner"] = candidate
+            lock.notify_all()
+
+        with Tracer.span("sample", n=self.n):
+            native_results = self._query_native(system_prompt, user_prompt, self.n)
+            with lock:
+                for content, response in native_results[:self.n]:
+                    candidate = _Candidate(len(candidates))
+                    candidate.content, candidate.response = content, response
+                    candidates.append(candidate)
+                    _finish(candidate)
+
+            def _run(candidate):
+                def _callback(delta):
+                    if state["winner"] is not None:
+                        # the other candidate won
+                        return False
+                    if is_ok_stream:
+                        candidate.partial += delta
+                        result = is_ok_stream(candidate.partial)
+                        if result is False:
+                            candidate.is_rejected = True
+                        if result is not None:
+                            return False
+                _local.index = candidate.index
+                try:
+                    with candidate.deadline.activate():
+                        candidate.content, candidate.response = self.client.query(system_prompt, user_prompt, _callback)
+                except Exception as err:
+                    candidate.error = err
+                finally:
+                    _local.index = None
+                with lock:
+                    _finish(candidate)
+
+            parent = Deadline.current()
+            with lock:
+                if state["winner"] is None or is_ranked:
+                    # the rest of n (all if the backend doesn't support "n") are requested concurrently
+                    for _ in range(self.n - len(candidates)):
+                        candidate = _Candidate(len(candidates), parent)
+                        candidates.append(candidate)
+                        threading.Thread(target=_run, args=(candidate,), daemon=True).start()
+                    with self._lock:
+                        self.candidates += self.n - len(native_results)
+                lock.wait_for(lambda: state["winner"] is not None or all(c.is_done for c in candidates))
+                winner = state["winner"]
+
+            # the non-streaming ones are still waiting for the whole response
+            for candidate in candidates:
+                if not candidate.is_done:
+                    candidate.deadline.cancel()
+                    with self._lock:
+                        self.cancelled += 1
+
+        if is_ranked:
+            valid = [c for c in candidates if _is_valid(c)]
+            if score:
+                # stable: the same score is in the arrival order
+                valid.sort(key=lambda c: c.done_time)
+                valid.sort(key=lambda c: score(c.content), reverse=True)
+            return [(c.content, c.response) for c in valid]
+
+        if winner:
+            return winner.content, winner.response
+        if parent:
+            parent.check()
+        # none is valid, then the first arrived one for the caller's retry and error report
+        finished = sorted([c for c in candidates if not c.error], key=lambda c: c.done_time)
+        if finished:
+            return finished[0].content, finished[0].response
+        errors = [c.error for c in candidates if c.error]
+        if errors:
+            raise errors[0]
+        return None, None
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "candidates": self.candidates,
+                "native": self.native,
+                "cancelled": self.cancelled,
+            }
@@ -0,0 +1,162 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import contextlib
+import os
+import socket
+import threading
+import time
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+class RequestCancelledError(Exception):
+    pass
+
+
+class Deadline:
+    # without any deadline, the sockets still have these timeouts not to hang forever
+    CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+    READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "600"))
+
+    _local = threading.local()
+
+    def __init__(self, timeout=None, parent=None):
+        # timeout : seconds from now (None is no deadline). the child never outlives the parent
+        self.parent = parent
+        self.expires_at = time.time() + timeout if timeout else None
+        if parent and parent.expires_at and (self.expires_at is None or parent.expires_at < self.expires_at):
+            self.expires_at = parent.expires_at
+        self._cancelled = threading.Event()
+        self._closers = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def current():
+        stack = getattr(Deadline._local, "stack", None)
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def activate(self):
+        # the deadline flows down to the helpers called in this thread
+        if not hasattr(Deadline._local, "stack"):
+            Deadline._local.stack = []
+        Deadline._local.stack.append(self)
+        try:
+            yield self
+        finally:
+            Deadline._local.stack.pop()
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - time.time(), 0.0)
+
+    def is_cancelled(self):
+        return self._cancelled.is_set() or (self.parent is not None and self.parent.is_cancelled())
+
+    def is_expired(self):
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def is_done(self):
+        return self.is_cancelled() or self.is_expired()
+
+    def check(self):
+        if self.is_cancelled():
+            raise RequestCancelledError("request is cancelled")
+        if self.is_expired():
+            raise DeadlineExceededError("deadline exceeded")
+
+    def cancel(self):
+        # cooperative cancellation from the other thread. the watched sockets are closed right away
+        self._cancelled.set()
+        with self._lock:
+            closers = list(self._closers.values())
+        for closer in closers:
+            try:
+                closer()
+            except Exception:
+                pass
+
+    def get_timeout(self):
+        # (connect, read) timeout for requests
+        remaining = self.remaining()
+        if remaining is None:
+            return (self.CONNECT_TIMEOUT, self.READ_TIMEOUT)
+        return (max(min(self.CONNECT_TIMEOUT, remaining), 0.001), max(min(self.READ_TIMEOUT, remaining), 0.001))
+
+    @contextlib.contextmanager
+    def watch(self, closer):
+        # closer() (e.g. response.close) is called at the expiry or cancel while in this context
+        # then the blocked stream read returns and the server's slot is freed
+        with self._lock:
+            watch_id = self._next_id
+            self._next_id += 1
+            self._closers[watch_id] = closer
+        parent_watch = self.parent.watch(closer) if self.parent else contextlib.nullcontext()
+        timer = None
+        remaining = self.remaining()
+        if remaining is not None:
+            timer = threading.Timer(remaining, closer)
+            timer.daemon = True
+            timer.start()
+        try:
+            with parent_watch:
+                yield
+        finally:
+            if timer:
+                timer.cancel()
+            with self._lock:
+                self._closers.pop(watch_id, None)
+
+    @staticmethod
+    def get_closer(stream):
+        # close() from the other thread doesn't wake up the blocked recv(), then shutdown the socket beneath
+        # stream : requests.Response, openai's Stream (httpx) or botocore's EventStream
+        def _close():
+            sock = None
+            try:
+                raw = getattr(stream, "raw", None) or getattr(stream, "_raw_stream", None)
+                if raw is not None:
+                    sock = getattr(getattr(raw, "_connection", None), "sock", None)
+                elif getattr(stream, "response", None) is not None:
+                    network_stream = stream.response.extensions.get("network_stream")
+                    sock = network_stream.get_extra_info("socket") if network_stream else None
+            except Exception:
+                sock = None
+            if isinstance(sock, socket.socket):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            stream.close()
+        return _close
+
+    def wrap_callback(self, callback):
+        # stop the stream at the next delta once it's done. the caller gets the exception instead of the partial result
+        def _callback(delta):
+            self.check()
+            return callback(delta) if callback else None
+        return _callback
+
+    @staticmethod
+    def get_or_none(timeout=None):
+        # the current deadline narrowed by timeout, or None if neither is set
+        parent = Deadline.current()
+        if timeout is None and parent is None:
+            return None
+        return Deadline(timeout, parent)
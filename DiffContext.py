@@ -0,0 +1,510 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+
+class DiffHunk:
+    def __init__(self, path, old_start, old_count, new_start, new_count, header=""):
+        self.path = path
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.header = header
+        # " ", "-", "+" prefixed lines
+        self.lines = []
+
+    def get_new_range(self):
+        # (first, last) line of the new file. pure deletion is (n+1, n)
+        if self.new_count:
+            return self.new_start, self.new_start + self.new_count - 1
+        return self.new_start + 1, self.new_start
+
+    def get_changed_lines(self):
+        return [line[1:] for line in self.lines if line[:1] in ("+", "-")]
+
+    def __repr__(self):
+        return f"DiffHunk({self.path}, -{self.old_start},{self.old_count} +{self.new_start},{self.new_count})"
+
+
+class SymbolIndex:
+    # bump to invalidate the caches when the parsers are changed
+    VERSION = 1
+    PYTHON_EXTS = (".py",)
+    C_LIKE_EXTS = (".c", ".cc", ".cpp", ".cxx", ".h", ".hh", ".hpp", ".hxx", ".java", ".kt", ".js", ".jsx", ".ts", ".tsx", ".go", ".cs", ".m", ".mm", ".swift", ".rs", ".php", ".scala")
+    C_LIKE_CONTROLS = {"if", "for", "while", "switch", "catch", "return", "else", "do", "sizeof", "new", "delete", "throw", "case", "using", "typedef"}
+    RE_C_TYPE = re.compile(r"^\s*(?:template\s*<[^>]*>\s*)?(?:(?:public|private|protected|internal|export|default|abstract|final|static|sealed|data|open)\s+)*(class|struct|interface|enum|namespace|union|object|trait|impl)\s+([A-Za-z_][\w:]*)[^;]*$")
+    RE_C_FUNC = re.compile(r"^\s*(?:[\w:<>,\*&~\[\]\.]+\s+)*?(?:func\s+(?:\([^)]*\)\s*)?|function\s+|fun\s+|fn\s+|def\s+)?\**&?(~?[A-Za-z_][\w:\.]*)\s*\([^;]*$")
+
+    def __init__(self, cache_path=None):
+        # path -> {"mtime", "size", "hash", "symbols"}. the symbols are rebuilt only if the content hash is changed
+        # symbol : {"name", "qualname", "kind", "start", "end", "signature"} (1-origin lines, end inclusive)
+        self.cache_path = cache_path
+        self.entries = {}
+        self.is_dirty = False
+        self._lock = threading.Lock()
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='UTF-8') as f:
+                    cache = json.load(f)
+                if cache.get("version") == self.VERSION:
+                    self.entries = cache["entries"]
+            except (OSError, ValueError, KeyError, AttributeError):
+                self.entries = {}
+
+    @staticmethod
+    def is_supported(path):
+        return path.endswith(SymbolIndex.PYTHON_EXTS + SymbolIndex.C_LIKE_EXTS)
+
+    def get_symbols(self, path, content=None):
+        # content : new file content if it's not in the working tree
+        path = os.path.abspath(path)
+        if not self.is_supported(path):
+            return []
+        stat = None
+        if content is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return []
+            with self._lock:
+                entry = self.entries.get(path)
+            # fast path: no need to read the unchanged file
+            if entry and entry.get("mtime") == stat.st_mtime_ns and entry.get("size") == stat.st_size:
+                return entry["symbols"]
+            try:
+                with open(path, 'r', encoding='UTF-8') as f:
+                    content = f.read()
+            except (OSError, UnicodeDecodeError):
+                return []
+        content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        with self._lock:
+            entry = self.entries.get(path)
+        if not entry or entry.get("hash") != content_hash:
+            symbols = self.parse_python(content) if path.endswith(self.PYTHON_EXTS) else self.parse_c_like(content)
+            entry = {"hash": content_hash, "symbols": symbols}
+        if stat:
+            entry["mtime"] = stat.st_mtime_ns
+            entry["size"] = stat.st_size
+        with self._lock:
+            self.entries[path] = entry
+            self.is_dirty = True
+        return entry["symbols"]
+
+    @staticmethod
+    def parse_python(content):
+        try:
+            tree = ast.parse(content)
+        except (SyntaxError, ValueError):
+            return []
+        lines = content.splitlines()
+        symbols = []
+
+        def _visit(node, prefix):
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                    qualname = prefix + child.name
+                    # the header lines until the trailing :
+                    header = []
+                    for line in lines[child.lineno-1:max(child.body[0].lineno-1, child.lineno)]:
+                        header.append(line.strip())
+                        if line.split("#")[0].rstrip().endswith(":"):
+                            break
+                    signature = " ".join(header)
+                    symbols.append({
+                        "name": child.name,
+                        "qualname": qualname,
+                        "kind": "class" if isinstance(child, ast.ClassDef) else "def",
+                        "start": min([child.lineno] + [d.lineno for d in child.decorator_list]),
+                        "end": child.end_lineno,
+                        "signature": signature[:300],
+                    })
+                    _visit(child, qualname + ".")
+                else:
+                    _visit(child, prefix)
+        _visit(tree, "")
+        return symbols
+
+    @staticmethod
+    def _strip_code(line, state):
+        # remove the comments and the string literals not to count their braces. state["comment"] is /* */ across the lines
+        result = ""
+        i = 0
+        while i < len(line):
+            if state["comment"]:
+                end = line.find("*/", i)
+                if end < 0:
+                    return result
+                state["comment"] = False
+                i = end + 2
+                continue
+            c = line[i]
+            if line.startswith("//", i):
+                break
+            if line.startswith("/*", i):
+                state["comment"] = True
+                i += 2
+                continue
+            if c in ("\"", "'", "`"):
+                end = i + 1
+                while end < len(line) and line[end] != c:
+                    end += 2 if line[end] == "\\" else 1
+                result += c + c
+                i = end + 1
+                continue
+            result += c
+            i += 1
+        return result
+
+    @staticmethod
+    def parse_c_like(content, max_signature_lines=5):
+        lines = content.splitlines()
+        state = {"comment": False}
+        code_lines = [SymbolIndex._strip_code(line, state) for line in lines]
+        symbols = []
+        # (symbol, depth at the opening brace)
+        stack = []
+        pending = None
+        depth = 0
+        for i, code in enumerate(code_lines):
+            if pending is None or i - pending["start"] + 1 > max_signature_lines:
+                pending = None
+                # the head before { as the body can be in the same line
+                head = code.split("{")[0]
+                match = SymbolIndex.RE_C_TYPE.match(head)
+                kind = name = None
+                if match:
+                    kind, name = match.group(1), match.group(2)
+                else:
+                    match = SymbolIndex.RE_C_FUNC.match(head)
+                    if match:
+                        kind, name = "function", match.group(1)
+                if name:
+                    name = name.split("::")[-1].split(".")[-1]
+                if name and name not in SymbolIndex.C_LIKE_CONTROLS and not code.lstrip().startswith(("#", "=", "return ", "else ")):
+                    pending = {"name": name, "kind": kind, "start": i + 1, "signature": ""}
+            if pending is not None:
+                head = code.split("{")[0]
+                pending["signature"] = (pending["signature"] + " " + head.strip()).strip()
+                if ";" in head and "(" not in head.split(";")[-1]:
+                    # declaration only
+                    pending = None
+            for c in code:
+                if c == "{":
+                    if pending is not None:
+                        prefix = ".".join(s["name"] for s, _ in stack)
+                        pending["qualname"] = prefix + "." + pending["name"] if prefix else pending["name"]
+                        pending["signature"] = re.sub(r"\s+", " ", pending["signature"])[:300]
+                        stack.append((pending, depth))
+                        pending = None
+                    depth += 1
+                elif c == "}":
+                    depth = max(depth - 1, 0)
+                    if stack and stack[-1][1] == depth:
+                        symbol, _ = stack.pop()
+                        symbol["end"] = i + 1
+                        symbols.append(symbol)
+            if pending is not None and code.rstrip().endswith(";"):
+                pending = None
+        for symbol, _ in stack:
+            symbol["end"] = len(lines)
+            symbols.append(symbol)
+        symbols.sort(key=lambda s: s["start"])
+        return [{"name": s["name"], "qualname": s["qualname"], "kind": s["kind"], "start": s["start"], "end": s["end"], "signature": s["signature"]} for s in symbols]
+
+    @staticmethod
+    def get_enclosing(symbols, first, last):
+        # the innermost symbols covering [first, last]
+        candidates = [s for s in symbols if s["start"] <= first and last <= s["end"]]
+        return min(candidates, key=lambda s: s["end"] - s["start"]) if candidates else None
+
+    def add_files(self, paths):
+        for path in paths:
+            if self.is_supported(path):
+                self.get_symbols(path)
+
+    def find(self, name):
+        # [(path, symbol)] defining the name
+        results = []
+        with self._lock:
+            entries = list(self.entries.items())
+        for path, entry in entries:
+            for symbol in entry["symbols"]:
+                if symbol["name"] == name:
+                    results.append((path, symbol))
+        return results
+
+    def save(self):
+        if not self.cache_path or not self.is_dirty:
+            return
+        with self._lock:
+            data = json.dumps({"version": self.VERSION, "entries": self.entries})
+            self.is_dirty = False
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        os.makedirs(directory, exist_ok=True)
+        # atomic replace not to leave the torn cache
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+
+class DiffContext:
+    RE_FILE = re.compile(r"^\+\+\+ (?:b/)?(.+?)\s*$")
+    RE_HUNK = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@(.*)$")
+    # (receiver, called name) and the type-like names. the local variables aren't looked up
+    RE_REFERENCE = re.compile(r"(?:([A-Za-z_]\w*)\s*(?:\.|::|->))?([A-Za-z_]\w*)\s*\(|\b([A-Z]\w*)")
+    KEYWORDS = {"if", "else", "elif", "for", "while", "return", "def", "class", "import", "from", "as", "in", "is", "not", "and", "or", "None", "True", "False", "self", "try", "except", "finally", "with", "pass", "break", "continue", "lambda", "yield", "raise", "global", "nonlocal", "assert", "del", "async", "await",
+                "int", "char", "void", "const", "static", "struct", "unsigned", "signed", "long", "short", "float", "double", "bool", "auto", "public", "private", "protected", "new", "delete", "this", "null", "nullptr", "true", "false", "switch", "case", "default", "do", "goto", "sizeof", "typedef", "namespace", "using", "template", "typename", "virtual", "override", "final", "var", "let", "function", "func", "fun", "fn", "print", "len", "str", "list", "dict", "set", "range"}
+
+    def __init__(self, index=None, base_dir=".", max_definition_lines=200, max_signatures=20):
+        # max_definition_lines : the larger enclosing definition is represented by its signature and the hunks
+        self.index = index if index else SymbolIndex()
+        self.base_dir = base_dir
+        self.max_definition_lines = max_definition_lines
+        self.max_signatures = max_signatures
+
+    @staticmethod
+    def parse_diff(diff_text):
+        # {path: [DiffHunk]} of the new side. the deleted files are skipped
+        results = {}
+        path = None
+        hunk = None
+        old_remaining = new_remaining = 0
+        for line in diff_text.splitlines():
+            if hunk is not None and (old_remaining > 0 or new_remaining > 0):
+                prefix = line[:1]
+                if prefix in (" ", "") and not line.startswith("\\"):
+                    hunk.lines.append(" " + line[1:])
+                    old_remaining -= 1
+                    new_remaining -= 1
+                    continue
+                if prefix == "-":
+                    hunk.lines.append(line)
+                    old_remaining -= 1
+                    continue
+                if prefix == "+":
+                    hunk.lines.append(line)
+                    new_remaining -= 1
+                    continue
+            if line.startswith("\\"):
+                # \ No newline at end of file
+                continue
+            match = DiffContext.RE_FILE.match(line)
+            if match:
+                path = None if match.group(1) == "/dev/null" else match.group(1)
+                hunk = None
+                continue
+            match = DiffContext.RE_HUNK.match(line)
+            if match and path:
+                old_count = int(match.group(2)) if match.group(2) is not None else 1
+                new_count = int(match.group(4)) if match.group(4) is not None else 1
+                hunk = DiffHunk(path, int(match.group(1)), old_count, int(match.group(3)), new_count, match.group(5).strip())
+                old_remaining, new_remaining = old_count, new_count
+                results.setdefault(path, []).append(hunk)
+        return results
+
+    def _read_new_file(self, path, hunks):
+        # the working tree is the new side only if the hunks match with it (e.g. git diff, git diff HEAD)
+        try:
+            with open(os.path.join(self.base_dir, path), 'r', encoding='UTF-8') as f:
+                lines = f.read().splitlines()
+        except (OSError, UnicodeDecodeError):
+            return None
+        for hunk in hunks:
+            new_lines = [line[1:] for line in hunk.lines if line[:1] in (" ", "+")]
+            if lines[hunk.new_start-1:hunk.new_start-1+len(new_lines)] != new_lines:
+                return None
+        return lines
+
+    @staticmethod
+    def _render(hunks, new_lines, first, last):
+        # unified diff view of the new lines [first, last] with the hunks inside
+        output = []
+        line_no = first
+        for hunk in sorted(hunks, key=lambda h: h.new_start):
+            hunk_first, hunk_last = hunk.get_new_range()
+            while line_no < hunk_first and line_no <= last:
+                output.append(" " + new_lines[line_no-1])
+                line_no += 1
+            output.extend(hunk.lines)
+            line_no = max(line_no, hunk_last + 1)
+        while line_no <= last:
+            output.append(" " + new_lines[line_no-1])
+            line_no += 1
+        return output
+
+    def build_file(self, path, hunks):
+        # returns (context text, {(path, receiver, name)} of the references)
+        new_lines = self._read_new_file(path, hunks)
+        symbols = self.index.get_symbols(os.path.join(self.base_dir, path), "\n".join(new_lines)) if new_lines is not None else []
+
+        # the hunks in the same definition are one region. [first, last, title, [hunks]] (first is None for the hunk as is)
+        regions = []
+        defined = set()
+        for hunk in hunks:
+            first, last = hunk.get_new_range()
+            symbol = SymbolIndex.get_enclosing(symbols, first, max(first, last))
+            if symbol:
+                defined.add(symbol["name"])
+            if symbol and symbol["end"] - symbol["start"] + 1 <= self.max_definition_lines:
+                # a hunk can stick out of the definition by its context lines
+                regions.append([min(symbol["start"], hunk.new_start), max(symbol["end"], last), f"{symbol['kind']} {symbol['qualname']}", [hunk]])
+            elif symbol:
+                # too large: the signature and the hunk as is
+                regions.append([None, None, f"{symbol['kind']} {symbol['qualname']}: {symbol['signature']}", [hunk]])
+            else:
+                regions.append([None, None, hunk.header, [hunk]])
+
+        # the nested or the same definitions are merged into the outer one
+        merged = []
+        for region in sorted(regions, key=lambda r: -(r[1] - r[0]) if r[0] is not None else 0):
+            for outer in merged:
+                if region[0] is not None and outer[0] is not None and outer[0] <= region[0] and region[1] <= outer[1]:
+                    outer[3].extend(region[3])
+                    break
+            else:
+                merged.append(region)
+        merged.sort(key=lambda r: r[3][0].new_start)
+
+        output = [f"--- a/{path}", f"+++ b/{path}"]
+        for first, last, title, region_hunks in merged:
+            if first is not None:
+                output.append(f"@@ +{first},{last-first+1} @@ {title}")
+                output.extend(self._render(region_hunks, new_lines, first, last))
+            else:
+                for hunk in region_hunks:
+                    output.append(f"@@ -{hunk.old_start},{hunk.old_count} +{hunk.new_start},{hunk.new_count} @@ {title}".rstrip())
+                    output.extend(hunk.lines)
+
+        references = set()
+        for hunk in hunks:
+            for line in hunk.get_changed_lines():
+                for receiver, called, type_name in self.RE_REFERENCE.findall(line):
+                    name = called or type_name
+                    if name not in self.KEYWORDS and name not in defined:
+                        references.add((path, receiver, name))
+        return "\n".join(output), references
+
+    def _resolve(self, path, receiver, name):
+        candidates = self.index.find(name)
+        if receiver in ("self", "this", "cls"):
+            return [(p, s) for p, s in candidates if p == os.path.abspath(os.path.join(self.base_dir, path))]
+        if receiver[:1].isupper():
+            return [(p, s) for p, s in candidates if s["qualname"].endswith(f"{receiver}.{name}")]
+        if receiver:
+            # method of the unknown type e.g. f.read() is ambiguous
+            return []
+        return candidates
+
+    def _get_signatures(self, references):
+        signatures = []
+        shown = set()
+        for path, receiver, name in sorted(references):
+            for symbol_path, symbol in self._resolve(path, receiver, name)[:2]:
+                if (symbol_path, symbol["start"]) not in shown:
+                    shown.add((symbol_path, symbol["start"]))
+                    signatures.append(f"{os.path.relpath(symbol_path, self.base_dir)}:{symbol['start']}: {symbol['signature']}")
+            if len(signatures) >= self.max_signatures:
+                break
+        return "Referenced definitions:\n" + "\n".join(signatures[:self.max_signatures]) if signatures else None
+
+    def build(self, diff_text, search_paths=None):
+        # search_paths : the files to look up the referenced signatures in addition to the changed files
+        sections = []
+        references = set()
+        if search_paths:
+            self.index.add_files(search_paths)
+        for path, hunks in self.parse_diff(diff_text).items():
+            text, file_references = self.build_file(path, hunks)
+            sections.append(text)
+            references |= file_references
+        signatures = self._get_signatures(references)
+        if signatures:
+            sections.append(signatures)
+        self.index.save()
+        return "\n\n".join(sections)
+
+    def build_each(self, diff_text, search_paths=None):
+        # {path: context} to review the changed files separately
+        results = {}
+        if search_paths:
+            self.index.add_files(search_paths)
+        for path, hunks in self.parse_diff(diff_text).items():
+            text, file_references = self.build_file(path, hunks)
+            signatures = self._get_signatures(file_references)
+            results[path] = text + "\n\n" + signatures if signatures else text
+        self.index.save()
+        return results
+
+    @staticmethod
+    def get_git_files(base_dir="."):
+        try:
+            result = subprocess.run(["git", "ls-files"], cwd=base_dir, capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            return []
+        return [os.path.join(base_dir, path) for path in result.stdout.splitlines() if SymbolIndex.is_supported(path)]
+
+    @staticmethod
+    def get_git_root(path="."):
+        try:
+            result = subprocess.run(["git", "rev-parse", "--show-toplevel"], cwd=path, capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return result.stdout.strip() or None
+
+    @staticmethod
+    def get_default_cache_path(base_dir="."):
+        # inside .git not to be committed
+        git_dir = os.path.join(base_dir, ".git")
+        return os.path.join(git_dir, "llm-symbols.json") if os.path.isdir(git_dir) else None
+
+    @staticmethod
+    def new_for_repo(base_dir=None, max_definition_lines=200):
+        # base_dir : the root the paths in the diff are relative to (default: git top level or cwd)
+        # the symbol index is cached in LLM_SYMBOL_CACHE or .git/llm-symbols.json
+        if not base_dir:
+            base_dir = DiffContext.get_git_root() or os.getcwd()
+        return DiffContext(SymbolIndex(os.getenv("LLM_SYMBOL_CACHE") or DiffContext.get_default_cache_path(base_dir)), base_dir, max_definition_lines)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Build the review context of git diff with the enclosing definitions')
+    parser.add_argument('args', nargs='*', help='diff files (default: stdin)')
+    parser.add_argument('-b', '--basedir', action='store', default=None, help='specify the repository root the paths in the diff are relative to (default: git top level)')
+    parser.add_argument('-m', '--maxlines', action='store', type=int, default=200, help='specify max lines of the enclosing definition to include entirely')
+    args = parser.parse_args()
+
+    diff_text = ""
+    if args.args:
+        for path in args.args:
+            with open(path, 'r', encoding='UTF-8') as f:
+                diff_text += f.read()
+    else:
+        diff_text = sys.stdin.read()
+    context = DiffContext.new_for_repo(args.basedir, args.maxlines)
+    result = context.build(diff_text, DiffContext.get_git_files(context.base_dir))
+    print(result)
+    # compared with sending the whole changed files
+    whole_size = sum(os.path.getsize(os.path.join(context.base_dir, path)) for path in DiffContext.parse_diff(diff_text) if os.path.isfile(os.path.join(context.base_dir, path)))
+    print(f"whole files {whole_size} chars, diff {len(diff_text)} chars -> context {len(result)} chars", file=sys.stderr)
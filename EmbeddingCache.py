@@ -0,0 +1,88 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+class EmbeddingCache:
+    def __init__(self, path):
+        # path.vec : float32 rows appended, path.keys : the content hash of each row (1st line is the dim)
+        # both are append only, then a partially written tail is cut at the next load
+        self.vectors_path = path + ".vec"
+        self.keys_path = path + ".keys"
+        self.dim = None
+        self.index = {}
+        self.vectors = None
+        self.appended = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return
+        with open(self.keys_path, 'r', encoding='UTF-8') as f:
+            lines = f.read().splitlines()
+        if not lines:
+            return
+        self.dim = int(lines[0])
+        keys = [key for key in lines[1:] if len(key)==64]
+        rows = min(len(keys), os.path.getsize(self.vectors_path) // (self.dim * 4))
+        if rows != len(keys) or rows * self.dim * 4 != os.path.getsize(self.vectors_path):
+            # cut the interrupted tail not to misalign the next append
+            os.truncate(self.vectors_path, rows * self.dim * 4)
+            with open(self.keys_path, 'w', encoding='UTF-8') as f:
+                f.write("".join([f"{self.dim}\n"] + [key + "\n" for key in keys[:rows]]))
+        if rows:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        for row, key in enumerate(keys[:rows]):
+            self.index[key] = row
+
+    def __len__(self):
+        return len(self.index) + len(self.appended)
+
+    def get_many(self, keys):
+        results = {}
+        with self._lock:
+            for key in keys:
+                if key in self.appended:
+                    results[key] = self.appended[key]
+                elif key in self.index:
+                    results[key] = np.array(self.vectors[self.index[key]])
+        return results
+
+    def put_many(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                directory = os.path.dirname(os.path.abspath(self.keys_path))
+                os.makedirs(directory, exist_ok=True)
+                self.dim = vectors.shape[1]
+                with open(self.keys_path, 'w', encoding='UTF-8') as f:
+                    f.write(f"{self.dim}\n")
+                open(self.vectors_path, 'wb').close()
+            if vectors.shape[1] != self.dim:
+                return
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.keys_path, 'a', encoding='UTF-8') as f:
+                f.write("".join([key + "\n" for key in keys]))
+            for key, vector in zip(keys, vectors):
+                self.appended[key] = vector
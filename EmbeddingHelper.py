@@ -0,0 +1,62 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import requests
+from GptHelper import IGpt
+from EmbeddingCache import EmbeddingCache
+from EndpointPool import EndpointPool
+from Deadline import Deadline
+
+
+class OpenAICompatibleEmbedding(IGpt):
+    def __init__(self, api_key, endpoint, model=None, headers={}):
+        self.api_key = api_key
+        self.endpoint = endpoint
+        self.model = model
+        self.headers = dict(headers)
+        self.headers['accept'] = 'application/json'
+        self.headers['Content-Type'] = 'application/json'
+        if self.api_key:
+            self.headers['Authorization'] = f'Bearer {self.api_key}'
+        self.session = EndpointPool.new_session()
+
+    def embed_batch(self, texts):
+        payload = {
+            "input": texts,
+        }
+        if self.model:
+            payload["model"] = self.model
+        deadline = Deadline.current()
+        if deadline:
+            deadline.check()
+        timeout = deadline.get_timeout() if deadline else (Deadline.CONNECT_TIMEOUT, Deadline.READ_TIMEOUT)
+        response = self.session.post(self.endpoint, headers=self.headers, json=payload, timeout=timeout)
+        if response.status_code != 200:
+            raise Exception(f"Error: {response.status_code} - {response.text}")
+        data = sorted(response.json()["data"], key=lambda x: x.get("index", 0))
+        return [d["embedding"] for d in data]
+
+    @staticmethod
+    def new_from_env(api_key=None, endpoint=None, model=None):
+        # e.g. LLM_EMBEDDING_ENDPOINT=http://localhost:8080/v1/embeddings for gaia's all-MiniLM
+        api_key = os.getenv("LLM_EMBEDDING_API_KEY", os.getenv("LLM_API_KEY")) if not api_key else api_key
+        endpoint = os.getenv("LLM_EMBEDDING_ENDPOINT") if not endpoint else endpoint
+        model = os.getenv("LLM_EMBEDDING_MODEL") if not model else model
+        if endpoint:
+            embedder = OpenAICompatibleEmbedding(api_key, endpoint, model)
+            if os.getenv("LLM_EMBEDDING_CACHE"):
+                embedder.embedding_cache = EmbeddingCache(os.getenv("LLM_EMBEDDING_CACHE"))
+            return embedder
+        return None
@@ -0,0 +1,213 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+import time
+import requests
+from Deadline import Deadline
+
+
+class EndpointUnavailableError(Exception):
+    pass
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def is_available(self, now):
+        return self.ejected_until <= now
+
+    def __repr__(self):
+        return f"Endpoint({self.url}, outstanding={self.outstanding}, ewma={self.ewma_latency}, failures={self.consecutive_failures})"
+
+
+class EndpointPool:
+    POLICY_LEAST_OUTSTANDING = "least_outstanding"
+    POLICY_EWMA = "ewma"
+    # GptDaemon sets this to share the keep-alive connections among the requests
+    shared_session = None
+
+    def __init__(self, urls, policy=POLICY_LEAST_OUTSTANDING, max_failures=3, eject_duration=30.0, ewma_alpha=0.3, max_failover=None):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_duration = eject_duration
+        self.ewma_alpha = ewma_alpha
+        self.max_failover = len(self.endpoints) if max_failover is None else max_failover
+        self._lock = threading.Lock()
+        self._health_thread = None
+        self._health_stop = threading.Event()
+
+    @staticmethod
+    def new_session():
+        return EndpointPool.shared_session if EndpointPool.shared_session is not None else requests.Session()
+
+    @staticmethod
+    def parse(endpoints):
+        result = []
+        if endpoints:
+            for url in endpoints.split(","):
+                url = url.strip()
+                if url:
+                    result.append(url)
+        return result
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _score(self, endpoint):
+        if self.policy == self.POLICY_EWMA:
+            # expected latency when the request is queued behind the outstanding ones
+            latency = endpoint.ewma_latency if endpoint.ewma_latency is not None else 0.0
+            return latency * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def acquire(self, exclude=()):
+        with self._lock:
+            now = time.time()
+            candidates = [e for e in self.endpoints if e not in exclude and e.is_available(now)]
+            if not candidates:
+                # all replicas are ejected, then let the earliest re-admission one try
+                candidates = [e for e in self.endpoints if e not in exclude]
+                if not candidates:
+                    raise EndpointUnavailableError("No available endpoint")
+                candidates = [min(candidates, key=lambda e: e.ejected_until)]
+            endpoint = min(candidates, key=lambda e: (self._score(e), e.total_requests))
+            endpoint.outstanding += 1
+            endpoint.total_requests += 1
+            return endpoint
+
+    def release(self, endpoint, latency=None, is_success=True):
+        # is_success=None only returns the slot (e.g. cancelled by the caller)
+        with self._lock:
+            endpoint.outstanding = max(endpoint.outstanding - 1, 0)
+            if is_success is not None:
+                self._report(endpoint, latency, is_success)
+
+    def _report(self, endpoint, latency, is_success):
+        if is_success:
+            endpoint.consecutive_failures = 0
+            endpoint.ejected_until = 0
+            if latency is not None:
+                if endpoint.ewma_latency is None:
+                    endpoint.ewma_latency = latency
+                else:
+                    endpoint.ewma_latency = self.ewma_alpha * latency + (1 - self.ewma_alpha) * endpoint.ewma_latency
+        else:
+            endpoint.consecutive_failures += 1
+            endpoint.total_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures:
+                endpoint.ejected_until = time.time() + self.eject_duration
+
+    @staticmethod
+    def is_retriable_error(err):
+        if isinstance(err, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        if isinstance(err, requests.exceptions.HTTPError) and err.response is not None:
+            return err.response.status_code in (429, 500, 502, 503, 504)
+        return False
+
+    def run(self, func, is_idempotent=True, is_emitted=None):
+        # func(url) is called with the chosen replica and failed over to another one when possible
+        # is_emitted() : True once the streamed output reached the caller, then no failover not to duplicate it
+        tried = []
+        last_error = None
+        deadline = Deadline.current()
+        while len(tried) < max(self.max_failover, 1):
+            if deadline:
+                # no failover after the caller gave up
+                deadline.check()
+            try:
+                endpoint = self.acquire(exclude=tried)
+            except EndpointUnavailableError:
+                break
+            tried.append(endpoint)
+            start_time = time.time()
+            try:
+                result = func(endpoint.url)
+                self.release(endpoint, time.time() - start_time, True)
+                return result
+            except Exception as err:
+                if deadline and deadline.is_done():
+                    # the stuck replica counts as failure, the caller's cancel doesn't
+                    self.release(endpoint, None, None if deadline.is_cancelled() else False)
+                    deadline.check()
+                is_retriable = self.is_retriable_error(err)
+                self.release(endpoint, None, not is_retriable)
+                last_error = err
+                if not is_idempotent or not is_retriable or (is_emitted and is_emitted()):
+                    raise
+        if last_error:
+            raise last_error
+        raise EndpointUnavailableError("No available endpoint")
+
+    def check_health(self, health_check, timeout=3.0):
+        # health_check(url, timeout) returns True if the replica is healthy
+        for endpoint in list(self.endpoints):
+            is_healthy = False
+            start_time = time.time()
+            try:
+                is_healthy = health_check(endpoint.url, timeout)
+            except Exception:
+                is_healthy = False
+            with self._lock:
+                if is_healthy:
+                    # re-admit the ejected replica
+                    endpoint.consecutive_failures = 0
+                    endpoint.ejected_until = 0
+                else:
+                    endpoint.consecutive_failures = max(endpoint.consecutive_failures, self.max_failures - 1)
+                    self._report(endpoint, None, False)
+
+    def start_health_check(self, health_check, interval=10.0, timeout=3.0):
+        if self._health_thread:
+            return
+        self._health_stop.clear()
+
+        def _loop():
+            while not self._health_stop.wait(interval):
+                self.check_health(health_check, timeout)
+
+        self._health_thread = threading.Thread(target=_loop, daemon=True)
+        self._health_thread.start()
+
+    def stop_health_check(self):
+        if self._health_thread:
+            self._health_stop.set()
+            self._health_thread.join()
+            self._health_thread = None
+
+    def get_stats(self):
+        with self._lock:
+            return [{
+                "url": e.url,
+                "outstanding": e.outstanding,
+                "ewma_latency": e.ewma_latency,
+                "total_requests": e.total_requests,
+                "total_failures": e.total_failures,
+                "is_ejected": not e.is_available(time.time()),
+            } for e in self.endpoints]
+
+
+def http_health_check(url, timeout=3.0):
+    # any HTTP answer from the server means the replica process is alive
+    response = requests.get(url, timeout=timeout)
+    return response.status_code < 500
@@ -0,0 +1,167 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+class _Inotify:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+
+    def add_dir(self, path):
+        # editors often save by rename, then the directories are watched instead of the files
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+        self.dirs[wd] = path
+
+    def read_events(self):
+        # returns [(path, is_dir)]
+        events = []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            name = data[pos:pos+length].rstrip(b"\0")
+            pos += length
+            if wd in self.dirs and name:
+                events.append((os.path.join(self.dirs[wd], os.fsdecode(name)), bool(mask & self.IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher:
+    def __init__(self, paths, debounce=0.3, poll_interval=0.5, is_polling=False):
+        # paths : files and/or directories (recursive). on_change(path) is called once the path is quiet for debounce seconds
+        self.files = set()
+        self.dirs = set()
+        for path in paths:
+            path = os.path.abspath(path)
+            if os.path.isdir(path):
+                for dirpath, dirnames, _ in os.walk(path):
+                    dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                    self.dirs.add(dirpath)
+            else:
+                self.files.add(path)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.inotify = None
+        if not is_polling:
+            try:
+                self.inotify = _Inotify()
+                for path in self.dirs | set(os.path.dirname(f) for f in self.files):
+                    self.inotify.add_dir(path)
+            except (OSError, AttributeError):
+                # not linux or the watch limit, then fallback to polling
+                self.inotify = None
+        self._is_running = False
+
+    def is_target(self, path):
+        if path in self.files:
+            return True
+        name = os.path.basename(path)
+        if name.startswith(".") or name.endswith(("~", ".swp", ".tmp")):
+            return False
+        return os.path.dirname(path) in self.dirs
+
+    def get_targets(self):
+        targets = set(self.files)
+        for dirpath in self.dirs:
+            try:
+                for name in os.listdir(dirpath):
+                    path = os.path.join(dirpath, name)
+                    if os.path.isfile(path) and self.is_target(path):
+                        targets.add(path)
+            except OSError:
+                pass
+        return targets
+
+    def _poll(self, snapshots):
+        changed = []
+        for path in self.get_targets():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot = (stat.st_mtime_ns, stat.st_size)
+            if snapshots.get(path) != snapshot:
+                if path in snapshots:
+                    changed.append(path)
+                snapshots[path] = snapshot
+        return changed
+
+    def watch(self, on_change):
+        self._is_running = True
+        pending = {}
+        snapshots = {}
+        if not self.inotify:
+            self._poll(snapshots)
+        while self._is_running:
+            now = time.time()
+            timeout = min([pending_time + self.debounce - now for pending_time in pending.values()] + [self.poll_interval])
+            if self.inotify:
+                readable, _, _ = select.select([self.inotify.fd], [], [], max(timeout, 0))
+                if readable:
+                    for path, is_dir in self.inotify.read_events():
+                        if is_dir and os.path.dirname(path) in self.dirs and not os.path.basename(path).startswith("."):
+                            self.dirs.add(path)
+                            self.inotify.add_dir(path)
+                        elif not is_dir and self.is_target(path):
+                            pending[path] = time.time()
+            else:
+                time.sleep(max(timeout, 0))
+                for path in self._poll(snapshots):
+                    pending[path] = time.time()
+
+            # debounce: the burst of the saves is one change
+            now = time.time()
+            for path in [p for p, pending_time in pending.items() if now - pending_time >= self.debounce]:
+                del pending[path]
+                if os.path.isfile(path):
+                    on_change(path)
+
+    def stop(self):
+        self._is_running = False
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,270 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import os
+import sys
+import threading
+from GptHelper import IGpt
+from GptPricing import GptPricing
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class _Spend:
+    def __init__(self, max_tokens=None, max_cost=None):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.tokens = 0
+        self.cost = 0.0
+        self.calls = 0
+
+    def get_remaining(self):
+        remaining_tokens = self.max_tokens - self.tokens if self.max_tokens else None
+        remaining_cost = self.max_cost - self.cost if self.max_cost else None
+        return remaining_tokens, remaining_cost
+
+    def get_ratio(self):
+        ratios = [0.0]
+        if self.max_tokens:
+            ratios.append(self.tokens / self.max_tokens)
+        if self.max_cost:
+            ratios.append(self.cost / self.max_cost)
+        return max(ratios)
+
+    def is_exhausted(self):
+        remaining_tokens, remaining_cost = self.get_remaining()
+        return (remaining_tokens is not None and remaining_tokens <= 0) or (remaining_cost is not None and remaining_cost <= 0)
+
+    def __repr__(self):
+        tokens = f"{self.tokens:,}/{self.max_tokens:,} tokens" if self.max_tokens else f"{self.tokens:,} tokens"
+        cost = f"${self.cost:.4f}/${self.max_cost:.2f}" if self.max_cost else f"${self.cost:.4f}"
+        return f"{tokens} {cost}"
+
+
+class GptBudget:
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_tokens=None, max_cost=None, max_job_tokens=None, max_job_cost=None, model_limits={}, pricing=None, degrade_ratio=0.8, min_prompt_tokens=256, is_verbose=True):
+        # model_limits : {model: {"tokens": N, "cost": USD}}. None or 0 is unlimited
+        self.pricing = pricing if pricing else GptPricing.new_from_env()
+        self.max_job_tokens = max_job_tokens
+        self.max_job_cost = max_job_cost
+        self.model_limits = dict(model_limits)
+        self.degrade_ratio = degrade_ratio
+        self.min_prompt_tokens = min_prompt_tokens
+        self.is_verbose = is_verbose
+        self.run = _Spend(max_tokens, max_cost)
+        self.jobs = {}
+        self.models = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_from_env(args=None):
+        # LLM_BUDGET_TOKENS, LLM_BUDGET_COST : per run, LLM_BUDGET_JOB_TOKENS, LLM_BUDGET_JOB_COST : per job
+        # LLM_BUDGET_MODELS='{"gpt-4o": {"tokens": 100000, "cost": 1.0}}' : per model
+        max_tokens = int(os.getenv("LLM_BUDGET_TOKENS", "0"))
+        max_cost = float(os.getenv("LLM_BUDGET_COST", "0"))
+        if args is not None and "budgettokens" in args and args.budgettokens:
+            max_tokens = args.budgettokens
+        if args is not None and "budgetcost" in args and args.budgetcost:
+            max_cost = args.budgetcost
+        max_job_tokens = int(os.getenv("LLM_BUDGET_JOB_TOKENS", "0"))
+        max_job_cost = float(os.getenv("LLM_BUDGET_JOB_COST", "0"))
+        model_limits = json.loads(os.getenv("LLM_BUDGET_MODELS", "{}"))
+        if max_tokens or max_cost or max_job_tokens or max_job_cost or model_limits:
+            return GptBudget(max_tokens, max_cost, max_job_tokens, max_job_cost, model_limits)
+        return None
+
+    @staticmethod
+    def get_default(args=None):
+        # one budget per process (run) shared by all of the clients
+        with GptBudget._default_lock:
+            if GptBudget._default is None:
+                GptBudget._default = GptBudget.new_from_env(args)
+            return GptBudget._default
+
+    def _get_spends_locked(self, model, job):
+        spends = [self.run]
+        if job is not None:
+            if job not in self.jobs:
+                self.jobs[job] = _Spend(self.max_job_tokens, self.max_job_cost)
+            spends.append(self.jobs[job])
+        if model not in self.models:
+            limits = self.model_limits.get(str(model), {})
+            self.models[model] = _Spend(limits.get("tokens"), limits.get("cost"))
+        spends.append(self.models[model])
+        return spends
+
+    def _get_max_prompt_tokens_locked(self, model, job):
+        max_prompt_tokens = None
+        price = self.pricing.get_price(model)
+        for spend in self._get_spends_locked(model, job):
+            remaining_tokens, remaining_cost = spend.get_remaining()
+            if remaining_cost is not None and price and price[0]:
+                remaining_cost_tokens = int(remaining_cost * 1000000 / price[0])
+                remaining_tokens = remaining_cost_tokens if remaining_tokens is None else min(remaining_tokens, remaining_cost_tokens)
+            if remaining_tokens is not None:
+                max_prompt_tokens = remaining_tokens if max_prompt_tokens is None else min(max_prompt_tokens, remaining_tokens)
+        return max_prompt_tokens
+
+    def plan(self, model, prompt_tokens, job=None, fallback_model=None):
+        # returns (model to use, max prompt tokens or None if the prompt fits) or raises BudgetExceededError
+        # degradation : the cheaper fallback_model after degrade_ratio, then the shrunk context, then stop
+        with self._lock:
+            spends = self._get_spends_locked(model, job)
+            if fallback_model and fallback_model != model:
+                if any(spend.is_exhausted() or spend.get_ratio() >= self.degrade_ratio for spend in spends):
+                    model = fallback_model
+                    spends = self._get_spends_locked(model, job)
+            for spend in spends:
+                if spend.is_exhausted():
+                    raise BudgetExceededError(f"budget exceeded ({model}, job={job}): {spend}")
+            max_prompt_tokens = self._get_max_prompt_tokens_locked(model, job)
+        if max_prompt_tokens is None or prompt_tokens <= max_prompt_tokens:
+            return model, None
+        if max_prompt_tokens < self.min_prompt_tokens:
+            raise BudgetExceededError(f"budget exceeded ({model}, job={job}): only {max_prompt_tokens} tokens are left for the {prompt_tokens} tokens prompt")
+        return model, max_prompt_tokens
+
+    def charge(self, model, prompt_tokens, completion_tokens, job=None):
+        cost = self.pricing.estimate_cost(model, prompt_tokens, completion_tokens) or 0.0
+        tokens = (prompt_tokens or 0) + (completion_tokens or 0)
+        with self._lock:
+            for spend in self._get_spends_locked(model, job):
+                spend.tokens += tokens
+                spend.cost += cost
+                spend.calls += 1
+        if self.is_verbose:
+            print(f"[budget] {self.get_summary(model, job)}", file=sys.stderr)
+        return cost
+
+    def get_summary(self, model=None, job=None):
+        with self._lock:
+            summary = f"run: {self.run}"
+            if job is not None and job in self.jobs:
+                summary += f" | job {job}: {self.jobs[job]}"
+            if model is not None and model in self.models:
+                summary += f" | {model}: {self.models[model]}"
+            return summary
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "tokens": self.run.tokens,
+                "cost": self.run.cost,
+                "calls": self.run.calls,
+                "models": {str(model): {"tokens": spend.tokens, "cost": spend.cost, "calls": spend.calls} for model, spend in self.models.items()},
+                "jobs": {str(job): {"tokens": spend.tokens, "cost": spend.cost, "calls": spend.calls} for job, spend in self.jobs.items()},
+            }
+
+
+class BudgetedGpt(IGpt):
+    def __init__(self, client, budget, fallback_client=None, job=None):
+        # fallback_client : the same provider with a cheaper model to degrade to
+        self.client = client
+        self.budget = budget
+        self.fallback_client = fallback_client
+        self.job = job
+        self.model = getattr(client, "model", None)
+        # IGpt.embed() runs on this wrapper to charge each batch, then with the wrapped client's batch size and cache
+        self.EMBEDDING_BATCH_SIZE = getattr(client, "EMBEDDING_BATCH_SIZE", IGpt.EMBEDDING_BATCH_SIZE)
+        self.embedding_model = getattr(client, "embedding_model", None) or self.model
+
+    @property
+    def embedding_cache(self):
+        return getattr(self.client, "embedding_cache", None)
+
+    @embedding_cache.setter
+    def embedding_cache(self, embedding_cache):
+        self.client.embedding_cache = embedding_cache
+
+    def for_job(self, job):
+        return BudgetedGpt(self.client, self.budget, self.fallback_client, job)
+
+    @staticmethod
+    def shrink(user_prompt, user_tokens, max_user_tokens):
+        # keep the head since the instruction is followed by the appended files
+        keep = int(len(user_prompt) * max_user_tokens / user_tokens) if user_tokens else 0
+        return user_prompt[:keep] + "\n...(truncated to fit the budget)"
+
+    def _plan(self, prompt_tokens):
+        # (model, client, max prompt tokens or None)
+        fallback_model = getattr(self.fallback_client, "model", None) if self.fallback_client else None
+        model, max_prompt_tokens = self.budget.plan(self.model, prompt_tokens, self.job, fallback_model)
+        client = self.fallback_client if self.fallback_client and model == fallback_model and model != self.model else self.client
+        return model, client, max_prompt_tokens
+
+    def _charge(self, model, response, prompt_tokens, contents):
+        # the actual usage if reported, otherwise the local estimation
+        usage = IGpt.get_usage(response)
+        if usage["prompt_tokens"] is None:
+            usage["prompt_tokens"] = prompt_tokens
+        if usage["completion_tokens"] is None:
+            usage["completion_tokens"] = sum(IGpt.estimate_tokens(content if isinstance(content, str) else "".join(content or [])) for content in contents)
+        self.budget.charge(model, usage["prompt_tokens"], usage["completion_tokens"], self.job)
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        user_tokens = IGpt.estimate_tokens(user_prompt)
+        prompt_tokens = IGpt.estimate_tokens(system_prompt) + user_tokens
+        model, client, max_prompt_tokens = self._plan(prompt_tokens)
+        if max_prompt_tokens is not None:
+            user_prompt = self.shrink(user_prompt, user_tokens, max(max_prompt_tokens - (prompt_tokens - user_tokens), 0))
+
+        content = response = None
+        try:
+            content, response = client.query(system_prompt, user_prompt, callback)
+        finally:
+            self._charge(model, response, IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt), [content])
+        return content, response
+
+    def query_n(self, system_prompt, user_prompt, n):
+        user_tokens = IGpt.estimate_tokens(user_prompt)
+        prompt_tokens = IGpt.estimate_tokens(system_prompt) + user_tokens
+        model, client, max_prompt_tokens = self._plan(prompt_tokens)
+        if max_prompt_tokens is not None:
+            user_prompt = self.shrink(user_prompt, user_tokens, max(max_prompt_tokens - (prompt_tokens - user_tokens), 0))
+
+        results = client.query_n(system_prompt, user_prompt, n)
+        if results:
+            # one response has the usage of all of the choices
+            self._charge(model, results[0][1], IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt), [content for content, _ in results])
+        return results
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        prompt_tokens = sum(IGpt.estimate_tokens(m["content"]) for m in messages if isinstance(m.get("content"), str))
+        model, client, max_prompt_tokens = self._plan(prompt_tokens)
+        # drop the oldest turns after the system, the last one is the new turn
+        head = 1 if messages and messages[0]["role"] == "system" else 0
+        while max_prompt_tokens is not None and prompt_tokens > max_prompt_tokens and len(messages) > head + 1:
+            prompt_tokens -= IGpt.estimate_tokens(messages[head]["content"]) if isinstance(messages[head].get("content"), str) else 0
+            messages = messages[:head] + messages[head + 1:]
+
+        content = response = None
+        try:
+            content, response = client.query_messages(messages, callback, session_id=session_id)
+        finally:
+            self._charge(model, response, prompt_tokens, [content])
+        return content, response
+
+    def embed_batch(self, texts):
+        tokens = sum(IGpt.estimate_tokens(text) for text in texts)
+        self.budget.plan(self.embedding_model, tokens, self.job)
+        vectors = self.client.embed_batch(texts)
+        if vectors is not None:
+            self.budget.charge(self.embedding_model, tokens, 0, self.job)
+        return vectors
@@ -0,0 +1,527 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# keep this module light: the client side runs before the CLI's heavy imports
+import argparse
+import json
+import os
+import select
+import socket
+import sys
+import threading
+import time
+from Tracer import Tracer
+
+SOCKET_ENV = "GPT_DAEMON_SOCKET"
+# the client's cwd of the request handled in this thread
+_request_cwd = threading.local()
+
+
+class GptDaemonClient:
+    @staticmethod
+    def forward_if_enabled(name, script_path):
+        # run the CLI on the warm daemon if GPT_DAEMON_SOCKET is set, otherwise fall through to the local execution
+        socket_path = os.getenv(SOCKET_ENV)
+        if name != "__main__" or not socket_path:
+            return
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socket_path)
+        except OSError:
+            return
+
+        stdin_data = None
+        if select.select([sys.stdin], [], [], 0.0)[0]:
+            stdin_data = sys.stdin.read()
+        env = dict(os.environ)
+        env.pop(SOCKET_ENV, None)
+        request = {
+            "script": os.path.basename(script_path),
+            "argv": sys.argv[1:],
+            "cwd": os.getcwd(),
+            "stdin": stdin_data,
+            "env": env,
+        }
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+
+        exit_code = 1
+        with sock.makefile("r", encoding="utf-8") as reader:
+            for line in reader:
+                frame = json.loads(line)
+                if "out" in frame:
+                    sys.stdout.write(frame["out"])
+                    sys.stdout.flush()
+                elif "err" in frame:
+                    sys.stderr.write(frame["err"])
+                    sys.stderr.flush()
+                elif "exit" in frame:
+                    exit_code = frame["exit"]
+                    break
+        sock.close()
+        sys.exit(exit_code)
+
+
+class _ThreadLocalStream:
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, "stream", None) or self.default
+
+    def set(self, stream):
+        self.local.stream = stream
+
+    def get_local(self):
+        return getattr(self.local, "stream", None)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        return self._target().flush()
+
+    def fileno(self):
+        return self._target().fileno()
+
+    def isatty(self):
+        return False if getattr(self.local, "stream", None) else self.default.isatty()
+
+
+class _ThreadLocalArgv(list):
+    # argparse reads sys.argv[0] and sys.argv[1:] then each request thread sees its own argv
+    def __init__(self, default):
+        super().__init__(default)
+        self.local = threading.local()
+
+    def _target(self):
+        return getattr(self.local, "argv", None) or list(super().__iter__())
+
+    def set(self, argv):
+        self.local.argv = argv
+
+    def get_local(self):
+        return getattr(self.local, "argv", None)
+
+    def __getitem__(self, index):
+        return self._target()[index]
+
+    def __len__(self):
+        return len(self._target())
+
+    def __iter__(self):
+        return iter(self._target())
+
+
+class _ThreadLocalEnviron(dict):
+    # the CLIs take their defaults from env (e.g. LLM_ENDPOINT) then use the caller's env per request thread
+    def __init__(self, default):
+        super().__init__()
+        self.default = default
+        self.local = threading.local()
+
+    def _target(self):
+        env = getattr(self.local, "env", None)
+        return env if env is not None else self.default
+
+    def set(self, env):
+        self.local.env = env
+
+    def get_local(self):
+        return getattr(self.local, "env", None)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        del self._target()[key]
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+    def get(self, key, default=None):
+        return self._target().get(key, default)
+
+    def pop(self, key, *args):
+        return self._target().pop(key, *args)
+
+    def keys(self):
+        return self._target().keys()
+
+    def items(self):
+        return self._target().items()
+
+    def copy(self):
+        return dict(self._target())
+
+
+class _RequestContext:
+    # stdin, stdout, stderr, argv, env, cwd and tracer of the request in this thread
+    @staticmethod
+    def get():
+        return (sys.stdin.get_local(), sys.stdout.get_local(), sys.stderr.get_local(), sys.argv.get_local(), os.environ.get_local(), getattr(_request_cwd, "cwd", None), Tracer.get_current())
+
+    @staticmethod
+    def set(context):
+        stdin, stdout, stderr, argv, env, cwd, tracer = context if context else (None,) * 7
+        sys.stdin.set(stdin)
+        sys.stdout.set(stdout)
+        sys.stderr.set(stderr)
+        sys.argv.set(argv)
+        os.environ.set(env)
+        _request_cwd.cwd = cwd
+        Tracer.set_current(tracer)
+
+    @staticmethod
+    def install():
+        # the threads started by the exec'd CLI (e.g. ThreadPoolExecutor's workers) inherit the request's context
+        # otherwise they print to the daemon's stdout and read the daemon's env such as the api keys and GPT_PRIORITY
+        start = threading.Thread.start
+
+        def _start(thread):
+            context = _RequestContext.get()
+            if any(value is not None for value in context):
+                run = thread.run
+
+                def _run():
+                    _RequestContext.set(context)
+                    try:
+                        run()
+                    finally:
+                        _RequestContext.set(None)
+                thread.run = _run
+            start(thread)
+        threading.Thread.start = _start
+
+
+class _FrameWriter:
+    def __init__(self, conn, lock, key):
+        self.conn = conn
+        self.lock = lock
+        self.key = key
+
+    def write(self, data):
+        if data:
+            try:
+                with self.lock:
+                    self.conn.sendall(json.dumps({self.key: data}).encode("utf-8") + b"\n")
+            except OSError:
+                # the thread left by the finished request or the client is gone
+                pass
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _ScheduledStream:
+    # holds the scheduler's slot until the stream is exhausted or closed
+    def __init__(self, stream, scheduler, ticket):
+        self._stream = stream
+        self._scheduler = scheduler
+        self._ticket = ticket
+        self._lock = threading.Lock()
+
+    def _release(self):
+        with self._lock:
+            ticket = self._ticket
+            self._ticket = None
+        if ticket:
+            self._scheduler.release(ticket)
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        finally:
+            self._release()
+
+    def close(self):
+        try:
+            close = getattr(self._stream, "close", None)
+            if close:
+                close()
+        finally:
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        # the caller dropped the stream without reading it
+        self._release()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _ScheduledCompletions:
+    # chat.completions of the shared AzureOpenAI client queued by GPT_PRIORITY of each request
+    def __init__(self, completions, scheduler):
+        self._completions = completions
+        self._scheduler = scheduler
+
+    def create(self, **kwargs):
+        from GptHelper import IGpt
+        from GptScheduler import PRIORITY_ENV, GptScheduler
+        cost = sum([IGpt.estimate_tokens(str(m.get("content", ""))) for m in kwargs.get("messages", [])])
+        priority = os.getenv(PRIORITY_ENV, GptScheduler.PRIORITY_INTERACTIVE)
+        if not kwargs.get("stream"):
+            return self._scheduler.run(lambda: self._completions.create(**kwargs), priority, cost)
+        # stream=True: the generation goes on while the caller reads the chunks
+        ticket = self._scheduler.acquire(priority, cost)
+        try:
+            stream = self._completions.create(**kwargs)
+        except BaseException:
+            self._scheduler.release(ticket)
+            raise
+        return _ScheduledStream(stream, self._scheduler, ticket)
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+
+class GptDaemonServer:
+    def __init__(self, socket_path, scripts_dir=None, concurrency=0):
+        # concurrency : max concurrent requests per end point with the priority scheduling (0 is unlimited)
+        self.socket_path = socket_path
+        self.scripts_dir = scripts_dir if scripts_dir else os.path.dirname(os.path.abspath(__file__))
+        self.concurrency = concurrency
+        self._codes = {}
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def _warm_up(self):
+        # pay the SDK imports once and share clients and connection pools among the requests
+        import requests
+        import openai
+        from EndpointPool import EndpointPool
+        EndpointPool.shared_session = requests.Session()
+        azure_openai = openai.AzureOpenAI
+
+        def _cached_azure_openai(**kwargs):
+            key = tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+            with self._lock:
+                if key not in self._clients:
+                    client = azure_openai(**kwargs)
+                    if self.concurrency:
+                        from GptScheduler import GptScheduler
+                        scheduler = GptScheduler.get_for(str(kwargs.get("azure_endpoint")), self.concurrency)
+                        client.chat.completions = _ScheduledCompletions(client.chat.completions, scheduler)
+                    self._clients[key] = client
+                return self._clients[key]
+        openai.AzureOpenAI = _cached_azure_openai
+
+        try:
+            import boto3
+            import GptHelper
+        except ImportError:
+            pass
+
+        if self.scripts_dir not in sys.path:
+            sys.path.insert(0, self.scripts_dir)
+
+    @staticmethod
+    def resolve_paths(values, cwd):
+        # the existing paths (also file:line) relative to the client's cwd are made absolute
+        if isinstance(values, list):
+            return [GptDaemonServer.resolve_paths(value, cwd) for value in values]
+        if not isinstance(values, str):
+            return values
+        path = values.split(":")[0] if ":" in values else values
+        if path and not os.path.isabs(path) and os.path.exists(os.path.join(cwd, path)):
+            return os.path.normpath(os.path.join(cwd, path)) + values[len(path):]
+        return values
+
+    @staticmethod
+    def _install_argparse_hook():
+        # the daemon has its own cwd. the positional arguments of the CLIs are the files, then only they are resolved
+        # against the client's cwd after the parse. pass the absolute path to the path options (e.g. -o, --session)
+        parse_known_args = argparse.ArgumentParser.parse_known_args
+
+        def _parse_known_args(parser, args=None, namespace=None):
+            namespace, extras = parse_known_args(parser, args, namespace)
+            cwd = getattr(_request_cwd, "cwd", None)
+            if cwd:
+                for action in parser._actions:
+                    if not action.option_strings and not isinstance(action, argparse._SubParsersAction) and hasattr(namespace, action.dest):
+                        setattr(namespace, action.dest, GptDaemonServer.resolve_paths(getattr(namespace, action.dest), cwd))
+            return namespace, extras
+        argparse.ArgumentParser.parse_known_args = _parse_known_args
+
+    def _get_code(self, script):
+        path = os.path.join(self.scripts_dir, os.path.basename(script))
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._codes.get(path)
+            if not cached or cached[0] != mtime:
+                with open(path, 'r', encoding='UTF-8') as f:
+                    cached = (mtime, compile(f.read(), path, "exec"))
+                self._codes[path] = cached
+        return path, cached[1]
+
+    def _handle(self, conn):
+        lock = threading.Lock()
+        exit_code = 0
+        stdin_r = None
+        try:
+            with conn.makefile("r", encoding="utf-8") as reader:
+                request = json.loads(reader.readline())
+            if request.get("stats"):
+                with lock:
+                    conn.sendall(json.dumps({"out": json.dumps(self.get_stats(), indent=2) + "\n"}).encode("utf-8") + b"\n")
+                return
+            path, code = self._get_code(request["script"])
+
+            # stdin is given as pipe since the CLIs select() on it
+            stdin_r, stdin_w = os.pipe()
+            stdin_data = request.get("stdin")
+            stdin_r = os.fdopen(stdin_r, "r", encoding="utf-8")
+
+            def _feed_stdin():
+                with os.fdopen(stdin_w, "w", encoding="utf-8") as f:
+                    if stdin_data:
+                        f.write(stdin_data)
+            threading.Thread(target=_feed_stdin, daemon=True).start()
+
+            env = request.get("env")
+            if self.concurrency and env is not None:
+                env.setdefault("GPT_SCHEDULER_CONCURRENCY", str(self.concurrency))
+            _RequestContext.set((stdin_r, _FrameWriter(conn, lock, "out"), _FrameWriter(conn, lock, "err"), [path] + request.get("argv", []), env, request.get("cwd"), None))
+            Tracer.mark_start()
+            try:
+                exec(code, {"__name__": "__main__", "__file__": path})
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+                if e.code and not isinstance(e.code, int):
+                    sys.stderr.write(str(e.code) + "\n")
+            finally:
+                Tracer.finish_current()
+        except Exception:
+            import traceback
+            exit_code = 1
+            sys.stderr.write(traceback.format_exc())
+        finally:
+            _RequestContext.set(None)
+            if stdin_r:
+                stdin_r.close()
+            try:
+                with lock:
+                    conn.sendall(json.dumps({"exit": exit_code}).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+            conn.close()
+
+    def get_stats(self):
+        # queue depth and wait time of each end point's scheduler
+        if "GptScheduler" not in sys.modules:
+            return {}
+        from GptScheduler import GptScheduler
+        with GptScheduler._schedulers_lock:
+            schedulers = dict(GptScheduler._schedulers)
+        return {key: scheduler.get_stats() for key, scheduler in schedulers.items()}
+
+    def serve_forever(self):
+        # the CLIs executed in the daemon must not forward to the daemon again
+        os.environ.pop(SOCKET_ENV, None)
+        self._warm_up()
+        self._install_argparse_hook()
+        sys.stdin = _ThreadLocalStream(sys.stdin)
+        sys.stdout = _ThreadLocalStream(sys.stdout)
+        sys.stderr = _ThreadLocalStream(sys.stderr)
+        sys.argv = _ThreadLocalArgv(sys.argv)
+        os.environ = _ThreadLocalEnviron(os.environ)
+        Tracer.is_per_thread = True
+        _RequestContext.install()
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        server.listen(64)
+        try:
+            while True:
+                conn, _ = server.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+
+def print_stats(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    sock.sendall(json.dumps({"stats": True}).encode("utf-8") + b"\n")
+    with sock.makefile("r", encoding="utf-8") as reader:
+        for line in reader:
+            frame = json.loads(line)
+            if "out" in frame:
+                sys.stdout.write(frame["out"])
+            elif "exit" in frame:
+                break
+    sock.close()
+
+
+def benchmark(socket_path, script_args, count):
+    import subprocess
+    env_cold = dict(os.environ)
+    env_cold.pop(SOCKET_ENV, None)
+    env_daemon = dict(os.environ)
+    env_daemon[SOCKET_ENV] = socket_path
+    command = [sys.executable] + script_args
+
+    for mode, env in [("cold", env_cold), ("daemon", env_daemon)]:
+        elapsed = []
+        for _ in range(count):
+            start_time = time.perf_counter()
+            subprocess.run(command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+            elapsed.append(time.perf_counter() - start_time)
+        elapsed.sort()
+        print(f"{mode}: min {elapsed[0]*1000:.1f}ms median {elapsed[len(elapsed)//2]*1000:.1f}ms max {elapsed[-1]*1000:.1f}ms")
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Warm daemon for gpt-cli.py, gpt_compatible-cli.py and gpt-cli-muliple.py')
+    parser.add_argument('args', nargs='*', help='script and its arguments for --benchmark (e.g. -b 10 -- gpt_compatible-cli.py -u hello)')
+    parser.add_argument('-s', '--socket', action='store', default=os.getenv(SOCKET_ENV, os.path.expanduser("~/.gpt-daemon.sock")), help=f'specify unix socket path or set it in {SOCKET_ENV} env')
+    parser.add_argument('-b', '--benchmark', action='store', type=int, default=0, help='measure end-to-end latency of the given script N times in cold and daemon mode')
+    parser.add_argument('-j', '--concurrency', action='store', type=int, default=0, help='specify max concurrent requests per end point. the requests are scheduled by GPT_PRIORITY=interactive|batch env of the client')
+    parser.add_argument('--stats', action='store_true', default=False, help='print queue depth and wait time of the running daemon')
+    args = parser.parse_args()
+
+    if args.stats:
+        print_stats(args.socket)
+    elif args.benchmark:
+        benchmark(args.socket, args.args, args.benchmark)
+    else:
+        GptDaemonServer(args.socket, concurrency=args.concurrency).serve_forever()
@@ -17,47 +17,200 @@ import os
 import re
 import sys
 import json
+import time
 import requests
 from openai import AzureOpenAI
 import logging
+import numpy as np
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from EndpointPool import EndpointPool, http_health_check
+from StreamDecoder import StreamDecoder
+from GptRecorder import GptRecorder
+from EmbeddingCache import EmbeddingCache
+from Deadline import Deadline
+from Tracer import Tracer
+from CandidateSampler import CandidateSampler
+from GptSession import GptSession
+
+class GptThrottlingError(Exception):
+    pass
+
 
 class IGpt:
-    def query(self, system_prompt, user_prompt):
+    # max number of texts per embedding request of the endpoint
+    EMBEDDING_BATCH_SIZE = 64
+    embedding_cache = None
+
+    # callback(delta) is called with each streamed piece of the content. return False from it to cancel the stream
+    def query(self, system_prompt, user_prompt, callback=None):
         return None, None
 
+    def query_messages(self, messages, callback=None, session_id=None):
+        # TODO: override this to send the conversation as is. session_id pins the server's cache (e.g. llama.cpp's slot)
+        # the default flattens the messages in the order, then the prefix of the prompt is still stable over the turns
+        # note that the wrappers (e.g. GptRouter) should pass the messages and session_id through to the client
+        system_prompt = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        turns = [m for m in messages if m["role"] != "system"]
+        if len(turns) == 1:
+            user_prompt = turns[0]["content"]
+        else:
+            user_prompt = "\n\n".join(f"[{m['role']}]\n{m['content']}" for m in turns)
+        return self.query(system_prompt, user_prompt, callback)
+
+    def query_n(self, system_prompt, user_prompt, n):
+        # TODO: override this to get n candidates by one request (e.g. "n" of the API) as [(content, response)]. [] if not supported
+        return []
+
+    def query_batch(self, queries, max_workers=8):
+        # queries : [(system_prompt, user_prompt), ...]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda q: self.query(q[0], q[1]), queries))
+
+    def embed_batch(self, texts):
+        # TODO: override this to return the embedding vectors of the texts (up to EMBEDDING_BATCH_SIZE) in the same order. None if not supported
+        return None
+
+    def embed(self, texts, max_workers=4, callback=None):
+        # returns float32 array (len(texts) x dim). the texts are split into the batches to request concurrently
+        # the vectors are reused by the content hash if embedding_cache is set. callback(done, total) reports the progress
+        # None if the backend doesn't support the embeddings
+        model = getattr(self, "embedding_model", None) or getattr(self, "model", None)
+        keys = [EmbeddingCache.make_key(model, text) for text in texts]
+        vectors = self.embedding_cache.get_many(keys) if self.embedding_cache is not None else {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing[key] = text
+        missing_keys = list(missing)
+        batches = [missing_keys[i:i+self.EMBEDDING_BATCH_SIZE] for i in range(0, len(missing_keys), self.EMBEDDING_BATCH_SIZE)]
+        total = len(vectors) + len(missing)
+        if callback and vectors:
+            callback(len(vectors), total)
+
+        if batches:
+            with Tracer.span("embed", texts=len(missing), batches=len(batches)), ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(self.embed_batch, [missing[key] for key in batch]): batch for batch in batches}
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    batch_vectors = future.result()
+                    if batch_vectors is None:
+                        for other in futures:
+                            other.cancel()
+                        return None
+                    batch_vectors = np.asarray(batch_vectors, dtype=np.float32)
+                    vectors.update(zip(batch, batch_vectors))
+                    if self.embedding_cache is not None:
+                        self.embedding_cache.put_many(batch, batch_vectors)
+                    if callback:
+                        callback(len(vectors), total)
+
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        results = np.empty((len(keys), len(vectors[keys[0]])), dtype=np.float32)
+        for i, key in enumerate(keys):
+            results[i] = vectors[key]
+        return results
+
+    @staticmethod
+    def get_usage(response):
+        # normalized token counts of the response of the helpers. None if the backend didn't report it
+        # cached_tokens : the prompt tokens served from the server's prompt (KV) cache
+        prompt_tokens = completion_tokens = cached_tokens = None
+        if isinstance(response, list):
+            usages = [IGpt.get_usage(r) for r in response]
+            if usages and all(u["prompt_tokens"] is not None for u in usages):
+                prompt_tokens = sum(u["prompt_tokens"] for u in usages)
+            if usages and all(u["completion_tokens"] is not None for u in usages):
+                completion_tokens = sum(u["completion_tokens"] for u in usages)
+            if usages and all(u["cached_tokens"] is not None for u in usages):
+                cached_tokens = sum(u["cached_tokens"] for u in usages)
+        elif isinstance(response, dict):
+            if response.get("usage"):
+                # OpenAI compatible
+                usage = dict(response["usage"])
+                prompt_tokens = usage.get("prompt_tokens", usage.get("input_tokens"))
+                completion_tokens = usage.get("completion_tokens", usage.get("output_tokens"))
+                cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", usage.get("cache_read_input_tokens"))
+            elif "eval_count" in response or "prompt_eval_count" in response:
+                # ollama. prompt_eval_count is only the evaluated ones, the cached prefix isn't counted
+                prompt_tokens = response.get("prompt_eval_count")
+                completion_tokens = response.get("eval_count")
+            elif "input_tokens" in response or "output_tokens" in response:
+                # bedrock
+                prompt_tokens = response.get("input_tokens")
+                completion_tokens = response.get("output_tokens")
+                cached_tokens = response.get("cache_read_input_tokens")
+            if cached_tokens is None and isinstance(response.get("timings"), dict):
+                # llama.cpp
+                cached_tokens = response["timings"].get("cache_n")
+        elif getattr(response, "usage", None) is not None:
+            # openai's ChatCompletion
+            prompt_tokens = response.usage.prompt_tokens
+            completion_tokens = response.usage.completion_tokens
+            details = getattr(response.usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", None) if details else None
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": cached_tokens}
+
+    @staticmethod
+    def estimate_tokens(text):
+        # rough count without tokenizer: 4 chars per token for ascii, 1 token per char for the others (e.g. CJK)
+        if not text:
+            return 0
+        ascii_chars = len(text.encode("ascii", errors="ignore"))
+        return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
     @staticmethod
     def add_code_section(the_flatten_lines, path=None):
         if path==None or path.endswith(('.cpp', '.c', '.cxx', '.h', 'hpp', '.hxx', '.py', '.asm', '.java', '.rs', '.kt', '.rb')):
             the_flatten_lines = "```\n" + the_flatten_lines + "\n```"
         return the_flatten_lines
 
+    @staticmethod
+    def get_code_sections(content):
+        # same as code-section-extractor.py : the lines quoted by ``` (or the whole lines if no quote)
+        lines = content.splitlines() if isinstance(content, str) else content
+        results = []
+        start_pos = None
+        for i in range(0, len(lines)):
+            line = lines[i].strip()
+            if start_pos==None and (line.startswith("```") or line.startswith("++ b/")):
+                start_pos = i
+            elif start_pos!=None and line.startswith("```"):
+                results.append( lines[start_pos+1:i] )
+                start_pos = None
+        if not results:
+            results = [lines]
+        return results
+
     @staticmethod
     def files_reader(files, margin_lines=10, code_section_if_sourcecode=True):
         result = ""
 
-        for path in files:
-            _path = path.split(":")
-            target_line = None
-            if len(_path)==2:
-                path = _path[0]
-                try:
-                    target_line = int(_path[1])
-                except:
-                    pass
-            if os.path.exists( path ):
-                the_file_content = ""
-                with open(path, 'r', encoding='UTF-8') as f:
-                    the_file_content = f.read()
-                    if target_line:
-                        # in case of target_line with margin_lines
-                        lines = the_file_content.splitlines()
-                        start_pos = max(target_line-margin_lines, 0)
-                        end_pos = min(target_line+margin_lines, len(lines))
-                        the_file_content = "\n".join(lines[start_pos:end_pos])
-                    the_file_content = IGpt.add_code_section(the_file_content, path)
-                    result += the_file_content
+        with Tracer.span("files_reader", files=len(files)):
+            for path in files:
+                _path = path.split(":")
+                target_line = None
+                if len(_path)==2:
+                    path = _path[0]
+                    try:
+                        target_line = int(_path[1])
+                    except:
+                        pass
+                if os.path.exists( path ):
+                    the_file_content = ""
+                    with open(path, 'r', encoding='UTF-8') as f:
+                        the_file_content = f.read()
+                        if target_line:
+                            # in case of target_line with margin_lines
+                            lines = the_file_content.splitlines()
+                            start_pos = max(target_line-margin_lines, 0)
+                            end_pos = min(target_line+margin_lines, len(lines))
+                            the_file_content = "\n".join(lines[start_pos:end_pos])
+                        the_file_content = IGpt.add_code_section(the_file_content, path)
+                        result += the_file_content
 
         return result
 
@@ -82,47 +235,143 @@ class IGpt:
 
 
 class OpenAIGptHelper(IGpt):
-    def __init__(self, api_key, endpoint, api_version = "2024-02-01", model = "gpt-35-turbo-instruct"):
+    EMBEDDING_BATCH_SIZE = 2048
+
+    def __init__(self, api_key, endpoint, api_version = "2024-02-01", model = "gpt-35-turbo-instruct", embedding_model = "text-embedding-ada-002"):
         self.client = AzureOpenAI(
           api_key = api_key,
           api_version = api_version,
-          azure_endpoint = endpoint
+          azure_endpoint = endpoint,
+          timeout = Deadline.READ_TIMEOUT
         )
         self.model = model
+        self.embedding_model = embedding_model
 
-    def query(self, system_prompt, user_prompt):
+    def embed_batch(self, texts):
+        response = self.client.embeddings.create(model=self.embedding_model, input=texts)
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+    def query(self, system_prompt, user_prompt, callback=None):
         _messages = []
         if system_prompt:
             _messages.append( {"role": "system", "content": system_prompt} )
         if user_prompt:
             _messages.append( {"role": "user", "content": user_prompt} )
-
-        response = self.client.chat.completions.create(
-            model= self.model,
-            messages = _messages
-        )
+        return self.query_messages(_messages, callback)
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        # Azure caches the prompt prefix (1024 tokens or more) automatically
+        deadline = Deadline.current()
+        client = self.client
+        if deadline:
+            deadline.check()
+            client = self.client.with_options(timeout=deadline.get_timeout()[1], max_retries=0)
+
+        if callback:
+            return self._query_streaming(client, messages, callback, deadline)
+
+        with Tracer.span("request", model=self.model):
+            response = client.chat.completions.create(
+                model= self.model,
+                messages = messages
+            )
         return response.choices[0].message.content, response
 
+    def query_n(self, system_prompt, user_prompt, n):
+        _messages = []
+        if system_prompt:
+            _messages.append( {"role": "system", "content": system_prompt} )
+        if user_prompt:
+            _messages.append( {"role": "user", "content": user_prompt} )
+
+        deadline = Deadline.current()
+        client = self.client
+        if deadline:
+            deadline.check()
+            client = self.client.with_options(timeout=deadline.get_timeout()[1], max_retries=0)
+
+        # the prompt is prefilled once for the n candidates
+        with Tracer.span("request", model=self.model, n=n):
+            response = client.chat.completions.create(
+                model= self.model,
+                messages = _messages,
+                n = n
+            )
+        return [(choice.message.content, response) for choice in sorted(response.choices, key=lambda c: c.index)]
+
+    def _query_streaming(self, client, messages, callback, deadline=None):
+        with Tracer.span("request", model=self.model):
+            stream = client.chat.completions.create(
+                model= self.model,
+                messages = messages,
+                stream = True,
+                stream_options = {"include_usage": True}
+            )
+        with Tracer.span("stream"):
+            if deadline:
+                # close the stream at the deadline or cancel to free the server's slot
+                with deadline.watch(Deadline.get_closer(stream)):
+                    try:
+                        return self._read_stream(stream, deadline.wrap_callback(callback))
+                    except Exception:
+                        deadline.check()
+                        raise
+            return self._read_stream(stream, callback)
+
+    def _read_stream(self, stream, callback):
+        output = ""
+        response = {}
+        for chunk in stream:
+            response["id"] = chunk.id
+            response["model"] = chunk.model
+            if chunk.usage:
+                response["usage"] = chunk.usage.model_dump()
+            if chunk.choices and chunk.choices[0].delta.content:
+                content = chunk.choices[0].delta.content
+                output += content
+                if callback(content) is False:
+                    response["aborted"] = True
+                    stream.close()
+                    break
+        return output, response
+
 
 class OpenAICompatibleGptHelper(IGpt):
-    def __init__(self, api_key, endpoint, model=None, is_streaming = False, headers={}):
+    def __init__(self, api_key, endpoint, model=None, is_streaming = False, headers={}, policy=EndpointPool.POLICY_LEAST_OUTSTANDING, health_check_interval=0, embedding_endpoint=None, embedding_model=None, keep_alive=None, slots=0):
+        # keep_alive : ollama keeps the model (and its cache) loaded for this duration e.g. "30m"
+        # slots : number of llama.cpp's slots (-np) to pin the session to the slot having its KV cache
         self.api_key = api_key
         self.endpoint = endpoint
         self.model = model
+        self.keep_alive = keep_alive
+        self.slots = slots
+        self.embedding_endpoint = embedding_endpoint
+        self.embedding_model = embedding_model
         self.is_streaming = is_streaming
         self.headers = headers
         self.headers['accept'] = 'application/json'
         self.headers['Content-Type'] = 'application/json'
         if self.api_key:
             self.headers['Authorization'] = f'Bearer {self.api_key}'
+        # endpoint can be "http://host1/v1/chat/completions,http://host2/v1/chat/completions"
+        self.pool = EndpointPool(EndpointPool.parse(endpoint), policy)
+        if health_check_interval and len(self.pool)>1:
+            self.pool.start_health_check(http_health_check, health_check_interval)
+        self.session = EndpointPool.new_session()
 
-    def _create_payload(self, messages):
+    def _create_payload(self, messages, session_id=None):
         # payload
         payload = {
             "messages": messages,
         }
         if self.is_streaming:
             payload["stream"] = True
+        if self.keep_alive and "/api/chat" in self.endpoint:
+            payload["keep_alive"] = self.keep_alive
+        if self.slots:
+            payload["cache_prompt"] = True
+            if session_id:
+                payload["id_slot"] = GptSession.get_slot(session_id, self.slots)
         if self.model:
             models = self.model.split(",")
             if len(models)==1:
@@ -132,132 +381,257 @@ class OpenAICompatibleGptHelper(IGpt):
 
         return payload
 
-    def query(self, system_prompt, user_prompt):
+    def query(self, system_prompt, user_prompt, callback=None):
         _messages = []
         if system_prompt:
             _messages.append( {"role": "system", "content": system_prompt} )
         if user_prompt:
             _messages.append( {"role": "user", "content": user_prompt} )
+        return self.query_messages(_messages, callback)
 
-        payload  = self._create_payload(_messages)
+    def query_messages(self, messages, callback=None, session_id=None):
+        payload  = self._create_payload(messages, session_id)
         #print(payload)
+        with Tracer.span("serialize"):
+            # once for all of the failover attempts
+            data = json.dumps(payload).encode("utf-8")
+
+        state = {"is_emitted": False}
+
+        def _callback(delta):
+            state["is_emitted"] = True
+            return callback(delta)
+
+        return self.pool.run(lambda endpoint: self._post(endpoint, data, _callback if callback else None), is_emitted=lambda: state["is_emitted"])
 
+    def query_n(self, system_prompt, user_prompt, n):
+        # only /v1/chat/completions of the single model returns the choices (vLLM, llama.cpp). ollama's /api/chat doesn't
+        if self.is_streaming or (self.model and "," in self.model):
+            return []
+        _messages = []
+        if system_prompt:
+            _messages.append( {"role": "system", "content": system_prompt} )
+        if user_prompt:
+            _messages.append( {"role": "user", "content": user_prompt} )
+
+        payload = self._create_payload(_messages)
+        payload["n"] = n
+        with Tracer.span("serialize"):
+            data = json.dumps(payload).encode("utf-8")
+
+        return self.pool.run(lambda endpoint: self._post_n(endpoint, data))
+
+    def _post_n(self, endpoint, data):
+        deadline = Deadline.current()
+        timeout = deadline.get_timeout() if deadline else (Deadline.CONNECT_TIMEOUT, Deadline.READ_TIMEOUT)
+        with Tracer.span("request", endpoint=endpoint):
+            response = self.session.post(endpoint, headers=self.headers, data=data, timeout=timeout)
+        response.raise_for_status()
+        with Tracer.span("decode"):
+            response_json = response.json()
+        # the server ignoring "n" returns one choice, then the rest are requested by the caller
+        choices = sorted(response_json.get("choices", []), key=lambda c: c.get("index", 0))
+        return [(choice["message"]["content"], response_json) for choice in choices]
+
+    def _post(self, endpoint, data, callback=None):
+        deadline = Deadline.current()
+        timeout = deadline.get_timeout() if deadline else (Deadline.CONNECT_TIMEOUT, Deadline.READ_TIMEOUT)
         if self.is_streaming:
             # streaming mode (ollama mode)
-            r = requests.post(self.endpoint, headers=self.headers, json=payload, stream=True)
-            r.raise_for_status()
-            output = ""
-            for line in r.iter_lines():
-                body = json.loads(line)
-                if "error" in body:
-                    raise Exception(body["error"])
-                if body.get("done") is False:
-                    message = body.get("message", "")
-                    content = message.get("content", "")
-                    output += content
-
-                if body.get("done", False):
-                    message = body
-                    message["content"] = output
-                    return output, message
+            with Tracer.span("request", endpoint=endpoint):
+                r = self.session.post(endpoint, headers=self.headers, data=data, stream=True, timeout=timeout)
+            with r, Tracer.span("stream"):
+                r.raise_for_status()
+                if deadline:
+                    # close the socket at the deadline or cancel to free the server's slot
+                    with deadline.watch(Deadline.get_closer(r)):
+                        return StreamDecoder.decode_chat_stream(r, deadline.wrap_callback(callback))
+                return StreamDecoder.decode_chat_stream(r, callback)
 
         else:
             # non-streaming mode
-            response = requests.post(self.endpoint, headers=self.headers, json=payload)
+            with Tracer.span("request", endpoint=endpoint):
+                response = self.session.post(endpoint, headers=self.headers, data=data, timeout=timeout)
             if response.status_code == 200:
-                responses = response_json = response.json()
+                with Tracer.span("decode"):
+                    responses = response_json = response.json()
                 if isinstance(responses, dict):
                     responses = [responses]
                 main_messages = []
                 for a_response in responses:
                     main_messages.append( a_response['choices'][0]['message']['content'] )
+                if callback:
+                    for a_message in main_messages:
+                        callback(a_message)
                 if len(main_messages)==1:
                     main_messages = main_messages[0]
                 return main_messages, response_json
             else:
+                response.raise_for_status()
                 raise Exception(f"Error: {response.status_code} - {response.text}")
 
         return None, None
 
+    @staticmethod
+    def get_embedding_endpoint(endpoint):
+        # the same server serves the embeddings e.g. /v1/chat/completions -> /v1/embeddings, ollama's /api/chat -> /api/embed
+        if "/api/chat" in endpoint:
+            return endpoint.replace("/api/chat", "/api/embed")
+        return re.sub(r"/chat/completions$|/completions$", "/embeddings", endpoint)
+
+    def embed_batch(self, texts):
+        payload = {
+            "input": texts,
+        }
+        model = self.embedding_model if self.embedding_model else self.model
+        if model:
+            payload["model"] = model
+        if self.embedding_endpoint:
+            return self._post_embed(self.embedding_endpoint, payload)
+        return self.pool.run(lambda endpoint: self._post_embed(self.get_embedding_endpoint(endpoint), payload))
+
+    def _post_embed(self, endpoint, payload):
+        deadline = Deadline.current()
+        timeout = deadline.get_timeout() if deadline else (Deadline.CONNECT_TIMEOUT, Deadline.READ_TIMEOUT)
+        response = self.session.post(endpoint, headers=self.headers, json=payload, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+        if "embeddings" in result:
+            # ollama
+            return result["embeddings"]
+        return [d["embedding"] for d in sorted(result["data"], key=lambda d: d.get("index", 0))]
+
 
 
 class ClaudeGptHelper(IGpt):
-    def __init__(self, api_key, secret_key, region="us-west-2", model="anthropic.claude-3-sonnet-20240229-v1:0"):
+    THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException", "throttlingException", "serviceUnavailableException", "ServiceUnavailableException")
+
+    # titan embeddings take one text per request
+    EMBEDDING_BATCH_SIZE = 1
+
+    def __init__(self, api_key, secret_key, region="us-west-2", model="anthropic.claude-3-sonnet-20240229-v1:0", max_tokens=4096, pool_size=50, max_attempts=10, endpoint_url=None, embedding_model="amazon.titan-embed-text-v2:0"):
+        # own session since boto3's default session isn't thread safe. the client is shared among the threads
+        session = boto3.session.Session()
+        config = Config(
+            max_pool_connections=pool_size,
+            retries={"mode": "adaptive", "max_attempts": max_attempts},
+            connect_timeout=Deadline.CONNECT_TIMEOUT,
+            read_timeout=Deadline.READ_TIMEOUT
+        )
         if api_key and secret_key and region:
-            self.client = boto3.client(
+            self.client = session.client(
                 service_name='bedrock-runtime',
                 aws_access_key_id=api_key,
                 aws_secret_access_key=secret_key,
-                region_name=region
+                region_name=region,
+                endpoint_url=endpoint_url,
+                config=config
             )
         else:
-            self.client = boto3.client(service_name='bedrock-runtime')
+            self.client = session.client(service_name='bedrock-runtime', region_name=region, endpoint_url=endpoint_url, config=config)
 
         self.model = model
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self.embedding_model = embedding_model
+
+    def query_batch(self, queries, max_workers=None):
+        return super().query_batch(queries, max_workers if max_workers else self.pool_size)
+
+    def embed(self, texts, max_workers=None, callback=None):
+        return super().embed(texts, max_workers if max_workers else self.pool_size, callback)
+
+    def embed_batch(self, texts):
+        results = []
+        for text in texts:
+            response = self.client.invoke_model(body=json.dumps({"inputText": text}), modelId=self.embedding_model)
+            results.append(json.loads(response["body"].read())["embedding"])
+        return results
+
+    def query(self, system_prompt, user_prompt, callback=None, max_tokens=None):
+        _messages = []
+        if system_prompt:
+            _messages.append( {"role": "system", "content": system_prompt} )
+        _messages.append( {"role": "user", "content": user_prompt} )
+        return self.query_messages(_messages, callback, max_tokens=max_tokens)
 
-    def query(self, system_prompt, user_prompt, max_tokens=200000):
+    def query_messages(self, messages, callback=None, session_id=None, max_tokens=None):
         if self.client:
+            system_prompt = "\n".join(m["content"] for m in messages if m["role"] == "system")
             _message = [{
-                "role": "user",
+                "role": m["role"],
                 "content": [
                     {
                         "type": "text",
-                        "text": user_prompt
+                        "text": m["content"]
                     }
                 ]
-            }]
+            } for m in messages if m["role"] != "system"]
 
             _body = {
                 "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": max_tokens,
+                "max_tokens": max_tokens if max_tokens else self.max_tokens,
                 "temperature": 1,
                 "top_p": 0.999,
                 "messages": _message
             }
             if system_prompt:
                 _body["system"] = system_prompt
-            body = json.dumps(_body)
+            with Tracer.span("serialize"):
+                body = json.dumps(_body)
 
+            deadline = Deadline.current()
             try:
-                response = self.client.invoke_model_with_response_stream(
-                    body=body,
-                    modelId=self.model
-                )
-
-                result = ""
-                status = {}
-
-                for event in response.get("body"):
-                    chunk = json.loads(event["chunk"]["bytes"])
-
-                    if chunk['type'] == 'message_delta':
-                        status = {
-                            "stop_reason": chunk['delta']['stop_reason'],
-                            "stop_sequence": chunk['delta']['stop_sequence'],
-                            "output_tokens": chunk['usage']['output_tokens'],
-                        }
-                    if chunk['type'] == 'content_block_delta':
-                        if chunk['delta']['type'] == 'text_delta':
-                            result += chunk['delta']['text']
-
-                return result, status
+                if deadline:
+                    deadline.check()
+                with Tracer.span("request", model=self.model):
+                    response = self.client.invoke_model_with_response_stream(
+                        body=body,
+                        modelId=self.model
+                    )
+
+                event_stream = response.get("body")
+                with Tracer.span("stream"):
+                    if deadline and hasattr(event_stream, "close"):
+                        with deadline.watch(Deadline.get_closer(event_stream)):
+                            try:
+                                return StreamDecoder.decode_bedrock_stream(event_stream, deadline.wrap_callback(callback))
+                            except Exception:
+                                deadline.check()
+                                raise
+                    return StreamDecoder.decode_bedrock_stream(event_stream, callback)
 
             except ClientError as err:
-                message = err.response["Error"]["Message"]
+                # EventStreamError in the stream is also ClientError
+                code = err.response["Error"].get("Code", "")
+                message = err.response["Error"].get("Message", "")
+                if code in self.THROTTLING_ERRORS:
+                    raise GptThrottlingError(f"{code}: {message}") from err
                 print(f"A client error occurred: {message}")
         return None, None
 
 class GptClientFactory:
     @staticmethod
-    def new_client(args):
+    def new_client(args, is_budgeted=True):
         gpt_client = None
 
+        if args.gpt=="router":
+            # LLM_ROUTER=path of the backends. each backend is built by this factory with its own scheduler and budget
+            from GptRouter import GptRouter
+            return GptRouter.new_from_env(args)
+
         if args.useclaude or args.gpt=="calude3":
             apikey = os.getenv('AWS_ACCESS_KEY_ID') if not args.apikey else args.apikey
             endpoint = "us-west-2" if not args.endpoint else args.endpoint
             deployment = "anthropic.claude-3-sonnet-20240229-v1:0" if not args.deployment else args.deployment
             secretkey = os.getenv("AWS_SECRET_ACCESS_KEY") if not args.secretkey else args.secretkey
-            gpt_client = ClaudeGptHelper(apikey, secretkey, endpoint, deployment)
+            max_tokens = int(os.getenv("AWS_BEDROCK_MAX_TOKENS", "4096"))
+            pool_size = int(os.getenv("AWS_BEDROCK_POOL_SIZE", "50"))
+            endpoint_url = os.getenv("AWS_BEDROCK_ENDPOINT_URL")
+            embedding_model = os.getenv("AWS_BEDROCK_EMBEDDING_MODEL", "amazon.titan-embed-text-v2:0")
+            if "maxtokens" in args and args.maxtokens:
+                max_tokens = args.maxtokens
+            gpt_client = ClaudeGptHelper(apikey, secretkey, endpoint, deployment, max_tokens, pool_size, endpoint_url=endpoint_url, embedding_model=embedding_model)
         elif args.gpt=="openaicompatible" or args.gpt=="local" or args.gpt=="others":
             apikey = os.getenv("LLM_API_KEY") if not args.apikey else args.apikey
             endpoint = os.getenv("LLM_ENDPOINT") if not args.endpoint else args.endpoint
@@ -270,25 +644,83 @@ class GptClientFactory:
                     if pos!=None:
                         headers[header[0:pos]] = header[pos+1:].strip()
 
-            gpt_client = OpenAICompatibleGptHelper(apikey, endpoint, deployment, is_streaming, headers)
+            policy = os.getenv("LLM_ENDPOINT_POLICY", EndpointPool.POLICY_LEAST_OUTSTANDING)
+            health_check_interval = float(os.getenv("LLM_HEALTH_CHECK_INTERVAL", "0"))
+            if "policy" in args and args.policy:
+                policy = args.policy
+
+            embedding_endpoint = os.getenv("LLM_EMBEDDING_ENDPOINT")
+            embedding_model = os.getenv("LLM_EMBEDDING_MODEL")
+            # LLM_KEEP_ALIVE=30m for ollama, LLM_SLOTS=number of llama.cpp's slots to reuse the session's KV cache
+            keep_alive = os.getenv("LLM_KEEP_ALIVE")
+            slots = int(os.getenv("LLM_SLOTS", "0"))
+            gpt_client = OpenAICompatibleGptHelper(apikey, endpoint, deployment, is_streaming, headers, policy, health_check_interval, embedding_endpoint, embedding_model, keep_alive, slots)
         else:
             apikey = os.getenv("AZURE_OPENAI_API_KEY") if not args.apikey else args.apikey
             endpoint = os.getenv("AZURE_OPENAI_ENDPOINT") if not args.endpoint else args.endpoint
             deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME") if not args.deployment else args.deployment
-            gpt_client = OpenAIGptHelper(apikey, endpoint, "2024-02-01", deployment)
+            embedding_model = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME", "text-embedding-ada-002")
+            gpt_client = OpenAIGptHelper(apikey, endpoint, "2024-02-01", deployment, embedding_model)
+
+        # LLM_EMBEDDING_CACHE=path to reuse the embedding vectors by the content hash
+        embedding_cache = os.getenv("LLM_EMBEDDING_CACHE")
+        if embedding_cache:
+            gpt_client.embedding_cache = EmbeddingCache(embedding_cache)
+
+        # record/replay the transport for offline performance tests
+        cassette = GptRecorder.new_cassette_from_env()
+        if cassette:
+            GptRecorder.install(gpt_client, cassette)
+
+        # share the end point among the interactive and batch requests (GPT_SCHEDULER_CONCURRENCY, GPT_PRIORITY env)
+        if os.getenv("GPT_SCHEDULER_CONCURRENCY"):
+            from GptScheduler import GptScheduler, ScheduledGpt
+            key = str(getattr(gpt_client, "endpoint", None) or getattr(gpt_client, "model", None))
+            gpt_client = ScheduledGpt(gpt_client, GptScheduler.get_for(key))
+
+        # token and cost ceilings of the run (LLM_BUDGET_* env or --budgettokens/--budgetcost)
+        if is_budgeted:
+            from GptBudget import BudgetedGpt, GptBudget
+            budget = GptBudget.get_default(args)
+            if budget:
+                fallback_client = None
+                fallback_model = os.getenv("LLM_BUDGET_FALLBACK_MODEL")
+                if fallback_model:
+                    fallback_args = argparse.Namespace(**vars(args))
+                    fallback_args.deployment = fallback_model
+                    fallback_client = GptClientFactory.new_client(fallback_args, False)
+                gpt_client = BudgetedGpt(gpt_client, budget, fallback_client)
 
         return gpt_client
 
 
 
 class GptQueryWithCheck:
-    def __init__(self, client=None, promptfile=None):
+    # seconds to wait before the retry of the throttled request, doubled on each throttling
+    THROTTLING_BACKOFF = float(os.getenv("LLM_THROTTLING_BACKOFF", "2"))
+
+    def __init__(self, client=None, promptfile=None, timeout=None, candidates=1):
+        # candidates : n>1 requests n answers at once in each try and the first valid one is used
         self.client = client
         self.system_prompt = None
         self.user_prompt = None
+        self.timeout = timeout
+        self.candidates = candidates
+        self.deadline = None
+        self.throttled = 0
         if promptfile:
             self.system_prompt, self.user_prompt = IGpt.read_prompt_json(promptfile)
 
+    def _back_off(self, err):
+        # the immediate retry of the throttled request makes it worse
+        wait = self.THROTTLING_BACKOFF * (2 ** self.throttled)
+        remaining = self.deadline.remaining() if self.deadline else None
+        if remaining is not None:
+            wait = min(wait, remaining)
+        self.throttled += 1
+        print(f"ERROR!!!: LLM is throttled, retry after {wait:.1f}s: {err}")
+        time.sleep(wait)
+
     def _generate_prompt(self, replace_keydata={}):
         system_prompt = self.system_prompt
         user_prompt = self.user_prompt
@@ -298,26 +730,72 @@ class GptQueryWithCheck:
 
         return system_prompt, user_prompt
 
+    def _is_stream_check_enabled(self):
+        return type(self).is_ok_stream_result is not GptQueryWithCheck.is_ok_stream_result
+
     def _query(self, system_prompt, user_prompt):
         content = None
         response = None
 
         if self.client and user_prompt:
+            callback = None
+            verdict = {}
+            if self._is_stream_check_enabled():
+                partial = {"content": ""}
+                def callback(delta):
+                    partial["content"] += delta
+                    result = self.is_ok_stream_result(partial["content"])
+                    if result is not None:
+                        verdict["result"] = result
+                        return False
             try:
-                content, response = self.client.query(system_prompt, user_prompt)
-            except:
-                pass
+                content, response = self.client.query(system_prompt, user_prompt, callback)
+            except GptThrottlingError as err:
+                self._back_off(err)
+            except Exception as err:
+                print(f"ERROR!!!: LLM query failed: {err}")
+            if verdict.get("result") is False:
+                # aborted as invalid output, then retry without waiting the rest of the generation
+                print("ERROR!!!: LLM's streaming output is aborted as unexpected answer")
+                content = None
             return content, response
 
         return None, None
 
+    def _query_candidates(self, system_prompt, user_prompt, is_ranked=False):
+        if not self.client or not user_prompt:
+            return [] if is_ranked else (None, None)
+        sampler = CandidateSampler(self.client, self.candidates)
+        is_ok_stream = self.is_ok_stream_result if self._is_stream_check_enabled() else None
+        try:
+            return sampler.sample(system_prompt, user_prompt, self.is_ok_query_result, is_ok_stream, self.score_query_result, is_ranked)
+        except GptThrottlingError as err:
+            self._back_off(err)
+        except Exception as err:
+            print(f"ERROR!!!: LLM query failed: {err}")
+        return [] if is_ranked else (None, None)
+
+    def is_ok_stream_result(self, partial_result):
+        # TODO: override this to check the partial result while streaming
+        # return False to abort as invalid, True to stop as the expected structure is completed, None to continue
+        return None
+
     def is_ok_query_result(self, query_result):
         if not query_result:
             # TODO: override this to check the query_result
             return False
         return True
 
-    def query(self, replace_keydata={}):
+    def score_query_result(self, query_result):
+        # TODO: override this to rank the valid candidates of query_ranked(). higher is better
+        return 0
+
+    def cancel(self):
+        # can be called from the other thread. the in-flight stream is closed and no more retry
+        if self.deadline:
+            self.deadline.cancel()
+
+    def query(self, replace_keydata={}, timeout=None):
         content = None
         response = None
 
@@ -325,15 +803,33 @@ class GptQueryWithCheck:
         #print(system_prompt)
         #print(user_prompt)
 
-        retry_count = 0
-        while retry_count<3:
-            # 1st level
-            content, response = self._query(system_prompt, user_prompt)
-            retry_count += 1
-            if self.is_ok_query_result(content):
-                break
-            else:
-                print(f"ERROR!!!: LLM didn't expected anser. Retry:{retry_count}")
-                print(content)
+        # the deadline covers all of the retries
+        self.deadline = Deadline(timeout if timeout else self.timeout, Deadline.current())
+        self.throttled = 0
+        with self.deadline.activate(), Tracer.span("query"):
+            retry_count = 0
+            while retry_count<3:
+                if self.deadline.is_done():
+                    print(f"ERROR!!!: LLM query is {'cancelled' if self.deadline.is_cancelled() else 'timed out'}")
+                    break
+                # 1st level
+                if self.candidates > 1:
+                    content, response = self._query_candidates(system_prompt, user_prompt)
+                else:
+                    content, response = self._query(system_prompt, user_prompt)
+                retry_count += 1
+                if self.is_ok_query_result(content):
+                    break
+                else:
+                    print(f"ERROR!!!: LLM didn't expected anser. Retry:{retry_count}")
+                    print(content)
 
         return content, response
+
+    def query_ranked(self, replace_keydata={}, timeout=None):
+        # [(content, response)] of the valid candidates in score_query_result() order. waits all of the candidates
+        system_prompt, user_prompt = self._generate_prompt(replace_keydata)
+        self.deadline = Deadline(timeout if timeout else self.timeout, Deadline.current())
+        self.throttled = 0
+        with self.deadline.activate(), Tracer.span("query"):
+            return self._query_candidates(system_prompt, user_prompt, True)
@@ -0,0 +1,63 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import os
+
+
+class GptPricing:
+    # USD per 1M tokens (input, output). the first entry included in the model name is used
+    DEFAULT_PRICES = [
+        ("gpt-4o-mini", 0.15, 0.6),
+        ("gpt-4o", 5.0, 15.0),
+        ("gpt-4-turbo", 10.0, 30.0),
+        ("gpt-4-32k", 60.0, 120.0),
+        ("gpt-4", 30.0, 60.0),
+        ("gpt-35-turbo-instruct", 1.5, 2.0),
+        ("gpt-35-turbo", 0.5, 1.5),
+        ("gpt-3.5-turbo", 0.5, 1.5),
+        ("claude-3-5-sonnet", 3.0, 15.0),
+        ("claude-3-opus", 15.0, 75.0),
+        ("claude-3-sonnet", 3.0, 15.0),
+        ("claude-3-haiku", 0.25, 1.25),
+        ("text-embedding-ada-002", 0.1, 0.0),
+        ("titan-embed-text-v2", 0.02, 0.0),
+    ]
+
+    def __init__(self, prices=None):
+        self.prices = list(prices) if prices else list(self.DEFAULT_PRICES)
+
+    @staticmethod
+    def new_from_env():
+        # LLM_PRICING=path of {"model name": [input, output], ...} which precedes the defaults (e.g. local model as [0, 0])
+        prices = []
+        path = os.getenv("LLM_PRICING")
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='UTF-8') as f:
+                for model, (input_price, output_price) in json.load(f).items():
+                    prices.append((model, float(input_price), float(output_price)))
+        return GptPricing(prices + GptPricing.DEFAULT_PRICES)
+
+    def get_price(self, model):
+        model = str(model).lower()
+        for name, input_price, output_price in self.prices:
+            if name.lower() in model:
+                return input_price, output_price
+        return None
+
+    def estimate_cost(self, model, prompt_tokens, completion_tokens):
+        price = self.get_price(model)
+        if price is None:
+            return None
+        return ((prompt_tokens or 0) * price[0] + (completion_tokens or 0) * price[1]) / 1000000
@@ -0,0 +1,343 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class Cassette:
+    MODE_RECORD = "record"
+    MODE_REPLAY = "replay"
+
+    def __init__(self, path, mode=MODE_REPLAY, timing_scale=1.0):
+        # timing_scale: 1.0 is the original timing, 0 is no wait, 0.5 is 2x faster
+        self.path = path
+        self.mode = mode
+        self.timing_scale = timing_scale
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._positions = {}
+        if mode == self.MODE_REPLAY:
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'r', encoding='UTF-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+
+    @staticmethod
+    def make_key(url, body):
+        # host isn't included since the replicas should be replayed with the same entry
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body, sort_keys=True)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        path = urlparse(url).path if "://" in url else url
+        return hashlib.sha256(path.encode("utf-8") + b"\n" + (body or b"")).hexdigest()
+
+    def record(self, key, status, headers, chunks):
+        # chunks : [(seconds since the request, bytes), ...]
+        entry = {
+            "key": key,
+            "status": status,
+            "headers": headers,
+            "chunks": [[round(t, 4), base64.b64encode(data).decode("ascii")] for t, data in chunks],
+        }
+        with self._lock:
+            with open(self.path, 'a', encoding='UTF-8') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def next(self, key):
+        # the same request is replayed in the recorded order, then the last one is repeated
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise KeyError(f"No recorded response in {self.path} for the request {key[:12]}")
+            pos = self._positions.get(key, 0)
+            self._positions[key] = pos + 1
+            return entries[min(pos, len(entries) - 1)]
+
+    def iter_chunks(self, entry):
+        start_time = time.time()
+        for t, data in entry["chunks"]:
+            if self.timing_scale:
+                wait = start_time + t * self.timing_scale - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            yield base64.b64decode(data)
+
+
+class _RecordingRaw:
+    # wraps urllib3's response to record the chunk boundaries and the timing StreamDecoder reads
+    def __init__(self, raw, on_done, start_time):
+        self._raw = raw
+        self._on_done = on_done
+        self._start_time = start_time
+        self._chunks = []
+        self._is_done = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def _done(self):
+        if not self._is_done:
+            self._is_done = True
+            self._on_done(self._chunks)
+
+    def read1(self, amt=None, **kwargs):
+        data = self._raw.read1(amt, **kwargs)
+        if data:
+            self._chunks.append((time.time() - self._start_time, data))
+        else:
+            self._done()
+        return data
+
+    def close(self):
+        self._done()
+        return self._raw.close()
+
+
+class _ReplayRaw:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b""
+
+    def read1(self, amt=None, **kwargs):
+        if not self._buf:
+            self._buf = next(self._chunks, b"")
+        if amt and amt > 0:
+            data, self._buf = self._buf[:amt], self._buf[amt:]
+        else:
+            data, self._buf = self._buf, b""
+        return data
+
+    def read(self, amt=None, **kwargs):
+        return self.read1(amt)
+
+    def close(self):
+        pass
+
+
+class CassetteResponse:
+    # subset of requests.Response used by the helpers
+    def __init__(self, url, status, headers, chunks, is_streaming):
+        self.url = url
+        self.status_code = status
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.raw = _ReplayRaw(chunks)
+        self._content = None if is_streaming else b"".join(chunks)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(iter(lambda: self.raw.read1(), b""))
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=None):
+        return iter(lambda: self.raw.read1(chunk_size), b"")
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            response = requests.Response()
+            response.status_code = self.status_code
+            response._content = self.content
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=response)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CassetteSession:
+    # drop-in for requests.Session of OpenAICompatibleGptHelper
+    def __init__(self, session, cassette):
+        self.session = session
+        self.cassette = cassette
+
+    @staticmethod
+    def get_body(json_body, data):
+        # the helpers post the pre-serialized bytes (data=). decode them to get the same key as json= of the old cassettes
+        if json_body is not None or data is None:
+            return json_body
+        try:
+            return json.loads(data)
+        except ValueError:
+            return data
+
+    def post(self, url, headers=None, json=None, stream=False, **kwargs):
+        key = Cassette.make_key(url, self.get_body(json, kwargs.get("data")))
+        if self.cassette.mode == Cassette.MODE_REPLAY:
+            entry = self.cassette.next(key)
+            return CassetteResponse(url, entry["status"], entry["headers"], self.cassette.iter_chunks(entry), stream)
+
+        start_time = time.time()
+        response = self.session.post(url, headers=headers, json=json, stream=stream, **kwargs)
+        response_headers = dict(response.headers)
+        response_headers.pop("Content-Encoding", None)
+        response_headers.pop("Transfer-Encoding", None)
+        if stream:
+            response.raw = _RecordingRaw(response.raw, lambda chunks: self.cassette.record(key, response.status_code, response_headers, chunks), start_time)
+        else:
+            self.cassette.record(key, response.status_code, response_headers, [(time.time() - start_time, response.content)])
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+if httpx:
+    class _RecordingByteStream(httpx.SyncByteStream):
+        def __init__(self, stream, on_done, start_time):
+            self._stream = stream
+            self._on_done = on_done
+            self._start_time = start_time
+
+        def __iter__(self):
+            chunks = []
+            try:
+                for chunk in self._stream:
+                    chunks.append((time.time() - self._start_time, chunk))
+                    yield chunk
+            finally:
+                self._on_done(chunks)
+
+        def close(self):
+            self._stream.close()
+
+
+    class _ReplayByteStream(httpx.SyncByteStream):
+        def __init__(self, chunks):
+            self._chunks = chunks
+
+        def __iter__(self):
+            for chunk in self._chunks:
+                yield chunk
+
+
+    class CassetteTransport(httpx.BaseTransport):
+        # httpx transport for the AzureOpenAI client of OpenAIGptHelper
+        def __init__(self, cassette, transport=None):
+            self.cassette = cassette
+            self.transport = transport if transport else httpx.HTTPTransport()
+
+        def handle_request(self, request):
+            key = Cassette.make_key(request.url.path, request.read())
+            if self.cassette.mode == Cassette.MODE_REPLAY:
+                entry = self.cassette.next(key)
+                return httpx.Response(entry["status"], headers=entry["headers"], stream=_ReplayByteStream(self.cassette.iter_chunks(entry)), request=request)
+
+            start_time = time.time()
+            response = self.transport.handle_request(request)
+            headers = dict(response.headers)
+            response.stream = _RecordingByteStream(response.stream, lambda chunks: self.cassette.record(key, response.status_code, headers, chunks), start_time)
+            return response
+
+        def close(self):
+            self.transport.close()
+
+
+class _CassetteEventStream:
+    def __init__(self, events):
+        self._events = events
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        pass
+
+
+class CassetteBedrockClient:
+    # wraps bedrock-runtime client of ClaudeGptHelper. the events are recorded as the chunk bytes
+    def __init__(self, client, cassette):
+        self.client = client
+        self.cassette = cassette
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        key = Cassette.make_key(modelId, body)
+        if self.cassette.mode == Cassette.MODE_REPLAY:
+            entry = self.cassette.next(key)
+            events = ({"chunk": {"bytes": data}} for data in self.cassette.iter_chunks(entry))
+            return {"body": _CassetteEventStream(events)}
+
+        start_time = time.time()
+        response = self.client.invoke_model_with_response_stream(body=body, modelId=modelId, **kwargs)
+        event_stream = response.get("body")
+
+        def _events():
+            chunks = []
+            try:
+                for event in event_stream:
+                    if "chunk" in event:
+                        chunks.append((time.time() - start_time, event["chunk"]["bytes"]))
+                    yield event
+            finally:
+                self.cassette.record(key, 200, {}, chunks)
+        response["body"] = _CassetteEventStream(_events())
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class GptRecorder:
+    @staticmethod
+    def install(gpt_client, cassette):
+        # replace the transport of the helper with the cassette's one
+        if hasattr(gpt_client, "session"):
+            gpt_client.session = CassetteSession(gpt_client.session, cassette)
+        elif hasattr(gpt_client, "client") and hasattr(gpt_client.client, "invoke_model_with_response_stream"):
+            gpt_client.client = CassetteBedrockClient(gpt_client.client, cassette)
+        elif hasattr(gpt_client, "client") and hasattr(gpt_client.client, "copy"):
+            if not httpx:
+                raise Exception("httpx is required to record/replay OpenAIGptHelper")
+            gpt_client.client = gpt_client.client.copy(http_client=httpx.Client(transport=CassetteTransport(cassette)))
+        else:
+            raise Exception(f"Unsupported client to record/replay: {type(gpt_client).__name__}")
+        return gpt_client
+
+    @staticmethod
+    def new_cassette_from_env():
+        # GPT_CASSETTE=path GPT_CASSETTE_MODE=record|replay GPT_CASSETTE_TIMING=1.0
+        path = os.getenv("GPT_CASSETTE")
+        if path:
+            mode = os.getenv("GPT_CASSETTE_MODE", Cassette.MODE_REPLAY)
+            timing_scale = float(os.getenv("GPT_CASSETTE_TIMING", "1.0"))
+            return Cassette(path, mode, timing_scale)
+        return None
@@ -0,0 +1,308 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+import numpy as np
+from GptHelper import IGpt
+from GptPricing import GptPricing
+from Deadline import Deadline
+from Tracer import Tracer
+
+
+class _LatencyModel:
+    # latency = base + a * prompt_tokens/1000 + b * output_tokens/100
+    # ridge regression to the prior with the decayed samples, then the recent behavior of the backend wins
+    def __init__(self, base=0.5, prefill_tps=1000.0, decode_tps=40.0, decay=0.98, prior_weight=1.0):
+        self.prior = np.array([base, 1000.0 / prefill_tps, 100.0 / decode_tps])
+        self.decay = decay
+        self.prior_weight = prior_weight
+        self.a = np.zeros((3, 3))
+        self.b = np.zeros(3)
+        self.theta = self.prior.copy()
+        self.samples = 0
+
+    @staticmethod
+    def _features(prompt_tokens, output_tokens):
+        return np.array([1.0, prompt_tokens / 1000.0, output_tokens / 100.0])
+
+    def predict(self, prompt_tokens, output_tokens):
+        return float(self._features(prompt_tokens, output_tokens) @ self.theta)
+
+    def update(self, prompt_tokens, output_tokens, latency):
+        x = self._features(prompt_tokens, output_tokens)
+        self.a = self.a * self.decay + np.outer(x, x)
+        self.b = self.b * self.decay + x * latency
+        regularization = self.prior_weight * np.eye(3)
+        theta = np.linalg.solve(self.a + regularization, self.b + regularization @ self.prior)
+        self.theta = np.maximum(theta, 0.0)
+        self.samples += 1
+
+    def get_stats(self):
+        base, prefill, decode = self.theta
+        return {"base": base, "prefill_tps": 1000.0 / prefill if prefill else None, "decode_tps": 100.0 / decode if decode else None, "samples": self.samples}
+
+
+class _Backend:
+    def __init__(self, name, client, config):
+        self.name = name
+        self.client = client
+        self.model = config.get("deployment") or getattr(client, "model", None)
+        self.max_context = config.get("max_context")
+        self.concurrency = max(int(config.get("concurrency", 8)), 1)
+        self.tasks = set(config["tasks"]) if config.get("tasks") else None
+        self.price = config.get("price")
+        self.latency = _LatencyModel(config.get("latency", 0.5), config.get("prefill_tps", 1000.0), config.get("decode_tps", 40.0))
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+        self.last_used = 0
+
+
+class GptRouter(IGpt):
+    # the output tokens are unknown before the request, then expected by the task class
+    DEFAULT_OUTPUT_TOKENS = {"code": 600, "chat": 250}
+    RE_CODE = re.compile(r"```|^[+-]{3} |^@@ |^\s*(def|class|function|func|public|private|static|#include)\b|[;{}]\s*$", re.MULTILINE)
+
+    def __init__(self, backends, slo=None, pricing=None, max_failures=3, eject_duration=30.0, explore_interval=50):
+        # backends : [(name, IGpt, config)] config: deployment, max_context, concurrency, tasks, price [input, output] per 1M tokens,
+        #   latency (sec), prefill_tps, decode_tps as the prior until the samples come
+        # slo : seconds. the cheapest backend predicted within slo is chosen, otherwise the fastest one
+        self.backends = [_Backend(name, client, config) for name, client, config in backends]
+        self.slo = slo
+        self.pricing = pricing if pricing else GptPricing.new_from_env()
+        self.max_failures = max_failures
+        self.eject_duration = eject_duration
+        self.explore_interval = explore_interval
+        self.output_tokens = dict(self.DEFAULT_OUTPUT_TOKENS)
+        self.routed = 0
+        self.fallbacks = 0
+        self.model = "router"
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_from_env(args):
+        # LLM_ROUTER=path of {"slo": 10, "backends": {"name": {"gpt": "local", "endpoint": ..., "deployment": ..., ...}}}
+        # the missing apikey, endpoint and deployment are taken from each backend's env
+        from GptHelper import GptClientFactory
+        path = os.getenv("LLM_ROUTER")
+        if not path or not os.path.exists(path):
+            raise ValueError("LLM_ROUTER is required to specify the backends of the router")
+        with open(path, 'r', encoding='UTF-8') as f:
+            config = json.load(f)
+        backends = []
+        for name, backend_config in config.get("backends", {}).items():
+            backend_args = argparse.Namespace(**vars(args))
+            backend_args.gpt = backend_config.get("gpt", "openai")
+            backend_args.useclaude = backend_args.gpt in ("calude3", "claude3", "claude")
+            backend_args.apikey = backend_config.get("apikey")
+            backend_args.endpoint = backend_config.get("endpoint")
+            backend_args.deployment = backend_config.get("deployment")
+            try:
+                # each backend has its own scheduler and budget with its actual model
+                backends.append((name, GptClientFactory.new_client(backend_args), backend_config))
+            except Exception as e:
+                print(f"ERROR!!!: {name} is skipped: {e}", file=sys.stderr)
+        if not backends:
+            raise ValueError("No available backend of the router")
+        slo = float(os.getenv("LLM_ROUTER_SLO", config.get("slo", 0))) or None
+        return GptRouter(backends, slo, GptPricing.new_from_env(), explore_interval=config.get("explore_interval", 50))
+
+    def classify(self, system_prompt, user_prompt):
+        return "code" if self.RE_CODE.search(user_prompt or "") else "chat"
+
+    def _get_cost(self, backend, prompt_tokens, output_tokens):
+        if backend.price:
+            return (prompt_tokens * backend.price[0] + output_tokens * backend.price[1]) / 1000000
+        cost = self.pricing.estimate_cost(backend.model, prompt_tokens, output_tokens)
+        # unknown model e.g. local one is free
+        return cost if cost is not None else 0.0
+
+    def _predict_locked(self, backend, prompt_tokens, output_tokens):
+        service_time = backend.latency.predict(prompt_tokens, output_tokens)
+        # waiting for the busy slots
+        return service_time * (1 + backend.outstanding // backend.concurrency)
+
+    def plan(self, prompt_tokens, task, slo=None):
+        # [(backend, predicted latency, cost)] in the order to try
+        slo = slo if slo is not None else self.slo
+        output_tokens = self.output_tokens.get(task, self.DEFAULT_OUTPUT_TOKENS["chat"])
+        now = time.time()
+        with self._lock:
+            candidates = []
+            for backend in self.backends:
+                if backend.max_context and prompt_tokens + output_tokens > backend.max_context:
+                    continue
+                if backend.tasks and task not in backend.tasks:
+                    continue
+                candidates.append((backend, self._predict_locked(backend, prompt_tokens, output_tokens), self._get_cost(backend, prompt_tokens, output_tokens)))
+            if not candidates:
+                # nothing fits, then the largest context one
+                backend = max(self.backends, key=lambda b: b.max_context or float("inf"))
+                candidates = [(backend, self._predict_locked(backend, prompt_tokens, output_tokens), self._get_cost(backend, prompt_tokens, output_tokens))]
+            available = [c for c in candidates if c[0].ejected_until <= now] or candidates
+            meeting = [c for c in available if slo is None or c[1] <= slo]
+            if meeting:
+                ordered = sorted(meeting, key=lambda c: (c[2], c[1])) + sorted([c for c in available if c not in meeting], key=lambda c: c[1])
+            else:
+                ordered = sorted(available, key=lambda c: c[1])
+            self.routed += 1
+            if self.explore_interval and self.routed % self.explore_interval == 0 and len(ordered) > 1:
+                # refresh the stale statistics of the least recently used one
+                stale = min(ordered, key=lambda c: c[0].last_used)
+                ordered.remove(stale)
+                ordered.insert(0, stale)
+        return ordered + [c for c in candidates if c not in ordered]
+
+    def _record(self, backend, prompt_tokens, task, content, response, latency, is_success):
+        with self._lock:
+            backend.outstanding = max(backend.outstanding - 1, 0)
+            if is_success is None:
+                # only returns the slot (e.g. cancelled by the caller)
+                return
+            if not is_success:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.max_failures:
+                    backend.ejected_until = time.time() + self.eject_duration
+                return
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0
+            usage = IGpt.get_usage(response)
+            if usage["prompt_tokens"] is not None:
+                prompt_tokens = usage["prompt_tokens"]
+            output_tokens = usage["completion_tokens"]
+            if output_tokens is None:
+                output_tokens = IGpt.estimate_tokens(content if isinstance(content, str) else "".join(content or []))
+            backend.latency.update(prompt_tokens, output_tokens, latency)
+            self.output_tokens[task] = 0.8 * self.output_tokens.get(task, output_tokens) + 0.2 * output_tokens
+
+    def _get_plan(self, prompt_tokens, task):
+        deadline = Deadline.current()
+        remaining = deadline.remaining() if deadline else None
+        slo = min(self.slo, remaining) if self.slo and remaining is not None else (self.slo or remaining)
+        with Tracer.span("route", task=task, prompt_tokens=prompt_tokens):
+            return self.plan(prompt_tokens, task, slo)
+
+    def _acquire(self, backend, is_fallback):
+        with self._lock:
+            backend.outstanding += 1
+            backend.requests += 1
+            backend.last_used = time.time()
+            if is_fallback:
+                self.fallbacks += 1
+
+    def _route(self, prompt_tokens, task, run, callback=None):
+        # run(client, callback) : (content, response) of the backend. falls back to the next one of the plan
+        deadline = Deadline.current()
+        plan = self._get_plan(prompt_tokens, task)
+
+        state = {"is_emitted": False}
+
+        def _callback(delta):
+            state["is_emitted"] = True
+            return callback(delta) if callback else None
+
+        last_error = None
+        for i, (backend, _, _) in enumerate(plan):
+            if deadline:
+                deadline.check()
+            self._acquire(backend, i > 0)
+            start_time = time.time()
+            try:
+                content, response = run(backend.client, _callback if callback else None)
+            except Exception as err:
+                if deadline and deadline.is_done():
+                    # no fallback after the caller gave up
+                    self._record(backend, prompt_tokens, task, None, None, None, None if deadline.is_cancelled() else False)
+                    deadline.check()
+                self._record(backend, prompt_tokens, task, None, None, None, False)
+                last_error = err
+                if state["is_emitted"]:
+                    # no fallback after the partial output went to the caller
+                    raise
+                print(f"ERROR!!!: {backend.name} failed, fallback: {err}", file=sys.stderr)
+                continue
+            if content is None:
+                # e.g. ClaudeGptHelper returns (None, None) for the client error such as too long prompt
+                self._record(backend, prompt_tokens, task, None, None, None, False)
+                print(f"ERROR!!!: {backend.name} returned no content, fallback", file=sys.stderr)
+                continue
+            self._record(backend, prompt_tokens, task, content, response, time.time() - start_time, True)
+            return content, response
+        if last_error:
+            raise last_error
+        return None, None
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        prompt_tokens = IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt)
+        task = self.classify(system_prompt, user_prompt)
+        return self._route(prompt_tokens, task, lambda client, _callback: client.query(system_prompt, user_prompt, _callback), callback)
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        # the conversation goes to the backend as is. the task is classified by the latest user message
+        prompt_tokens = sum([IGpt.estimate_tokens(m["content"] if isinstance(m["content"], str) else json.dumps(m["content"])) for m in messages])
+        user_prompts = [m["content"] for m in messages if m["role"] == "user" and isinstance(m["content"], str)]
+        task = self.classify(None, user_prompts[-1] if user_prompts else None)
+        return self._route(prompt_tokens, task, lambda client, _callback: client.query_messages(messages, _callback, session_id=session_id), callback)
+
+    def query_n(self, system_prompt, user_prompt, n):
+        # n candidates by one request of the planned backend
+        # [] if it doesn't support "n", then CandidateSampler routes each candidate by query()
+        prompt_tokens = IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt)
+        task = self.classify(system_prompt, user_prompt)
+        backend = self._get_plan(prompt_tokens, task)[0][0]
+        self._acquire(backend, False)
+        start_time = time.time()
+        try:
+            results = backend.client.query_n(system_prompt, user_prompt, n)
+        except Exception:
+            self._record(backend, prompt_tokens, task, None, None, None, False)
+            raise
+        if not results:
+            self._record(backend, prompt_tokens, task, None, None, None, None)
+            return []
+        self._record(backend, prompt_tokens, task, results[0][0], results[0][1], time.time() - start_time, True)
+        return results
+
+    def embed(self, texts, max_workers=4, callback=None):
+        # the first backend that supports the embeddings. None if none of them
+        for backend in self.backends:
+            vectors = backend.client.embed(texts, max_workers, callback)
+            if vectors is not None:
+                return vectors
+        return None
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "routed": self.routed,
+                "fallbacks": self.fallbacks,
+                "output_tokens": dict(self.output_tokens),
+                "backends": [dict({
+                    "name": b.name,
+                    "model": b.model,
+                    "requests": b.requests,
+                    "failures": b.failures,
+                    "outstanding": b.outstanding,
+                    "is_ejected": b.ejected_until > time.time(),
+                }, **b.latency.get_stats()) for b in self.backends],
+            }
@@ -0,0 +1,186 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import os
+import threading
+import time
+from GptHelper import IGpt
+from Deadline import Deadline
+
+PRIORITY_ENV = "GPT_PRIORITY"
+CONCURRENCY_ENV = "GPT_SCHEDULER_CONCURRENCY"
+
+
+class _Ticket:
+    def __init__(self, priority, finish_tag):
+        self.priority = priority
+        self.finish_tag = finish_tag
+        self.enqueue_time = time.time()
+        self.start_time = None
+
+
+class _PriorityStats:
+    def __init__(self, history_size=200):
+        self.in_flight = 0
+        self.served = 0
+        self.max_depth = 0
+        self.waits = collections.deque(maxlen=history_size)
+
+
+class GptScheduler:
+    PRIORITY_INTERACTIVE = "interactive"
+    PRIORITY_BATCH = "batch"
+    DEFAULT_WEIGHTS = {PRIORITY_INTERACTIVE: 8, PRIORITY_BATCH: 1}
+    # the cancel from the other thread doesn't notify the waiters, then it's polled in this interval
+    POLL_INTERVAL = 0.1
+
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+
+    def __init__(self, max_concurrency=8, weights=None, reserved=1):
+        # weighted fair queuing among the priority classes: each request gets the virtual finish tag
+        # max(virtual time, the class's last tag) + cost / weight and the smallest tag is dispatched first.
+        # reserved slots of max_concurrency are only for the highest weight class not to wait for a long batch request
+        self.max_concurrency = max_concurrency
+        self.weights = dict(weights) if weights else dict(self.DEFAULT_WEIGHTS)
+        self.top_priority = max(self.weights, key=self.weights.get)
+        self.reserved = min(reserved, max_concurrency - 1)
+        self.queues = {priority: collections.deque() for priority in self.weights}
+        self.last_finish_tags = {priority: 0.0 for priority in self.weights}
+        self.stats = {priority: _PriorityStats() for priority in self.weights}
+        self.virtual_time = 0.0
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def get_for(key, max_concurrency=None):
+        # one scheduler per end point shared by all of the clients in the process (e.g. GptDaemon)
+        with GptScheduler._schedulers_lock:
+            if key not in GptScheduler._schedulers:
+                max_concurrency = max_concurrency if max_concurrency else int(os.getenv(CONCURRENCY_ENV, "8"))
+                GptScheduler._schedulers[key] = GptScheduler(max_concurrency)
+            return GptScheduler._schedulers[key]
+
+    def _is_runnable_locked(self, priority):
+        if self.in_flight >= self.max_concurrency:
+            return False
+        return priority == self.top_priority or self.in_flight < self.max_concurrency - self.reserved
+
+    def _select_locked(self):
+        candidates = [queue[0] for priority, queue in self.queues.items() if queue and self._is_runnable_locked(priority)]
+        return min(candidates, key=lambda ticket: ticket.finish_tag) if candidates else None
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, cost=1):
+        # cost is the estimated tokens, then large batch requests take the proportional share
+        priority = priority if priority in self.weights else self.PRIORITY_BATCH if self.PRIORITY_BATCH in self.weights else self.top_priority
+        with self._cond:
+            start_tag = max(self.virtual_time, self.last_finish_tags[priority])
+            ticket = _Ticket(priority, start_tag + max(cost, 1) / self.weights[priority])
+            self.last_finish_tags[priority] = ticket.finish_tag
+            queue = self.queues[priority]
+            queue.append(ticket)
+            stats = self.stats[priority]
+            stats.max_depth = max(stats.max_depth, len(queue))
+            deadline = Deadline.current()
+            while self._select_locked() is not ticket:
+                if deadline and deadline.is_done():
+                    # the caller gave up in the queue: the later ones don't wait for this
+                    queue.remove(ticket)
+                    if self.last_finish_tags[priority] == ticket.finish_tag:
+                        self.last_finish_tags[priority] = start_tag
+                    self._cond.notify_all()
+                    deadline.check()
+                timeout = None
+                if deadline:
+                    remaining = deadline.remaining()
+                    timeout = min(remaining, self.POLL_INTERVAL) if remaining is not None else self.POLL_INTERVAL
+                self._cond.wait(timeout)
+            queue.popleft()
+            self.virtual_time = max(self.virtual_time, start_tag)
+            self.in_flight += 1
+            ticket.start_time = time.time()
+            stats.in_flight += 1
+            stats.served += 1
+            stats.waits.append(ticket.start_time - ticket.enqueue_time)
+            self._cond.notify_all()
+        return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            self.in_flight -= 1
+            self.stats[ticket.priority].in_flight -= 1
+            self._cond.notify_all()
+
+    def run(self, func, priority=PRIORITY_INTERACTIVE, cost=1):
+        ticket = self.acquire(priority, cost)
+        try:
+            return func()
+        finally:
+            self.release(ticket)
+
+    def get_stats(self):
+        with self._cond:
+            results = {"in_flight": self.in_flight, "max_concurrency": self.max_concurrency, "priorities": {}}
+            for priority, stats in self.stats.items():
+                waits = sorted(stats.waits)
+                results["priorities"][priority] = {
+                    "queue_depth": len(self.queues[priority]),
+                    "max_queue_depth": stats.max_depth,
+                    "in_flight": stats.in_flight,
+                    "served": stats.served,
+                    "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+                    "wait_p95": waits[min(int(len(waits) * 0.95), len(waits) - 1)] if waits else 0.0,
+                }
+            return results
+
+
+class ScheduledGpt(IGpt):
+    def __init__(self, client, scheduler, priority=None):
+        # priority=None reads GPT_PRIORITY env per request (the daemon has per request env)
+        self.client = client
+        self.scheduler = scheduler
+        self.priority = priority
+        self.model = getattr(client, "model", None)
+        # IGpt.embed() runs on this wrapper to take a slot per batch, then with the wrapped client's batch size and cache
+        self.EMBEDDING_BATCH_SIZE = getattr(client, "EMBEDDING_BATCH_SIZE", IGpt.EMBEDDING_BATCH_SIZE)
+        self.embedding_model = getattr(client, "embedding_model", None) or self.model
+
+    @property
+    def embedding_cache(self):
+        return getattr(self.client, "embedding_cache", None)
+
+    @embedding_cache.setter
+    def embedding_cache(self, embedding_cache):
+        self.client.embedding_cache = embedding_cache
+
+    def _get_priority(self):
+        return self.priority if self.priority else os.getenv(PRIORITY_ENV, GptScheduler.PRIORITY_INTERACTIVE)
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        cost = IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt)
+        return self.scheduler.run(lambda: self.client.query(system_prompt, user_prompt, callback), self._get_priority(), cost)
+
+    def query_n(self, system_prompt, user_prompt, n):
+        # one slot as the prompt is prefilled once for the n choices
+        cost = IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt)
+        return self.scheduler.run(lambda: self.client.query_n(system_prompt, user_prompt, n), self._get_priority(), cost)
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        cost = sum(IGpt.estimate_tokens(m["content"]) for m in messages if isinstance(m.get("content"), str))
+        return self.scheduler.run(lambda: self.client.query_messages(messages, callback, session_id=session_id), self._get_priority(), cost)
+
+    def embed_batch(self, texts):
+        cost = sum(IGpt.estimate_tokens(text) for text in texts)
+        return self.scheduler.run(lambda: self.client.embed_batch(texts), self._get_priority(), cost)
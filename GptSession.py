@@ -0,0 +1,140 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# keep this module light: the compatible CLIs load the session file without GptHelper
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import uuid
+
+
+class GptSession:
+    # {"version", "session_id", "messages", "usage"}
+    VERSION = 1
+
+    def __init__(self, client=None, system_prompt=None, path=None, session_id=None, max_prompt_tokens=None):
+        # the messages are append-only: [system, user, assistant, user, assistant, ...]
+        # then the prefix of the next request is the previous request + answer and the server's KV cache (prompt cache) hits
+        # max_prompt_tokens : the oldest half of the turns is dropped at once not to change the prefix on every turn
+        self.client = client
+        self.path = path
+        self.session_id = session_id
+        self.max_prompt_tokens = max_prompt_tokens
+        self.messages = []
+        self.usage = {"turns": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "compactions": 0}
+        if path and os.path.exists(path):
+            self.load(path)
+        if not self.session_id:
+            self.session_id = uuid.uuid4().hex
+        if system_prompt:
+            self.set_system_prompt(system_prompt)
+
+    def set_system_prompt(self, system_prompt):
+        # the different system prompt invalidates the whole prefix, then the history is restarted
+        if self.messages and self.messages[0]["role"] == "system":
+            if self.messages[0]["content"] == system_prompt:
+                return
+            print("WARNING: system prompt is changed, then the session history is restarted", file=sys.stderr)
+        self.messages = [{"role": "system", "content": system_prompt}]
+
+    @staticmethod
+    def get_slot(session_id, slots):
+        # llama.cpp's id_slot: the same session goes to the same slot to reuse its KV cache
+        return int(hashlib.sha256(str(session_id).encode("utf-8")).hexdigest(), 16) % slots
+
+    @staticmethod
+    def estimate_tokens(messages):
+        # same as IGpt.estimate_tokens
+        result = 0
+        for message in messages:
+            text = message.get("content") or ""
+            if not isinstance(text, str):
+                text = json.dumps(text)
+            ascii_chars = len(text.encode("ascii", errors="ignore"))
+            result += (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+        return result
+
+    def _compact(self, message):
+        head = 1 if self.messages and self.messages[0]["role"] == "system" else 0
+        turns = self.messages[head:]
+        while turns and self.estimate_tokens(self.messages[:head] + turns + [message]) > self.max_prompt_tokens:
+            # keep the user/assistant pairs
+            drop = max(len(turns) // 2, 2)
+            drop += drop % 2
+            turns = turns[drop:]
+            self.usage["compactions"] += 1
+        self.messages = self.messages[:head] + turns
+
+    def get_messages(self, user_message):
+        # the messages to send for the next turn. the session isn't changed until add_turn()
+        if isinstance(user_message, str):
+            user_message = {"role": "user", "content": user_message}
+        if self.max_prompt_tokens:
+            self._compact(user_message)
+        return self.messages + [user_message]
+
+    def add_turn(self, user_message, content, usage=None):
+        # usage : {"prompt_tokens", "cached_tokens", "completion_tokens"} as IGpt.get_usage()
+        if isinstance(user_message, str):
+            user_message = {"role": "user", "content": user_message}
+        self.messages.append(user_message)
+        self.messages.append({"role": "assistant", "content": content if isinstance(content, str) else "".join(content or [])})
+        self.usage["turns"] += 1
+        for key in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+            if usage and usage.get(key):
+                self.usage[key] += usage[key]
+        if self.path:
+            self.save(self.path)
+
+    def ask(self, user_prompt, callback=None):
+        # client : IGpt. query_messages() sends the history as is
+        messages = self.get_messages(user_prompt)
+        content, response = self.client.query_messages(messages, callback, session_id=self.session_id)
+        if content is not None:
+            usage = self.client.get_usage(response) if hasattr(self.client, "get_usage") else None
+            self.add_turn(messages[-1], content, usage)
+        return content, response
+
+    def get_stats(self):
+        result = dict(self.usage)
+        result["messages"] = len(self.messages)
+        result["cache_ratio"] = self.usage["cached_tokens"] / self.usage["prompt_tokens"] if self.usage["prompt_tokens"] else 0.0
+        return result
+
+    def load(self, path):
+        try:
+            with open(path, 'r', encoding='UTF-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != self.VERSION:
+            return False
+        self.session_id = data.get("session_id", self.session_id)
+        self.messages = data.get("messages", [])
+        self.usage.update(data.get("usage", {}))
+        return True
+
+    def save(self, path):
+        # atomic not to break the session by the interrupted run
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".llm-session-")
+        try:
+            with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+                json.dump({"version": self.VERSION, "session_id": self.session_id, "messages": self.messages, "usage": self.usage}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
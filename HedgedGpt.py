@@ -0,0 +1,190 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import threading
+import time
+from GptHelper import IGpt
+from Deadline import Deadline
+
+
+class _Attempt:
+    def __init__(self, client, is_hedge, parent=None):
+        self.client = client
+        self.is_hedge = is_hedge
+        # the loser's socket is closed through this
+        self.deadline = Deadline(None, parent)
+        self.start_time = time.time()
+        self.first_token_time = None
+        self.content = None
+        self.response = None
+        self.error = None
+        self.is_done = False
+
+
+class HedgedGpt(IGpt):
+    def __init__(self, clients, percentile=0.95, initial_delay=None, min_samples=20, max_hedge_ratio=0.1, history_size=200):
+        # clients[0] is primary, the hedge goes to clients[1:] in turn (can be the same client)
+        self.clients = clients if isinstance(clients, list) else [clients, clients]
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.history = collections.deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._next_hedge = 0
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.latency_saved = 0.0
+        self.model = getattr(self.clients[0], "model", None)
+
+    def _get_percentile_locked(self):
+        if len(self.history) < self.min_samples:
+            return None
+        samples = sorted(self.history)
+        return samples[min(int(len(samples) * self.percentile), len(samples) - 1)]
+
+    def get_hedge_delay(self):
+        # first token latency of the percentile in the recent history
+        with self._lock:
+            delay = self._get_percentile_locked()
+        return delay if delay is not None else self.initial_delay
+
+    def _is_hedge_allowed(self):
+        # budget: hedges are capped to max_hedge_ratio of the requests (+1 to allow the first one)
+        with self._lock:
+            return self.hedges < self.max_hedge_ratio * self.requests + 1
+
+    def _hedge(self, run, callback):
+        # run(client, callback) : (content, response) of the attempt
+        lock = threading.Condition()
+        attempts = []
+        state = {"winner": None, "is_emitted": False}
+
+        def _cancel_losers(winner):
+            # right away not to keep the server's slot of the loser stuck in the prefill until the winner's generation ends
+            with lock:
+                losers = [a for a in attempts if a is not winner and not a.is_done]
+            for loser in losers:
+                loser.deadline.cancel()
+
+        def _run(attempt):
+            def _callback(delta):
+                is_won = False
+                with lock:
+                    if attempt.first_token_time is None:
+                        attempt.first_token_time = time.time()
+                    if state["winner"] is None:
+                        state["winner"] = attempt
+                        is_won = True
+                        lock.notify_all()
+                    if state["winner"] is not attempt:
+                        # the loser is cancelled
+                        return False
+                if is_won:
+                    _cancel_losers(attempt)
+                if callback:
+                    state["is_emitted"] = True
+                    return callback(delta)
+            try:
+                with attempt.deadline.activate():
+                    attempt.content, attempt.response = run(attempt.client, _callback)
+            except Exception as err:
+                attempt.error = err
+            is_won = False
+            with lock:
+                attempt.is_done = True
+                if state["winner"] is None and not attempt.error and attempt.content:
+                    # non streaming backend or empty stream
+                    attempt.first_token_time = time.time()
+                    state["winner"] = attempt
+                    is_won = True
+                lock.notify_all()
+            if is_won:
+                _cancel_losers(attempt)
+
+        parent = Deadline.current()
+
+        def _start(client, is_hedge):
+            attempt = _Attempt(client, is_hedge, parent)
+            attempts.append(attempt)
+            threading.Thread(target=_run, args=(attempt,), daemon=True).start()
+
+        with self._lock:
+            self.requests += 1
+        start_time = time.time()
+        delay = self.get_hedge_delay()
+
+        with lock:
+            _start(self.clients[0], False)
+            if delay is not None and len(self.clients) > 1:
+                lock.wait_for(lambda: state["winner"] or all(a.is_done for a in attempts), timeout=delay)
+                if state["winner"] is None and not all(a.is_done for a in attempts) and self._is_hedge_allowed():
+                    with self._lock:
+                        self.hedges += 1
+                        client = self.clients[1 + self._next_hedge % (len(self.clients) - 1)]
+                        self._next_hedge += 1
+                    _start(client, True)
+            lock.wait_for(lambda: (state["winner"] and state["winner"].is_done) or all(a.is_done for a in attempts))
+            winner = state["winner"]
+
+        # the non-streaming loser is still waiting for the whole response
+        for attempt in attempts:
+            if attempt is not winner and not attempt.is_done:
+                attempt.deadline.cancel()
+
+        if winner and winner.first_token_time:
+            with self._lock:
+                self.history.append(winner.first_token_time - start_time)
+                if winner.is_hedge:
+                    self.hedge_wins += 1
+                    # lower bound of the saved latency: the primary's first token came later or not yet
+                    primary = attempts[0]
+                    primary_first_token_time = primary.first_token_time if primary.first_token_time else time.time()
+                    self.latency_saved += max(primary_first_token_time - winner.first_token_time, 0)
+            if winner.error:
+                if state["is_emitted"] or (parent and parent.is_done()):
+                    # no fallback after the partial output went to the caller or the caller gave up
+                    raise winner.error
+                # the losers are already cancelled, then the other client is requested again
+                with self._lock:
+                    self.fallbacks += 1
+                clients = [c for c in self.clients if c is not winner.client] or self.clients
+                return run(clients[0], callback)
+            return winner.content, winner.response
+
+        for attempt in attempts:
+            if attempt.error:
+                raise attempt.error
+        return attempts[0].content, attempts[0].response
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        return self._hedge(lambda client, _callback: client.query(system_prompt, user_prompt, _callback), callback)
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        return self._hedge(lambda client, _callback: client.query_messages(messages, _callback, session_id=session_id), callback)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "fallbacks": self.fallbacks,
+                "latency_saved": self.latency_saved,
+                "hedge_delay": self._get_percentile_locked(),
+            }
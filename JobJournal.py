@@ -0,0 +1,127 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# keep this module light: the CLIs import this before the SDKs
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class JobJournal:
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+
+    def __init__(self, path, fsync_interval=1.0, fsync_count=32):
+        # append-only JSONL of {"unit", "hash", "status", "result", "error", "time"}. the last entry of the unit wins
+        # fsync is batched by fsync_interval seconds or fsync_count entries, then a crash loses only the last batch
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_count = fsync_count
+        self.units = {}
+        self.skipped = 0
+        self._unsynced = 0
+        self._last_fsync = time.time()
+        self._lock = threading.Lock()
+        self._load()
+        self._file = open(self.path, 'a', encoding='UTF-8')
+
+    @staticmethod
+    def make_hash(*inputs):
+        sha = hashlib.sha256()
+        for data in inputs:
+            sha.update(str(data).encode("utf-8"))
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            return
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn write of the crash
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                self.units[entry["unit"]] = entry
+                valid_size += len(line)
+        if valid_size != os.path.getsize(self.path):
+            os.truncate(self.path, valid_size)
+
+    def get_result(self, unit, input_hash):
+        # the recorded result if the unit is completed with the same input, otherwise None
+        with self._lock:
+            entry = self.units.get(unit)
+        if entry and entry["status"] == self.STATUS_DONE and entry["hash"] == input_hash:
+            return entry.get("result")
+        return None
+
+    def is_done(self, unit, input_hash):
+        with self._lock:
+            entry = self.units.get(unit)
+        return bool(entry) and entry["status"] == self.STATUS_DONE and entry["hash"] == input_hash
+
+    def record(self, unit, input_hash, status, result=None, error=None):
+        entry = {"unit": unit, "hash": input_hash, "status": status, "result": result, "error": error, "time": time.time()}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self.units[unit] = entry
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_count or time.time() - self._last_fsync >= self.fsync_interval:
+                self._fsync_locked()
+
+    def _fsync_locked(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_fsync = time.time()
+
+    def run(self, unit, input_hash, func):
+        # func() is skipped if the unit is already done with the same input. exception is recorded as failed then re-raised
+        if self.is_done(unit, input_hash):
+            with self._lock:
+                self.skipped += 1
+            return self.get_result(unit, input_hash)
+        try:
+            result = func()
+        except Exception as e:
+            self.record(unit, input_hash, self.STATUS_FAILED, error=str(e))
+            raise
+        self.record(unit, input_hash, self.STATUS_DONE if result is not None else self.STATUS_FAILED, result)
+        return result
+
+    def get_stats(self):
+        with self._lock:
+            statuses = [entry["status"] for entry in self.units.values()]
+            return {"done": statuses.count(self.STATUS_DONE), "failed": statuses.count(self.STATUS_FAILED), "skipped": self.skipped}
+
+    def close(self):
+        with self._lock:
+            self._fsync_locked()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
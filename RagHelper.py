@@ -0,0 +1,215 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+from Tracer import Tracer
+from GptHelper import IGpt
+from EmbeddingHelper import OpenAICompatibleEmbedding
+from VectorStore import VectorStore
+
+
+class RagRetriever:
+    # same as gaia's --rag-prompt with --rag-policy system-message
+    DEFAULT_RAG_PROMPT = "Use the following pieces of context to answer the user's question.\nIf you don't know the answer, just say that you don't know, don't try to make up an answer.\n----------------\n"
+
+    def __init__(self, embedder, path, limit=3, threshold=0.5, nprobe=8, chunk_size=1000, chunk_overlap=200, rag_prompt=DEFAULT_RAG_PROMPT, max_query_chars=2000):
+        self.embedder = embedder
+        self.store = VectorStore(path)
+        self.limit = limit
+        self.threshold = threshold
+        self.nprobe = nprobe
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.rag_prompt = rag_prompt
+        self.max_query_chars = max_query_chars
+
+    @staticmethod
+    def chunk(text, chunk_size=1000, chunk_overlap=200):
+        # line based chunks, the tail lines up to chunk_overlap chars are repeated in the next chunk
+        chunks = []
+        lines = text.splitlines()
+        current = []
+        current_size = 0
+        start_line = 0
+        for i, line in enumerate(lines):
+            if current and current_size + len(line) > chunk_size:
+                chunks.append((start_line, "\n".join(current)))
+                overlap = []
+                overlap_size = 0
+                for prev_line in reversed(current[1:]):
+                    if overlap_size + len(prev_line) > chunk_overlap:
+                        break
+                    overlap.insert(0, prev_line)
+                    overlap_size += len(prev_line) + 1
+                current = overlap
+                current_size = overlap_size
+                start_line = i - len(current)
+            current.append(line)
+            current_size += len(line) + 1
+        if current and "".join(current).strip():
+            chunks.append((start_line, "\n".join(current)))
+        return chunks
+
+    @staticmethod
+    def get_files(paths):
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+                    for filename in sorted(filenames):
+                        files.append(os.path.join(dirpath, filename))
+            else:
+                files.append(path)
+        return files
+
+    @staticmethod
+    def get_key(payload):
+        # (path, content hash) of the chunk. the index ingested before has only "source" as path:line
+        path = payload.get("path") or payload["source"].rsplit(":", 1)[0]
+        return path, payload.get("hash") or hashlib.sha256(payload["text"].encode("utf-8")).hexdigest()
+
+    def ingest(self, paths, max_workers=4, callback=None):
+        # re-ingest only embeds the new chunks. the chunks which aren't in the changed file anymore are removed
+        existing = {}
+        for index, payload in enumerate(self.store.payloads):
+            path, content_hash = self.get_key(payload)
+            existing.setdefault(path, {}).setdefault(content_hash, []).append(index)
+
+        chunks = []
+        removed = []
+        with Tracer.span("chunk"):
+            for path in self.get_files(paths):
+                try:
+                    with open(path, 'r', encoding='UTF-8') as f:
+                        text = f.read()
+                except (UnicodeDecodeError, OSError):
+                    continue
+                old_chunks = existing.pop(path, {})
+                for start_line, chunk in self.chunk(text, self.chunk_size, self.chunk_overlap):
+                    payload = {"source": f"{path}:{start_line+1}", "text": chunk, "path": path, "hash": hashlib.sha256(chunk.encode("utf-8")).hexdigest()}
+                    if old_chunks.get(payload["hash"]):
+                        # unchanged chunk: the line may be moved by the other chunk's change
+                        self.store.payloads[old_chunks[payload["hash"]].pop(0)].update(payload)
+                    else:
+                        chunks.append(payload)
+                for indexes in old_chunks.values():
+                    removed.extend(indexes)
+
+        if chunks:
+            # embedder.embed() batches and caches the requests
+            vectors = self.embedder.embed([c["text"] for c in chunks], max_workers, callback)
+            if vectors is None:
+                print(f"ERROR!!!: embeddings are not supported by {type(self.embedder).__name__}", file=sys.stderr)
+                return 0
+        if removed:
+            with Tracer.span("index"):
+                self.store.remove(removed)
+        if chunks:
+            with Tracer.span("index"):
+                self.store.add(vectors, chunks)
+        with Tracer.span("index"):
+            self.store.save()
+            self.store.build_index()
+        return len(chunks)
+
+    def retrieve(self, query):
+        if not len(self.store) or not query:
+            return []
+        vectors = self.embedder.embed([query[:self.max_query_chars]])
+        if vectors is None:
+            print(f"ERROR!!!: embeddings are not supported by {type(self.embedder).__name__}", file=sys.stderr)
+            return []
+        vector = vectors[0]
+        with Tracer.span("vector_search"):
+            return [(score, payload) for score, _, payload in self.store.search(vector, self.limit, self.threshold, self.nprobe)]
+
+    def augment(self, system_prompt, user_prompt):
+        contexts = self.retrieve(user_prompt)
+        if not contexts:
+            return system_prompt
+        context = "\n\n".join([payload["text"] for _, payload in contexts])
+        return f"{system_prompt}\n{self.rag_prompt}{context}" if system_prompt else f"{self.rag_prompt}{context}"
+
+
+class RagGpt(IGpt):
+    def __init__(self, client, retriever):
+        self.client = client
+        self.retriever = retriever
+        self.model = getattr(client, "model", None)
+        self._lock = threading.Lock()
+        self._last = (None, None, None)
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        # GptQueryWithCheck retries with the same prompts, then the retrieval is reused
+        with self._lock:
+            last_system_prompt, last_user_prompt, augmented = self._last
+        if last_system_prompt != system_prompt or last_user_prompt != user_prompt:
+            augmented = self.retriever.augment(system_prompt, user_prompt)
+            with self._lock:
+                self._last = (system_prompt, user_prompt, augmented)
+        return self.client.query(augmented, user_prompt, callback)
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        # the contexts go to the latest user message. the system message and the history are kept as is not to break the prefix of the session
+        if messages and messages[-1]["role"] == "user" and isinstance(messages[-1]["content"], str):
+            user_prompt = messages[-1]["content"]
+            context = self.retriever.augment("", user_prompt)
+            if context:
+                messages = messages[:-1] + [dict(messages[-1], content=f"{context}\n\n{user_prompt}")]
+        return self.client.query_messages(messages, callback, session_id=session_id)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Ingest documents to / search the in-process RAG index')
+    parser.add_argument('args', nargs='*', help='files or directories to ingest')
+
+    parser.add_argument('-r', '--rag', action='store', required=True, help='specify index path (path.npy and path.json are created)')
+    parser.add_argument('-e', '--embeddingendpoint', action='store', default=os.getenv("LLM_EMBEDDING_ENDPOINT"), help='specify embedding end point (e.g. http://localhost:8080/v1/embeddings) or set it in LLM_EMBEDDING_ENDPOINT env')
+    parser.add_argument('-m', '--model', action='store', default=None, help='specify embedding model or set it in LLM_EMBEDDING_MODEL env')
+    parser.add_argument('-q', '--query', action='store', default=None, help='specify query to search')
+    parser.add_argument('-n', '--limit', action='store', type=int, default=3, help='specify number of contexts to retrieve')
+    parser.add_argument('-t', '--threshold', action='store', type=float, default=0.5, help='specify score threshold of the contexts')
+    parser.add_argument('-s', '--chunksize', action='store', type=int, default=1000, help='specify chunk size in chars')
+    parser.add_argument('-o', '--overlap', action='store', type=int, default=200, help='specify overlap chars between the chunks')
+    parser.add_argument('-j', '--parallel', action='store', type=int, default=4, help='specify number of concurrent embedding requests')
+    Tracer.add_arguments(parser)
+
+    args = parser.parse_args()
+    Tracer.start_from_args(args)
+
+    embedder = OpenAICompatibleEmbedding.new_from_env(endpoint=args.embeddingendpoint, model=args.model)
+    if not embedder:
+        print("ERROR!!!: embedding end point is required", file=sys.stderr)
+        sys.exit(1)
+    retriever = RagRetriever(embedder, args.rag, args.limit, args.threshold, chunk_size=args.chunksize, chunk_overlap=args.overlap)
+
+    if args.args:
+        start_time = time.time()
+        count = retriever.ingest(args.args, args.parallel, lambda done, total: print(f"\r{done}/{total} chunks", end="", file=sys.stderr))
+        print(f"\ningested {count} chunks in {time.time()-start_time:.1f}s (total {len(retriever.store)})", file=sys.stderr)
+
+    if args.query:
+        start_time = time.time()
+        contexts = retriever.retrieve(args.query)
+        print(f"retrieved {len(contexts)} contexts in {(time.time()-start_time)*1000:.1f}ms", file=sys.stderr)
+        for score, payload in contexts:
+            print(f"{payload['source']} ({score:.3f})")
+            print(payload["text"])
+            print("")
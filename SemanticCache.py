@@ -0,0 +1,107 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+import threading
+import time
+from GptHelper import IGpt
+from VectorStore import VectorStore
+
+
+class SemanticCacheGpt(IGpt):
+    def __init__(self, client, embedder, path, threshold=0.95, max_entries=10000, ttl=None, save_interval=16):
+        self.client = client
+        self.embedder = embedder
+        self.store = VectorStore(path, max_entries=max_entries)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._unsaved = 0
+        self._is_supported = True
+        self._lock = threading.Lock()
+
+    def _get_model(self):
+        return str(getattr(self.client, "model", None))
+
+    def _lookup(self, vector, system_prompt):
+        model = self._get_model()
+        for score, index, payload in self.store.search(vector, limit=4, threshold=self.threshold):
+            # the answer is only reusable for the same model and the same system prompt
+            if payload["model"] != model or payload["system_prompt"] != system_prompt:
+                continue
+            if self.ttl and time.time() - payload["created"] > self.ttl:
+                continue
+            return score, payload
+        return None, None
+
+    def _query(self, system_prompt, user_prompt, callback, run):
+        # run(callback) : (content, response) of the client for the cache miss
+        vectors = self.embedder.embed([user_prompt]) if self._is_supported else None
+        if vectors is None:
+            if self._is_supported:
+                self._is_supported = False
+                print(f"ERROR!!!: embeddings are not supported by {type(self.embedder).__name__}, then the semantic cache is disabled", file=sys.stderr)
+            return run(callback)
+        vector = vectors[0]
+        score, payload = self._lookup(vector, system_prompt)
+        if payload:
+            with self._lock:
+                self.hits += 1
+            if callback:
+                callback(payload["content"])
+            return payload["content"], {"cached": True, "similarity": score, "model": payload["model"]}
+
+        with self._lock:
+            self.misses += 1
+        content, response = run(callback)
+        if content and isinstance(content, str):
+            self.store.add([vector], [{
+                "model": self._get_model(),
+                "system_prompt": system_prompt,
+                "user_prompt": user_prompt,
+                "content": content,
+                "created": time.time(),
+            }])
+            with self._lock:
+                self._unsaved += 1
+                is_save_needed = self._unsaved >= self.save_interval
+                if is_save_needed:
+                    self._unsaved = 0
+            if is_save_needed:
+                self.store.save()
+        return content, response
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        return self._query(system_prompt, user_prompt, callback, lambda _callback: self.client.query(system_prompt, user_prompt, _callback))
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        turns = [m for m in messages if m["role"] != "system"]
+        if len(turns) != 1 or turns[0]["role"] != "user" or not isinstance(turns[0]["content"], str):
+            # the answer depends on the conversation, then it isn't cached
+            return self.client.query_messages(messages, callback, session_id=session_id)
+        system_prompt = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        return self._query(system_prompt, turns[0]["content"], callback, lambda _callback: self.client.query_messages(messages, _callback, session_id=session_id))
+
+    def close(self):
+        self.store.save()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.store),
+            }
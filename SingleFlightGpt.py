@@ -0,0 +1,92 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import threading
+from GptHelper import IGpt
+from CandidateSampler import CandidateSampler
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.content = None
+        self.response = None
+        self.error = None
+
+
+class SingleFlightGpt(IGpt):
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.calls = 0
+        self.saved_calls = 0
+
+    def _get_key(self, *args):
+        # the parallel candidates of the same prompt are expected to be different answers
+        return (getattr(self.client, "endpoint", None), getattr(self.client, "model", None)) + args + (CandidateSampler.get_current_index(),)
+
+    def _run(self, key, run, callback):
+        # run(callback) : (content, response) of the client. only the leader calls it
+        if callback:
+            # the streaming request isn't coalesced: its callback can stop the stream (e.g. GptQueryWithCheck's is_ok_stream_result)
+            # then the others would get the aborted content as the complete one
+            with self._lock:
+                self.calls += 1
+            return run(callback)
+
+        is_leader = False
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight:
+                self.saved_calls += 1
+            else:
+                flight = _Flight()
+                self._flights[key] = flight
+                is_leader = True
+
+        if is_leader:
+            try:
+                flight.content, flight.response = run(None)
+            except Exception as err:
+                flight.error = err
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        else:
+            flight.done.wait()
+
+        if flight.error:
+            raise flight.error
+        return flight.content, flight.response
+
+    def query(self, system_prompt, user_prompt, callback=None):
+        key = self._get_key(system_prompt, user_prompt)
+        return self._run(key, lambda _callback: self.client.query(system_prompt, user_prompt, _callback), callback)
+
+    def query_messages(self, messages, callback=None, session_id=None):
+        key = self._get_key(json.dumps(messages, sort_keys=True), session_id)
+        return self._run(key, lambda _callback: self.client.query_messages(messages, _callback, session_id=session_id), callback)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "network_calls": self.calls - self.saved_calls,
+                "saved_calls": self.saved_calls,
+                "in_flight": len(self._flights),
+            }
@@ -0,0 +1,272 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import io
+import json
+import time
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class StreamDecoder:
+    CHUNK_SIZE = 64 * 1024
+
+    @staticmethod
+    def iter_chunks(response, chunk_size=CHUNK_SIZE):
+        # read1() returns whatever already arrived (up to chunk_size) instead of waiting the chunk_size to be filled
+        raw = getattr(response, "raw", response)
+        read1 = getattr(raw, "read1", None)
+        if read1:
+            # urllib3's response needs decode_content=True since requests opens it without decoding
+            kwargs = {"decode_content": True} if hasattr(raw, "stream") else {}
+            while True:
+                chunk = read1(chunk_size, **kwargs)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in response.iter_content(chunk_size=None):
+                yield chunk
+
+    @staticmethod
+    def iter_lines(response, chunk_size=CHUNK_SIZE):
+        buf = bytearray()
+        for chunk in StreamDecoder.iter_chunks(response, chunk_size):
+            buf += chunk
+            start = 0
+            while True:
+                pos = buf.find(b"\n", start)
+                if pos < 0:
+                    break
+                end = pos - 1 if pos > start and buf[pos - 1] == 13 else pos
+                if end > start:
+                    yield bytes(buf[start:end])
+                start = pos + 1
+            if start:
+                del buf[:start]
+        if buf.strip():
+            yield bytes(buf)
+
+    @staticmethod
+    def iter_ndjson(response, chunk_size=CHUNK_SIZE):
+        for line in StreamDecoder.iter_lines(response, chunk_size):
+            yield json_loads(line)
+
+    @staticmethod
+    def iter_sse(response, chunk_size=CHUNK_SIZE):
+        data = []
+        for line in StreamDecoder.iter_lines(response, chunk_size):
+            if line.startswith(b"data:"):
+                payload = line[5:].strip()
+                if payload == b"[DONE]":
+                    return
+                # one data line per event in practice, then decode it without waiting the blank line
+                try:
+                    yield json_loads(b"".join(data) + payload)
+                    data = []
+                except ValueError:
+                    data.append(payload)
+            elif line.startswith(b"{"):
+                # some servers mix plain json (e.g. error) into the stream
+                yield json_loads(line)
+
+    @staticmethod
+    def iter_bedrock_chunks(event_stream):
+        for event in event_stream:
+            if "chunk" in event:
+                yield json_loads(event["chunk"]["bytes"])
+
+    @staticmethod
+    def is_sse(response):
+        headers = getattr(response, "headers", None) or {}
+        return "text/event-stream" in headers.get("Content-Type", "")
+
+    @staticmethod
+    def decode_chat_stream(response, callback=None, chunk_size=CHUNK_SIZE):
+        # ollama's NDJSON and OpenAI's SSE chat streams. returns (output, last message)
+        # callback(delta) can return False to stop reading the stream
+        output = ""
+        message = {}
+        is_aborted = False
+        if StreamDecoder.is_sse(response):
+            for body in StreamDecoder.iter_sse(response, chunk_size):
+                if "error" in body:
+                    raise Exception(body["error"])
+                message = body
+                for choice in body.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        output += content
+                        if callback and callback(content) is False:
+                            is_aborted = True
+                if is_aborted:
+                    break
+        else:
+            for body in StreamDecoder.iter_ndjson(response, chunk_size):
+                if "error" in body:
+                    raise Exception(body["error"])
+                message = body
+                content = (body.get("message") or {}).get("content", "")
+                if content:
+                    output += content
+                    if callback and callback(content) is False:
+                        is_aborted = True
+                        break
+                if body.get("done", False):
+                    break
+        message["content"] = output
+        if is_aborted:
+            message["aborted"] = True
+        return output, message
+
+    @staticmethod
+    def decode_bedrock_stream(event_stream, callback=None):
+        # anthropic messages events on bedrock. returns (output, status)
+        # callback(delta) can return False to stop reading the stream
+        result = ""
+        status = {}
+        for chunk in StreamDecoder.iter_bedrock_chunks(event_stream):
+            if chunk['type'] == 'message_start':
+                status["input_tokens"] = chunk['message'].get('usage', {}).get('input_tokens', 0)
+                if 'cache_read_input_tokens' in chunk['message'].get('usage', {}):
+                    status["cache_read_input_tokens"] = chunk['message']['usage']['cache_read_input_tokens']
+            elif chunk['type'] == 'message_delta':
+                status.update({
+                    "stop_reason": chunk['delta']['stop_reason'],
+                    "stop_sequence": chunk['delta']['stop_sequence'],
+                    "output_tokens": chunk['usage']['output_tokens'],
+                })
+            elif chunk['type'] == 'content_block_delta':
+                if chunk['delta']['type'] == 'text_delta':
+                    result += chunk['delta']['text']
+                    if callback and callback(chunk['delta']['text']) is False:
+                        status["stop_reason"] = "aborted"
+                        status["aborted"] = True
+                        if hasattr(event_stream, "close"):
+                            event_stream.close()
+                        break
+        return result, status
+
+
+class _ChunkedReader(io.RawIOBase):
+    def __init__(self, data, chunk_size):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.chunk_size = chunk_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # deliver at most chunk_size bytes per read like a socket
+        n = min(len(b), self.chunk_size, len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def read1(self, size=-1):
+        n = min(size if size and size > 0 else self.chunk_size, self.chunk_size, len(self.data) - self.pos)
+        result = bytes(self.data[self.pos:self.pos + n])
+        self.pos += n
+        return result
+
+
+class _FakeResponse:
+    def __init__(self, data, chunk_size, content_type):
+        self.raw = _ChunkedReader(data, chunk_size)
+        self.headers = {"Content-Type": content_type}
+
+    def iter_lines(self, chunk_size=512):
+        # requests' default iter_lines() behavior
+        pending = None
+        while True:
+            chunk = self.raw.read(chunk_size)
+            if not chunk:
+                break
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+                pending = lines.pop()
+            else:
+                pending = None
+            for line in lines:
+                yield line
+        if pending is not None:
+            yield pending
+
+
+def _generate_ndjson(size):
+    lines = []
+    total = 0
+    while total < size:
+        line = json.dumps({"model": "bench", "created_at": "2024-01-01T00:00:00Z", "message": {"role": "assistant", "content": "token "}, "done": False}).encode() + b"\n"
+        lines.append(line)
+        total += len(line)
+    lines.append(json.dumps({"model": "bench", "done": True, "eval_count": len(lines)}).encode() + b"\n")
+    return b"".join(lines)
+
+
+def _generate_sse(size):
+    lines = []
+    total = 0
+    while total < size:
+        line = b"data: " + json.dumps({"id": "bench", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": "token "}}]}).encode() + b"\n\n"
+        lines.append(line)
+        total += len(line)
+    lines.append(b"data: [DONE]\n\n")
+    return b"".join(lines)
+
+
+def _legacy_decode(response):
+    # the previous per-line json.loads() loop
+    output = ""
+    for line in response.iter_lines():
+        body = json.loads(line)
+        if body.get("done") is False:
+            output += body.get("message", {}).get("content", "")
+        if body.get("done", False):
+            return output
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmark stream decoder with synthetic streams')
+    parser.add_argument('-s', '--size', action='store', type=int, default=8, help='specify synthetic stream size in MB')
+    parser.add_argument('-c', '--chunk', action='store', type=int, default=16*1024, help='specify socket read size of the synthetic stream')
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    print(f"json parser: {json_loads.__module__}")
+
+    ndjson = _generate_ndjson(size)
+    start_time = time.perf_counter()
+    expected = _legacy_decode(_FakeResponse(ndjson, args.chunk, "application/x-ndjson"))
+    legacy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    output, _ = StreamDecoder.decode_chat_stream(_FakeResponse(ndjson, args.chunk, "application/x-ndjson"))
+    decoder_time = time.perf_counter() - start_time
+    assert output == expected
+    print(f"ndjson {len(ndjson)/1024/1024:.1f}MB: iter_lines+json.loads {legacy_time:.3f}s, StreamDecoder {decoder_time:.3f}s ({len(ndjson)/1024/1024/decoder_time:.1f}MB/s)")
+
+    sse = _generate_sse(size)
+    start_time = time.perf_counter()
+    output, _ = StreamDecoder.decode_chat_stream(_FakeResponse(sse, args.chunk, "text/event-stream"))
+    decoder_time = time.perf_counter() - start_time
+    print(f"sse {len(sse)/1024/1024:.1f}MB: StreamDecoder {decoder_time:.3f}s ({len(sse)/1024/1024/decoder_time:.1f}MB/s)")
@@ -0,0 +1,183 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# keep this module light: the CLIs import this first, then the imports of the SDKs are in the startup span
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+_IMPORTED_AT = time.time()
+# GptDaemon runs the CLIs without the process start, then the start is marked per request
+_started_at = threading.local()
+
+
+class Tracer:
+    _current = None
+    _is_atexit_registered = False
+    # GptDaemon runs the concurrent requests in a process, then the tracer is per request thread (and its spawned threads)
+    is_per_thread = False
+    _thread_current = threading.local()
+
+    def __init__(self, trace_path=None, cprofile_path=None, is_breakdown=True):
+        self.trace_path = trace_path
+        self.cprofile_path = cprofile_path
+        self.is_breakdown = is_breakdown
+        self.start_time = getattr(_started_at, "time", _IMPORTED_AT)
+        self.thread_id = threading.get_ident()
+        # (name, start, duration, self duration, thread id, args)
+        self.spans = []
+        self.profiler = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_current():
+        return getattr(Tracer._thread_current, "tracer", None) if Tracer.is_per_thread else Tracer._current
+
+    @staticmethod
+    def set_current(tracer):
+        if Tracer.is_per_thread:
+            Tracer._thread_current.tracer = tracer
+        else:
+            Tracer._current = tracer
+
+    @staticmethod
+    def span(name, **args):
+        # no-op unless the tracing is started, then the phases can be marked anywhere without the cost
+        tracer = Tracer.get_current()
+        if tracer is None:
+            return contextlib.nullcontext()
+        return tracer._span(name, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        stack = self._local.stack
+        # [children's duration] to get the self duration
+        frame = [0.0]
+        stack.append(frame)
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start_time
+            stack.pop()
+            if stack:
+                stack[-1][0] += duration
+            self.add(name, start_time, duration, duration - frame[0], args)
+
+    def add(self, name, start_time, duration, self_duration=None, args=None):
+        with self._lock:
+            self.spans.append((name, start_time, duration, duration if self_duration is None else self_duration, threading.get_ident(), args or {}))
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument('--profile', action='store_true', default=False, help='print the time breakdown of the phases to stderr at exit')
+        parser.add_argument('--trace', action='store', default=os.getenv("LLM_TRACE"), help='specify path to write the spans as Chrome trace (chrome://tracing, Perfetto) or set it in LLM_TRACE env')
+        parser.add_argument('--cprofile', action='store', default=None, help='specify path to dump cProfile stats of the run (python -m pstats PATH)')
+
+    @staticmethod
+    def start_from_args(args):
+        # call right after parse_args(). returns None if none of --profile, --trace, --cprofile
+        is_breakdown = getattr(args, "profile", False)
+        trace_path = getattr(args, "trace", None)
+        cprofile_path = getattr(args, "cprofile", None)
+        if not is_breakdown and not trace_path and not cprofile_path:
+            return None
+        tracer = Tracer(trace_path, cprofile_path, is_breakdown)
+        tracer.add("startup", tracer.start_time, time.time() - tracer.start_time, args={"phase": "imports and parse_args"})
+        tracer.start()
+        return tracer
+
+    @staticmethod
+    def mark_start():
+        _started_at.time = time.time()
+
+    @staticmethod
+    def finish_current():
+        # for GptDaemon as atexit doesn't come. the tracer started by the other request is kept
+        tracer = Tracer.get_current()
+        if tracer and tracer.thread_id == threading.get_ident():
+            tracer.finish()
+        _started_at.__dict__.pop("time", None)
+
+    def start(self):
+        Tracer.set_current(self)
+        if self.cprofile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        # sys.exit() in the middle of the CLIs is also covered
+        if not Tracer._is_atexit_registered:
+            Tracer._is_atexit_registered = True
+            atexit.register(Tracer.finish_current)
+
+    def finish(self):
+        if Tracer.get_current() is not self:
+            return
+        Tracer.set_current(None)
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.cprofile_path)
+        self.add("total", self.start_time, time.time() - self.start_time, 0.0)
+        if self.trace_path:
+            self.export_chrome_trace(self.trace_path)
+        if self.is_breakdown:
+            self.print_breakdown()
+
+    def export_chrome_trace(self, path):
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            "name": name,
+            "cat": "llm",
+            "ph": "X",
+            "ts": (start_time - self.start_time) * 1000000,
+            "dur": duration * 1000000,
+            "pid": pid,
+            "tid": tid,
+            "args": {k: str(v) for k, v in args.items()},
+        } for name, start_time, duration, _, tid, args in spans]
+        with open(path, 'w', encoding='UTF-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def get_breakdown(self):
+        # {name: {"count", "total", "self"}} in the order of the first appearance
+        result = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span[1])
+        for name, _, duration, self_duration, _, _ in spans:
+            stat = result.setdefault(name, {"count": 0, "total": 0.0, "self": 0.0})
+            stat["count"] += 1
+            stat["total"] += duration
+            stat["self"] += self_duration
+        return result
+
+    def print_breakdown(self, file=None):
+        # self% of the concurrent spans (e.g. --compare, embed) can exceed 100% in total
+        # sys.stderr is looked up here as GptDaemon swaps it per request
+        file = file if file else sys.stderr
+        breakdown = self.get_breakdown()
+        wall = breakdown.pop("total", {"total": time.time() - self.start_time})["total"]
+        untraced = max(wall - sum(stat["self"] for stat in breakdown.values()), 0.0)
+        print(f"{'phase':<24} {'count':>6} {'total(s)':>9} {'self(s)':>9} {'self%':>6}", file=file)
+        for name, stat in list(breakdown.items()) + [("(untraced)", {"count": 0, "total": untraced, "self": untraced})]:
+            print(f"{name[:24]:<24} {stat['count']:>6} {stat['total']:>9.3f} {stat['self']:>9.3f} {stat['self'] / wall * 100 if wall else 0:>5.1f}%", file=file)
+        print(f"{'wall':<24} {'':>6} {wall:>9.3f}", file=file)
@@ -0,0 +1,198 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+
+class VectorStore:
+    def __init__(self, path, dim=None, capacity=1024, max_entries=None):
+        # path.npy : memory-mapped float32 matrix (capacity x dim), rows are L2 normalized
+        # path.json : count, payloads and last used time of each row
+        self.path = path
+        self.matrix_path = path + ".npy"
+        self.meta_path = path + ".json"
+        self.ivf_path = path + ".ivf.npz"
+        self.dim = dim
+        self.capacity = capacity if not max_entries else max_entries
+        self.max_entries = max_entries
+        self.count = 0
+        self.payloads = []
+        self.last_used = []
+        self.matrix = None
+        self.centroids = None
+        self.assignments = None
+        self.ivf_count = 0
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.matrix_path) and os.path.exists(self.meta_path):
+            self.matrix = np.load(self.matrix_path, mmap_mode="r+")
+            self.capacity, self.dim = self.matrix.shape
+            with open(self.meta_path, 'r', encoding='UTF-8') as f:
+                meta = json.load(f)
+            self.count = meta.get("count", 0)
+            self.payloads = meta.get("payloads", [])
+            self.last_used = meta.get("last_used", [0] * self.count)
+        if os.path.exists(self.ivf_path):
+            ivf = np.load(self.ivf_path)
+            self.centroids = ivf["centroids"]
+            self.assignments = ivf["assignments"]
+            self.ivf_count = len(self.assignments)
+
+    def _allocate(self, capacity):
+        directory = os.path.dirname(self.matrix_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.matrix_path + ".tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+        if self.matrix is not None and self.count:
+            matrix[:self.count] = self.matrix[:self.count]
+        matrix.flush()
+        del matrix
+        self.matrix = None
+        os.replace(tmp_path, self.matrix_path)
+        self.matrix = np.load(self.matrix_path, mmap_mode="r+")
+        self.capacity = capacity
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def __len__(self):
+        return self.count
+
+    def add(self, vectors, payloads):
+        vectors = self.normalize(np.atleast_2d(vectors))
+        indexes = []
+        with self._lock:
+            if self.matrix is None:
+                self.dim = vectors.shape[1] if not self.dim else self.dim
+                self._allocate(max(self.capacity, len(vectors)) if not self.max_entries else self.max_entries)
+            for vector, payload in zip(vectors, payloads):
+                if self.count < self.capacity:
+                    index = self.count
+                    self.count += 1
+                    self.payloads.append(payload)
+                    self.last_used.append(0)
+                elif self.max_entries:
+                    # evict the least recently used row
+                    index = int(np.argmin(self.last_used))
+                    self.payloads[index] = payload
+                else:
+                    self._allocate(self.capacity * 2)
+                    index = self.count
+                    self.count += 1
+                    self.payloads.append(payload)
+                    self.last_used.append(0)
+                self.matrix[index] = vector
+                self.last_used[index] = time.time()
+                indexes.append(index)
+        return indexes
+
+    def remove(self, indexes):
+        # the rest of the rows are compacted, then the approximate index is dropped until the next build_index()
+        with self._lock:
+            removed = set(indexes)
+            keep = [i for i in range(self.count) if i not in removed]
+            if len(keep) == self.count:
+                return 0
+            if keep:
+                self.matrix[:len(keep)] = self.matrix[keep]
+            self.payloads = [self.payloads[i] for i in keep]
+            self.last_used = [self.last_used[i] for i in keep]
+            self.count = len(keep)
+            self.centroids = None
+            self.assignments = None
+            self.ivf_count = 0
+            if os.path.exists(self.ivf_path):
+                os.unlink(self.ivf_path)
+            return len(removed)
+
+    def build_index(self, nlist=None, iterations=10, sample_size=65536):
+        # approximate index (IVF): k-means centroids and the nearest centroid of each row
+        with self._lock:
+            if self.count < 1024:
+                return
+            nlist = nlist if nlist else int(np.sqrt(self.count))
+            vectors = self.matrix[:self.count]
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(self.count, min(sample_size, self.count), replace=False)]
+            centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assignments = np.argmax(sample @ centroids.T, axis=1)
+                for i in range(nlist):
+                    members = sample[assignments == i]
+                    if len(members):
+                        centroids[i] = members.mean(axis=0)
+                centroids = self.normalize(centroids)
+            self.centroids = centroids
+            self.assignments = np.concatenate([np.argmax(vectors[i:i+65536] @ centroids.T, axis=1) for i in range(0, self.count, 65536)])
+            self.ivf_count = self.count
+            np.savez(self.ivf_path, centroids=self.centroids, assignments=self.assignments)
+
+    def _get_candidates(self, query, nprobe):
+        # the rows added after build_index() are always searched exhaustively
+        nearest_lists = np.argsort(-(self.centroids @ query))[:nprobe]
+        candidates = np.nonzero(np.isin(self.assignments, nearest_lists))[0]
+        if self.ivf_count < self.count:
+            candidates = np.concatenate([candidates, np.arange(self.ivf_count, self.count)])
+        return candidates
+
+    def search(self, vector, limit=1, threshold=None, nprobe=None):
+        results = []
+        with self._lock:
+            if not self.count:
+                return results
+            query = self.normalize(vector).reshape(-1)
+            if nprobe and self.centroids is not None and not self.max_entries:
+                candidates = self._get_candidates(query, nprobe)
+                scores = self.matrix[candidates] @ query
+            else:
+                candidates = np.arange(self.count)
+                scores = self.matrix[:self.count] @ query
+            limit = min(limit, len(candidates))
+            if not limit:
+                return results
+            if limit < len(candidates):
+                top = np.argpartition(-scores, limit - 1)[:limit]
+            else:
+                top = np.arange(len(candidates))
+            top = top[np.argsort(-scores[top])]
+            now = time.time()
+            for pos in top:
+                score = float(scores[pos])
+                if threshold is not None and score < threshold:
+                    break
+                index = int(candidates[pos])
+                self.last_used[index] = now
+                results.append((score, index, self.payloads[index]))
+        return results
+
+    def save(self):
+        with self._lock:
+            if self.matrix is None:
+                return
+            self.matrix.flush()
+            tmp_path = self.meta_path + ".tmp"
+            with open(tmp_path, 'w', encoding='UTF-8') as f:
+                json.dump({"count": self.count, "payloads": self.payloads, "last_used": self.last_used}, f)
+            os.replace(tmp_path, self.meta_path)
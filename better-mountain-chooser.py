@@ -13,31 +13,132 @@
 #   limitations under the License.
 
 import argparse
+import math
 import os
+import re
 import sys
+import time
+from Tracer import Tracer
 from openai import AzureOpenAI
 
+class Bm25Index:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = []
+        self.avg_doc_length = 0
+
+    @staticmethod
+    def tokenize(text):
+        # words for alphabets/numbers and character bi-grams for CJK since the records are in Japanese
+        tokens = []
+        for word in re.findall(r"[A-Za-z0-9]+|[^\sA-Za-z0-9\W]+", text.lower()):
+            if word.isascii():
+                tokens.append(word)
+            elif len(word)==1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i+2] for i in range(len(word)-1))
+        return tokens
+
+    def build(self, docs):
+        for doc_id, doc in enumerate(docs):
+            tokens = self.tokenize(doc)
+            self.doc_lengths.append(len(tokens))
+            tf = {}
+            for token in tokens:
+                tf[token] = tf.get(token, 0) + 1
+            for token, count in tf.items():
+                self.postings.setdefault(token, []).append((doc_id, count))
+        self.avg_doc_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0
+
+    def search(self, query):
+        scores = {}
+        n = len(self.doc_lengths)
+        for token in set(self.tokenize(query)):
+            postings = self.postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length)
+                scores[doc_id] = scores.get(doc_id, 0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+
+def split_records(info):
+    # a record is a paragraph, or a line if there is no blank line
+    records = [r.strip() for r in re.split(r"\n\s*\n", info) if r.strip()]
+    if len(records) <= 1:
+        records = [r.strip() for r in info.splitlines() if r.strip()]
+    return records
+
+
+def select_candidates(records, query, candidate_pattern, top_k, records_per_candidate):
+    index = Bm25Index()
+    start_time = time.perf_counter()
+    index.build(records)
+    build_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    scores = index.search(query)
+    if not scores:
+        # e.g. the query's words aren't in the records. the empty info makes the LLM answer nothing, then no filtering
+        print(f"WARNING: bm25: no record matched the query, all of the {len(records)} records are sent", file=sys.stderr)
+        return records
+    # a candidate (e.g. mountain name) is ranked by its best record
+    candidates = {}
+    for doc_id, score in scores.items():
+        match = re.match(candidate_pattern, records[doc_id])
+        key = match.group(1).strip() if match else records[doc_id]
+        candidates.setdefault(key, []).append((score, doc_id))
+    ranked = sorted(candidates.values(), key=lambda docs: max(docs)[0], reverse=True)[:top_k]
+    selected = []
+    for docs in ranked:
+        for score, doc_id in sorted(docs, reverse=True)[:records_per_candidate]:
+            selected.append(records[doc_id])
+    query_time = time.perf_counter() - start_time
+
+    print(f"bm25: {len(records)} records, index {build_time*1000:.1f}ms, query {query_time*1000:.1f}ms, {len(candidates)} matched candidates -> top {len(ranked)}", file=sys.stderr)
+    return selected
+
+
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='Code review specified file with OpenAI LLM')
     parser.add_argument('-k', '--apikey', action='store', default=os.getenv("AZURE_OPENAI_API_KEY"), help='specify your API key or set it in AZURE_OPENAI_API_KEY env')
     parser.add_argument('-e', '--endpoint', action='store', default=os.getenv("AZURE_OPENAI_ENDPOINT"), help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
     parser.add_argument('-d', '--deployment', action='store', default=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"), help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env')
+    parser.add_argument('-q', '--query', action='store', default=None, help='specify customer\'s constraints (e.g. area, level, season). records are pre-ranked by BM25 with this')
+    parser.add_argument('-n', '--topk', action='store', type=int, default=20, help='specify number of candidates sent to LLM')
+    parser.add_argument('-r', '--records', action='store', type=int, default=3, help='specify number of records per candidate sent to LLM')
+    parser.add_argument('-m', '--candidate', action='store', default=r"^([^\t,:\n]+)", help='specify regexp to extract candidate (mountain) name from a record')
+    Tracer.add_arguments(parser)
     args = parser.parse_args()
+    Tracer.start_from_args(args)
 
-    info = sys.stdin.read()
+    with Tracer.span("read_stdin"):
+        info = sys.stdin.read()
+    if args.query:
+        original_size = len(info)
+        with Tracer.span("select_candidates"):
+            info = "\n\n".join(select_candidates(split_records(info), args.query, args.candidate, args.topk, args.records))
+        print(f"prompt: {original_size} -> {len(info)} chars ({len(info)*100/max(original_size, 1):.1f}%)", file=sys.stderr)
+        info = f"Customer's constraints: {args.query}\n\n{info}"
 
     client = AzureOpenAI(
       api_key = args.apikey,  
       api_version = "2024-02-01",
       azure_endpoint = args.endpoint
     )
-    response = client.chat.completions.create(
-        model= args.deployment, #"gpt-35-turbo-instruct", # model = "deployment_name".
-        messages=[
-            {"role": "system", "content": "You're the best experienced mountain tour guide. For customer's satisfaction, check the given info. you need to suggest the best mountains and the car park for the customer. considering points are shorter transport from the customer to the park, better review commented mountain in the given mountain records, smaller dangerousnes, better sceneic experience. You need to output several candidates of recommended mountains and explain what's the points of the recommendations. Output is in Japanese. Expect to output top 5 mountain candidates."},
-            {"role": "user", "content": "Please suggest recommended mountains from given candidates and the related mountain records including impression.\n"+info}
-        ]
-    )
+    with Tracer.span("request", model=args.deployment):
+        response = client.chat.completions.create(
+            model= args.deployment, #"gpt-35-turbo-instruct", # model = "deployment_name".
+            messages=[
+                {"role": "system", "content": "You're the best experienced mountain tour guide. For customer's satisfaction, check the given info. you need to suggest the best mountains and the car park for the customer. considering points are shorter transport from the customer to the park, better review commented mountain in the given mountain records, smaller dangerousnes, better sceneic experience. You need to output several candidates of recommended mountains and explain what's the points of the recommendations. Output is in Japanese. Expect to output top 5 mountain candidates."},
+                {"role": "user", "content": "Please suggest recommended mountains from given candidates and the related mountain records including impression.\n"+info}
+            ]
+        )
 
     #print(response)
     #print(response.model_dump_json(indent=2))
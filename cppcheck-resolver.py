@@ -0,0 +1,208 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import difflib
+import os
+import sys
+import xml.etree.ElementTree as ET
+from Tracer import Tracer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from GptHelper import GptClientFactory, GptQueryWithCheck, IGpt
+
+
+class CppcheckFinding:
+    def __init__(self, path, line, id, severity, msg):
+        self.path = path
+        self.line = line
+        self.id = id
+        self.severity = severity
+        self.msg = msg
+
+    def __repr__(self):
+        return f"{self.path}:{self.line}: [{self.severity}] {self.id}: {self.msg}"
+
+
+class CppcheckFindingGroup:
+    def __init__(self, path, findings, margin_lines):
+        self.path = path
+        self.findings = findings
+        self.first_line = min(f.line for f in findings)
+        self.last_line = max(f.line for f in findings)
+        # one context window covering all of the findings, same as IGpt.files_reader(["path:center"], margin)
+        self.center_line = (self.first_line + self.last_line) // 2
+        self.margin_lines = (self.last_line - self.first_line + 1) // 2 + margin_lines
+        # (start_pos, end_pos, new lines) of the window
+        self.resolution = None
+
+    def get_window(self, lines):
+        start_pos = max(self.center_line - self.margin_lines, 0)
+        end_pos = min(self.center_line + self.margin_lines, len(lines))
+        return start_pos, end_pos
+
+    def __repr__(self):
+        return f"{self.path}:{self.first_line}-{self.last_line} ({len(self.findings)} findings)"
+
+
+class CppcheckReport:
+    @staticmethod
+    def parse(path, severities=None, base_dir=None):
+        findings = []
+        root = ET.parse(path).getroot()
+        for error in root.iter("error"):
+            severity = error.get("severity", "")
+            if severities and severity not in severities:
+                continue
+            locations = error.findall("location")
+            if not locations:
+                continue
+            # cppcheck's xml v2 writes the call stack in reverse: the first one is the error, the rest are the notes
+            location = locations[0]
+            file_path = location.get("file")
+            if base_dir and not os.path.isabs(file_path):
+                file_path = os.path.join(base_dir, file_path)
+            findings.append( CppcheckFinding(file_path, int(location.get("line", 0)), error.get("id"), severity, error.get("verbose") or error.get("msg", "")) )
+        return findings
+
+    @staticmethod
+    def group(findings, margin_lines=10, max_findings=10):
+        # findings within the margin of each other share one request
+        per_file = {}
+        for finding in findings:
+            per_file.setdefault(finding.path, []).append(finding)
+
+        groups = []
+        for path, file_findings in per_file.items():
+            file_findings.sort(key=lambda f: f.line)
+            current = []
+            for finding in file_findings:
+                if current and (finding.line - current[-1].line > margin_lines * 2 or len(current) >= max_findings):
+                    groups.append( CppcheckFindingGroup(path, current, margin_lines) )
+                    current = []
+                current.append(finding)
+            if current:
+                groups.append( CppcheckFindingGroup(path, current, margin_lines) )
+        return groups
+
+
+class CppcheckResolver(GptQueryWithCheck):
+    def __init__(self, client, promptfile, group, candidates=1):
+        super().__init__(client, promptfile, candidates=candidates)
+        self.group = group
+
+    def is_ok_query_result(self, query_result):
+        if not query_result or "```" not in query_result:
+            return False
+        return len(max(IGpt.get_code_sections(query_result), key=len)) > 0
+
+    def resolve(self):
+        with open(self.group.path, 'r', encoding='UTF-8') as f:
+            content = f.read()
+        lines = content.splitlines()
+        start_pos, end_pos = self.group.get_window(lines)
+
+        report = "\n".join([f"line {f.line}: [{f.severity}] {f.id}: {f.msg}" for f in self.group.findings])
+        code = IGpt.files_reader([f"{self.group.path}:{self.group.center_line}"], self.group.margin_lines)
+        additional_prompt = f"{report}\n\n{code}"
+
+        self.user_prompt += additional_prompt
+        content_result, _ = self.query()
+
+        if self.is_ok_query_result(content_result):
+            self.group.resolution = (start_pos, end_pos, max(IGpt.get_code_sections(content_result), key=len))
+        return self.group
+
+    @staticmethod
+    def make_patches(groups):
+        # the resolutions of a file are applied to one working copy, then one diff per file
+        per_file = {}
+        for group in groups:
+            if group.resolution:
+                per_file.setdefault(group.path, []).append(group)
+
+        patches = []
+        for path, file_groups in per_file.items():
+            with open(path, 'r', encoding='UTF-8') as f:
+                lines = f.read().splitlines()
+            new_lines = []
+            pos = 0
+            for group in sorted(file_groups, key=lambda g: g.resolution[0]):
+                start_pos, end_pos, resolution = group.resolution
+                if start_pos < pos:
+                    # the window overlaps the applied one
+                    print(f"WARNING: {group} is skipped since it overlaps the other resolution", file=sys.stderr)
+                    group.resolution = None
+                    continue
+                new_lines += lines[pos:start_pos] + resolution
+                pos = end_pos
+            new_lines += lines[pos:]
+            patches.append("".join(difflib.unified_diff(
+                [l + "\n" for l in lines], [l + "\n" for l in new_lines],
+                fromfile="a/" + os.path.relpath(path), tofile="b/" + os.path.relpath(path))))
+        return patches
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Resolve cppcheck report in batch')
+    parser.add_argument('args', nargs='*', help='cppcheck xml report(s) (cppcheck --xml 2> report.xml)')
+
+    parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3')
+    parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible or router (backends in LLM_ROUTER)')
+
+    parser.add_argument('-k', '--apikey', action='store', default=None, help='specify your API key or set it in AZURE_OPENAI_API_KEY env')
+    parser.add_argument('-y', '--secretkey', action='store', default=os.getenv("AWS_SECRET_ACCESS_KEY"), help='specify your secret key or set it in AWS_SECRET_ACCESS_KEY env (for claude3)')
+    parser.add_argument('-e', '--endpoint', action='store', default=None, help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
+    parser.add_argument('-d', '--deployment', action='store', default=None, help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env')
+    parser.add_argument('-p', '--promptfile', action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cppcheck_resolver.json"), help='specify prompt.json')
+    parser.add_argument('-H', '--header', action='append', default=[], help='Specify headers for http e.g. header_key:value (multiple --header are ok)')
+
+    parser.add_argument('-b', '--basedir', action='store', default=None, help='specify base directory of the relative paths in the report')
+    parser.add_argument('-m', '--margin', action='store', type=int, default=10, help='specify margin lines around the findings')
+    parser.add_argument('-f', '--maxfindings', action='store', type=int, default=10, help='specify max findings per request')
+    parser.add_argument('-s', '--severity', action='store', default="error,warning,style,performance,portability", help='specify target severities with ,')
+    parser.add_argument('-j', '--parallel', action='store', type=int, default=8, help='specify number of concurrent requests')
+    parser.add_argument('--candidates', action='store', type=int, default=1, help='specify number of resolutions requested at once in each try to use the first valid one')
+    parser.add_argument('-o', '--output', action='store', default=None, help='specify output patch file (default: stdout)')
+
+    Tracer.add_arguments(parser)
+    args = parser.parse_args()
+    Tracer.start_from_args(args)
+
+    findings = []
+    with Tracer.span("parse_report"):
+        for report in args.args:
+            findings.extend( CppcheckReport.parse(report, set(args.severity.split(",")), args.basedir) )
+        findings = [f for f in findings if os.path.exists(f.path)]
+        groups = CppcheckReport.group(findings, args.margin, args.maxfindings)
+    print(f"{len(findings)} findings in {len(groups)} requests", file=sys.stderr)
+
+    client = GptClientFactory.new_client(args)
+    done = 0
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = [executor.submit(CppcheckResolver(client, args.promptfile, group, args.candidates).resolve) for group in groups]
+        for future in as_completed(futures):
+            done += 1
+            try:
+                group = future.result()
+                print(f"[{done}/{len(groups)}] {group}: {'resolved' if group.resolution else 'FAILED'}", file=sys.stderr)
+            except Exception as e:
+                print(f"[{done}/{len(groups)}] ERROR: {e}", file=sys.stderr)
+
+    with Tracer.span("print"):
+        patches = CppcheckResolver.make_patches(groups)
+        if args.output:
+            with open(args.output, 'w', encoding='UTF-8') as f:
+                f.write("".join(patches))
+        else:
+            sys.stdout.write("".join(patches))
@@ -0,0 +1,287 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import os
+import sys
+import subprocess
+import tempfile
+from Tracer import Tracer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from GptHelper import GptClientFactory, GptQueryWithCheck, IGpt
+from SingleFlightGpt import SingleFlightGpt
+
+
+class ConflictRegion:
+    def __init__(self, path, start, end, margin_start, margin_end):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.margin_start = margin_start
+        self.margin_end = margin_end
+        self.resolution = None
+
+    def __repr__(self):
+        return f"{self.path}:{self.start+1}-{self.end+1}"
+
+
+class MergeConflictScanner:
+    MARKER_START = "<<<<<<< "
+    MARKER_SEPARATOR = "======="
+    MARKER_END = ">>>>>>> "
+
+    @staticmethod
+    def has_conflict_markers(lines):
+        for line in lines:
+            if line.startswith(("<<<<<<<", ">>>>>>>")) or line.rstrip()==MergeConflictScanner.MARKER_SEPARATOR:
+                return True
+        return False
+
+    @staticmethod
+    def get_conflicted_files(root):
+        # git knows the unmerged paths, otherwise scan the whole tree
+        try:
+            result = subprocess.run(["git", "diff", "--name-only", "--relative", "--diff-filter=U"], cwd=root, capture_output=True, text=True, check=True)
+            files = [os.path.join(root, f) for f in result.stdout.splitlines() if f]
+            if files:
+                return files
+        except (OSError, subprocess.CalledProcessError):
+            pass
+        files = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d!=".git"]
+            for filename in filenames:
+                files.append(os.path.join(dirpath, filename))
+        return files
+
+    @staticmethod
+    def read_lines(path):
+        try:
+            with open(path, 'r', encoding='UTF-8') as f:
+                return f.read().splitlines()
+        except (UnicodeDecodeError, OSError):
+            return None
+
+    @staticmethod
+    def scan(path, lines, margin_lines=10):
+        regions = []
+        start = None
+        for i, line in enumerate(lines):
+            if line.startswith(MergeConflictScanner.MARKER_START):
+                start = i
+            elif start!=None and line.startswith(MergeConflictScanner.MARKER_END):
+                margin_start = max(start - margin_lines, 0)
+                margin_end = min(i + 1 + margin_lines, len(lines))
+                if regions and margin_start <= regions[-1].margin_end:
+                    # merge the adjacent conflicts into one region not to overlap the replacement
+                    regions[-1].end = i
+                    regions[-1].margin_end = margin_end
+                else:
+                    regions.append( ConflictRegion(path, start, i, margin_start, margin_end) )
+                start = None
+        return regions
+
+
+class MergeConflictResolver(GptQueryWithCheck):
+    def __init__(self, client, prompt, region, lines, candidates=1):
+        super().__init__(client, candidates=candidates)
+        self.system_prompt = prompt.get("system_prompt", "")
+        self.user_prompt = prompt.get("user_prompt", "")
+        self.region = region
+        self.lines = lines
+
+    @staticmethod
+    def get_bracket_balance(lines):
+        balance = 0
+        for line in lines:
+            balance += line.count("(") + line.count("{") + line.count("[") - line.count(")") - line.count("}") - line.count("]")
+        return balance
+
+    def get_sides(self):
+        # HEAD side and upstream side of the region with the margin lines
+        ours = []
+        theirs = []
+        state = None
+        for line in self.lines[self.region.margin_start:self.region.margin_end]:
+            if line.startswith(MergeConflictScanner.MARKER_START):
+                state = "ours"
+            elif state and line.rstrip()==MergeConflictScanner.MARKER_SEPARATOR:
+                state = "theirs"
+            elif state and line.startswith(MergeConflictScanner.MARKER_END):
+                state = None
+            elif state=="ours":
+                ours.append(line)
+            elif state=="theirs":
+                theirs.append(line)
+            else:
+                ours.append(line)
+                theirs.append(line)
+        return ours, theirs
+
+    def get_resolution(self, query_result):
+        if not query_result:
+            return None
+        sections = IGpt.get_code_sections(query_result)
+        return max(sections, key=len) if sections else None
+
+    def is_ok_query_result(self, query_result):
+        resolution = self.get_resolution(query_result)
+        if not resolution or MergeConflictScanner.has_conflict_markers(resolution):
+            return False
+        # syntax check: the resolution must not break the bracket structure of both sides
+        ours, theirs = self.get_sides()
+        balance = self.get_bracket_balance(resolution)
+        return balance in (self.get_bracket_balance(ours), self.get_bracket_balance(theirs))
+
+    def is_ok_stream_result(self, partial_result):
+        pos = partial_result.find("```")
+        if pos < 0:
+            # the answer is expected to be quoted by ```
+            return False if len(partial_result) > 2000 else None
+        code = partial_result[pos:]
+        if MergeConflictScanner.has_conflict_markers(code.splitlines()[1:]):
+            return False
+        if code.count("```") >= 2:
+            return True
+        return None
+
+    def resolve(self):
+        conflict = "\n".join(self.lines[self.region.margin_start:self.region.margin_end])
+        content, _ = self.query({"[MERGE_CONFLICT]": conflict})
+        if self.is_ok_query_result(content):
+            self.region.resolution = self.get_resolution(content)
+        return self.region
+
+
+class MergeConflictResolutionEngine:
+    def __init__(self, client, prompt, margin_lines=10, max_workers=8, is_replace_allowed=True, candidates=1):
+        self.client = SingleFlightGpt(client)
+        self.candidates = candidates
+        self.prompt = prompt
+        self.margin_lines = margin_lines
+        self.max_workers = max_workers
+        self.is_replace_allowed = is_replace_allowed
+
+    @staticmethod
+    def is_syntax_ok(path, lines):
+        # whole file check is only possible when all of the conflicts in the file are resolved
+        if path.endswith(".py") and not MergeConflictScanner.has_conflict_markers(lines):
+            try:
+                compile("\n".join(lines) + "\n", path, "exec")
+            except SyntaxError:
+                return False
+        return True
+
+    @staticmethod
+    def write_atomically(path, lines, newline_at_end=True):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".merge-resolver-")
+        try:
+            with os.fdopen(fd, 'w', encoding='UTF-8') as f:
+                f.write("\n".join(lines) + ("\n" if newline_at_end else ""))
+            os.chmod(tmp_path, os.stat(path).st_mode)
+            os.replace(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def apply(self, path, lines, regions):
+        # replace from the bottom not to shift the line numbers of the other regions
+        new_lines = list(lines)
+        resolved = 0
+        for region in sorted(regions, key=lambda r: r.margin_start, reverse=True):
+            if region.resolution is not None:
+                new_lines[region.margin_start:region.margin_end] = region.resolution
+                resolved += 1
+        if not resolved or not self.is_syntax_ok(path, new_lines):
+            return 0
+        if self.is_replace_allowed:
+            with open(path, 'r', encoding='UTF-8') as f:
+                newline_at_end = f.read().endswith("\n")
+            self.write_atomically(path, new_lines, newline_at_end)
+        return resolved
+
+    def execute(self, files):
+        targets = {}
+        for path in files:
+            lines = MergeConflictScanner.read_lines(path)
+            if lines:
+                regions = MergeConflictScanner.scan(path, lines, self.margin_lines)
+                if regions:
+                    targets[path] = (lines, regions)
+
+        total = sum(len(regions) for _, regions in targets.values())
+        print(f"{total} conflict regions in {len(targets)} files", file=sys.stderr)
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            for path, (lines, regions) in targets.items():
+                for region in regions:
+                    resolver = MergeConflictResolver(self.client, self.prompt, region, lines, self.candidates)
+                    futures.append( executor.submit(resolver.resolve) )
+            for future in as_completed(futures):
+                region = future.result()
+                done += 1
+                status = "resolved" if region.resolution is not None else "FAILED"
+                print(f"[{done}/{total}] {region}: {status}", file=sys.stderr)
+
+        results = {}
+        for path, (lines, regions) in targets.items():
+            results[path] = (self.apply(path, lines, regions), len(regions))
+        return results
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Resolve merge conflicts in the working tree in parallel')
+    parser.add_argument('args', nargs='*', help='files or directories (default: unmerged files in the current git working tree)')
+
+    parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3')
+    parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible or router (backends in LLM_ROUTER)')
+
+    parser.add_argument('-k', '--apikey', action='store', default=None, help='specify your API key or set it in AZURE_OPENAI_API_KEY env')
+    parser.add_argument('-y', '--secretkey', action='store', default=os.getenv("AWS_SECRET_ACCESS_KEY"), help='specify your secret key or set it in AWS_SECRET_ACCESS_KEY env (for claude3)')
+    parser.add_argument('-e', '--endpoint', action='store', default=None, help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
+    parser.add_argument('-d', '--deployment', action='store', default=None, help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env')
+    parser.add_argument('-p', '--promptfile', action='store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "git_merge_conflict_resolution_for_upstream_integration2.json"), help='specify prompt.json including [MERGE_CONFLICT]')
+    parser.add_argument('-H', '--header', action='append', default=[], help='Specify headers for http e.g. header_key:value (multiple --header are ok)')
+
+    parser.add_argument('-m', '--margin', action='store', type=int, default=10, help='specify margin lines around the conflict')
+    parser.add_argument('-j', '--parallel', action='store', type=int, default=8, help='specify number of concurrent resolutions')
+    parser.add_argument('--candidates', action='store', type=int, default=1, help='specify number of resolutions requested at once in each try to use the first valid one')
+    parser.add_argument('-n', '--dryrun', action='store_true', default=False, help='specify if you don\'t want to write the resolution')
+
+    Tracer.add_arguments(parser)
+    args = parser.parse_args()
+    Tracer.start_from_args(args)
+
+    prompt, _ = IGpt.read_prompt_json(args.promptfile)
+    is_replace_allowed = str(prompt.get("is_replace_allowed", "true")).lower()=="true" and not args.dryrun
+    prompt = prompt.get("resolver", prompt)
+
+    files = []
+    with Tracer.span("scan"):
+        for path in args.args if args.args else [os.getcwd()]:
+            if os.path.isdir(path):
+                files.extend( MergeConflictScanner.get_conflicted_files(path) )
+            else:
+                files.append(path)
+
+    client = GptClientFactory.new_client(args)
+    engine = MergeConflictResolutionEngine(client, prompt, args.margin, args.parallel, is_replace_allowed, args.candidates)
+    results = engine.execute(files)
+
+    for path, (resolved, total) in results.items():
+        print(f"{path}: {resolved}/{total} {'written' if resolved and is_replace_allowed else 'not written'}")
+    print(f"saved calls: {engine.client.get_stats()['saved_calls']}", file=sys.stderr)
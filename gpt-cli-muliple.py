@@ -17,7 +17,11 @@ import os
 import sys
 import json
 import select
+from Tracer import Tracer
+from GptDaemon import GptDaemonClient
+GptDaemonClient.forward_if_enabled(__name__, __file__)
 from openai import AzureOpenAI
+from JobJournal import JobJournal
 
 class GptHelper:
     def __init__(self, api_key, endpoint, api_version = "2024-02-01", model = "gpt-35-turbo-instruct"):
@@ -29,10 +33,11 @@ class GptHelper:
         self.model = model
 
     def query(self, _messages):
-        response = self.client.chat.completions.create(
-            model= self.model,
-            messages = _messages
-        )
+        with Tracer.span("request", model=self.model):
+            response = self.client.chat.completions.create(
+                model= self.model,
+                messages = _messages
+            )
         return response
 
 
@@ -40,10 +45,11 @@ class GptHelper:
     def files_reader(files):
         result = ""
 
-        for path in files:
-            if os.path.exists( path ):
-              with open(path, 'r', encoding='UTF-8') as f:
-                result += f.read()
+        with Tracer.span("files_reader", files=len(files)):
+            for path in files:
+                if os.path.exists( path ):
+                  with open(path, 'r', encoding='UTF-8') as f:
+                    result += f.read()
 
         return result
 
@@ -90,14 +96,10 @@ if __name__=="__main__":
     parser.add_argument('-u', '--prompt', action='store', default=None, help='specify prompt')
     parser.add_argument('-p', '--promptfile', action='store', default=None, help='specify prompt.json')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='enable verbose')
+    parser.add_argument('-j', '--journal', action='store', default=None, help='specify job journal path to query each file separately and skip the completed files at rerun')
+    Tracer.add_arguments(parser)
     args = parser.parse_args()
-
-    additional_prompt = ""
-    if len(args.args) > 0:
-        additional_prompt = GptHelper.files_reader(args.args)
-    else:
-        if select.select([sys.stdin], [], [], 0.0)[0]:
-            additional_prompt = sys.stdin.read()
+    Tracer.start_from_args(args)
 
     system_prompt, user_prompt = GptHelper.read_prompt_json(args.promptfile)
 
@@ -107,10 +109,34 @@ if __name__=="__main__":
     if args.prompt is not None:
         user_prompt = str(args.prompt)
 
-    user_prompt = user_prompt + "\n" +additional_prompt
-
     client = GptHelper(args.apikey, args.endpoint, "2024-02-01", args.deployment)
 
+    if args.journal and len(args.args) > 0:
+        # one work unit per file. the completed files with the same input are skipped at rerun
+        with JobJournal(args.journal) as journal:
+            for path in args.args:
+                _messages = []
+                if system_prompt:
+                    _messages.append( {"role": "system", "content": system_prompt} )
+                _messages.append( {"role": "user", "content": user_prompt + "\n" + GptHelper.files_reader([path])} )
+                try:
+                    result = journal.run(path, JobJournal.make_hash(args.deployment, _messages), lambda: client.query(_messages).choices[0].message.content)
+                    print(f"# {path}\n{result}\n")
+                except Exception as e:
+                    print(f"ERROR!!!: {path}: {e}", file=sys.stderr)
+            print(f"journal: {journal.get_stats()}", file=sys.stderr)
+        sys.exit(0)
+
+    additional_prompt = ""
+    if len(args.args) > 0:
+        additional_prompt = GptHelper.files_reader(args.args)
+    else:
+        if select.select([sys.stdin], [], [], 0.0)[0]:
+            with Tracer.span("read_stdin"):
+                additional_prompt = sys.stdin.read()
+
+    user_prompt = user_prompt + "\n" +additional_prompt
+
     _messages = []
     if system_prompt:
         _messages.append( {"role": "system", "content": system_prompt} )
@@ -118,7 +144,8 @@ if __name__=="__main__":
         _messages.append( {"role": "user", "content": user_prompt} )
 
     response = client.query(_messages)
-    print(response.choices[0].message.content)
+    with Tracer.span("print"):
+        print(response.choices[0].message.content)
 
     if response and args.verbose:
         print("")
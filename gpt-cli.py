@@ -17,15 +17,19 @@ import os
 import sys
 import json
 import select
+from Tracer import Tracer
+from GptDaemon import GptDaemonClient
+GptDaemonClient.forward_if_enabled(__name__, __file__)
 from openai import AzureOpenAI
 
 def files_reader(files):
     result = ""
 
-    for path in files:
-        if os.path.exists( path ):
-          with open(path, 'r', encoding='UTF-8') as f:
-            result += f.read()
+    with Tracer.span("files_reader", files=len(files)):
+        for path in files:
+            if os.path.exists( path ):
+              with open(path, 'r', encoding='UTF-8') as f:
+                result += f.read()
 
     return result
 
@@ -54,14 +58,17 @@ if __name__=="__main__":
     parser.add_argument('-u', '--prompt', action='store', default=None, help='specify prompt')
     parser.add_argument('-p', '--promptfile', action='store', default=None, help='specify prompt.json')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='enable verbose')
+    Tracer.add_arguments(parser)
     args = parser.parse_args()
+    Tracer.start_from_args(args)
 
     additional_prompt = ""
     if len(args.args) > 0:
         additional_prompt = files_reader(args.args)
     else:
         if select.select([sys.stdin], [], [], 0.0)[0]:
-            additional_prompt = sys.stdin.read()
+            with Tracer.span("read_stdin"):
+                additional_prompt = sys.stdin.read()
 
     system_prompt, user_prompt = read_prompt_json(args.promptfile)
 
@@ -85,12 +92,14 @@ if __name__=="__main__":
     if user_prompt:
         _messages.append( {"role": "user", "content": user_prompt} )
 
-    response = client.chat.completions.create(
-        model= args.deployment, #"gpt-35-turbo-instruct", # model = "deployment_name".
-        messages = _messages
-    )
+    with Tracer.span("request", model=args.deployment):
+        response = client.chat.completions.create(
+            model= args.deployment, #"gpt-35-turbo-instruct", # model = "deployment_name".
+            messages = _messages
+        )
 
-    print(response.choices[0].message.content)
+    with Tracer.span("print"):
+        print(response.choices[0].message.content)
 
     if response and args.verbose:
         print("")
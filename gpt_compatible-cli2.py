@@ -16,18 +16,27 @@ import argparse
 import os
 import sys
 import json
+from Tracer import Tracer
 import requests
 import select
+from EndpointPool import EndpointPool
+from StreamDecoder import StreamDecoder
+from Deadline import Deadline
+from GptSession import GptSession
 import base64
 import mimetypes
 import io
 from PIL import Image
 
 class OpenAICompatibleLLM:
-    def __init__(self, api_key, endpoint, is_streaming):
+    def __init__(self, api_key, endpoint, is_streaming, keep_alive=None, slots=0):
         self.api_key = api_key
         self.endpoint = endpoint
         self.is_streaming = is_streaming
+        self.keep_alive = keep_alive
+        self.slots = slots
+        self.pool = EndpointPool(EndpointPool.parse(endpoint))
+        self.session = EndpointPool.new_session()
 
     def _create_header_and_payload(self, messages, model=None):
         headers = {
@@ -44,48 +53,70 @@ class OpenAICompatibleLLM:
             payload["model"] = model
         return headers, payload
 
-    def create_chat_completion(self, messages, model=None):
+    def create_chat_completion(self, messages, model=None, session_id=None):
         headers, payload  = self._create_header_and_payload(messages, model)
 
         if "/api/chat" in self.endpoint or self.is_streaming:
-            # streaming mode (ollama mode)
             payload["stream"] = True
-            
-            r = requests.post(self.endpoint, headers=headers, json=payload, stream=True)
-            r.raise_for_status()
-            output = ""
-            for line in r.iter_lines():
-                body = json.loads(line)
-                if "error" in body:
-                    raise Exception(body["error"])
-                if body.get("done") is False:
-                    message = body.get("message", "")
-                    content = message.get("content", "")
-                    output += content
-
-                if body.get("done", False):
-                    message = body
-                    message["content"] = output
-                    return output, message
+        # keep the server's KV cache of the conversation for the next turn
+        if self.keep_alive and "/api/chat" in self.endpoint:
+            payload["keep_alive"] = self.keep_alive
+        if self.slots:
+            payload["cache_prompt"] = True
+            if session_id:
+                payload["id_slot"] = GptSession.get_slot(session_id, self.slots)
+
+        with Tracer.span("serialize"):
+            data = json.dumps(payload).encode("utf-8")
+
+        return self.pool.run(lambda endpoint: self._post(endpoint, headers, data, payload.get("stream")))
+
+    def _post(self, endpoint, headers, data, is_streaming=False):
+        deadline = Deadline.current()
+        timeout = deadline.get_timeout() if deadline else (Deadline.CONNECT_TIMEOUT, Deadline.READ_TIMEOUT)
+        if is_streaming:
+            # streaming mode (ollama mode)
+            with Tracer.span("request", endpoint=endpoint):
+                r = self.session.post(endpoint, headers=headers, data=data, stream=True, timeout=timeout)
+            with r, Tracer.span("stream"):
+                r.raise_for_status()
+                if deadline:
+                    with deadline.watch(Deadline.get_closer(r)):
+                        return StreamDecoder.decode_chat_stream(r, deadline.wrap_callback(None))
+                return StreamDecoder.decode_chat_stream(r)
 
         else:
             # non-streaming mode
-            response = requests.post(self.endpoint, headers=headers, json=payload)
+            with Tracer.span("request", endpoint=endpoint):
+                response = self.session.post(endpoint, headers=headers, data=data, timeout=timeout)
             if response.status_code == 200:
-                response_json = response.json()
+                with Tracer.span("decode"):
+                    response_json = response.json()
                 main_message = response_json['choices'][0]['message']['content']
                 return main_message, response_json
             else:
+                response.raise_for_status()
                 raise Exception(f"Error: {response.status_code} - {response.text}")
 
         return None, None
 
+def get_usage(response):
+    # OpenAI compatible, ollama and llama.cpp (timings.cache_n is the prompt tokens reused from the KV cache)
+    usage = response.get("usage") or {}
+    timings = response.get("timings") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens", response.get("prompt_eval_count")),
+        "completion_tokens": usage.get("completion_tokens", response.get("eval_count")),
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", timings.get("cache_n")),
+    }
+
 def files_reader(files):
     result = ""
-    for path in files:
-        if os.path.exists(path):
-            with open(path, 'r', encoding='UTF-8') as f:
-                result += f.read()
+    with Tracer.span("files_reader", files=len(files)):
+        for path in files:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='UTF-8') as f:
+                    result += f.read()
     return result
 
 def read_prompt_json(path):
@@ -152,7 +183,8 @@ def get_message_for_attachments(user_prompt, file_paths, max_size=320):
     for file_path in file_paths:
         if os.path.exists(file_path):
             file_type = get_file_type(file_path)
-            base64_data, ext = get_base64_and_ext_body_or_shrinked_image(file_path, max_size)
+            with Tracer.span("encode_attachment", path=file_path):
+                base64_data, ext = get_base64_and_ext_body_or_shrinked_image(file_path, max_size)
             if file_type == "image":
                 body_images.append(base64_data)
             else:
@@ -179,7 +211,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='General LLM client for OpenAI compatible web API')
     parser.add_argument('args', nargs='*', help='files')
     parser.add_argument('-k', '--apikey', action='store', default=os.getenv("LLM_API_KEY"), help='specify your API key or set it in LLM_API_KEY env')
-    parser.add_argument('-e', '--endpoint', action='store', default=os.getenv("LLM_ENDPOINT"), help='specify your end point (e.g. http://localhost:8080/v1/chat/completions ) or set it in LLM_ENDPOINT env')
+    parser.add_argument('-e', '--endpoint', action='store', default=os.getenv("LLM_ENDPOINT"), help='specify your end point (e.g. http://localhost:8080/v1/chat/completions ) or set it in LLM_ENDPOINT env. multiple replicas can be specified with ,')
     parser.add_argument('-d', '--deployment', action='store', default=os.getenv("LLM_DEPLOYMENT_NAME"), help='optional. specify deployment name(model) or set it in LLM_DEPLOYMENT_NAME env')
     parser.add_argument('-s', '--systemprompt', action='store', default=None, help='specify system prompt if necessary')
     parser.add_argument('-u', '--prompt', action='store', default=None, help='specify prompt')
@@ -187,14 +219,21 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--stream', action='store_true', default=False, help='specify if streaming mode is necessary (e.g. ollam)')
     parser.add_argument('-a', '--attach', action='append', default=[], help='Attachment files such as hoge.jpg')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='enable verbose')
+    parser.add_argument('--session', action='store', default=None, help='specify session file to continue the conversation. the history is sent as the same prefix to reuse the server\'s KV cache')
+    parser.add_argument('--keepalive', action='store', default=os.getenv("LLM_KEEP_ALIVE"), help='specify duration for ollama to keep the model loaded (e.g. 30m) or set it in LLM_KEEP_ALIVE env')
+    parser.add_argument('--slots', action='store', type=int, default=int(os.getenv("LLM_SLOTS", "0")), help='specify number of llama.cpp server slots (-np) to pin the session to its slot or set it in LLM_SLOTS env')
+    parser.add_argument('-t', '--timeout', action='store', type=float, default=None, help='specify seconds to give up the request including the failover (default: no deadline)')
+    Tracer.add_arguments(parser)
     args = parser.parse_args()
+    Tracer.start_from_args(args)
 
     additional_prompt = ""
     if len(args.args) > 0:
         additional_prompt = files_reader(args.args)
     else:
         if select.select([sys.stdin], [], [], 0.0)[0]:
-            additional_prompt = sys.stdin.read()
+            with Tracer.span("read_stdin"):
+                additional_prompt = sys.stdin.read()
 
     system_prompt, user_prompt = read_prompt_json(args.promptfile)
 
@@ -206,11 +245,16 @@ if __name__ == "__main__":
 
     user_prompt = user_prompt + "\n" + additional_prompt
 
-    service = OpenAICompatibleLLM(api_key=args.apikey, endpoint=args.endpoint, is_streaming=args.stream)
+    service = OpenAICompatibleLLM(api_key=args.apikey, endpoint=args.endpoint, is_streaming=args.stream, keep_alive=args.keepalive, slots=args.slots)
+    session = GptSession(path=args.session) if args.session else None
 
     messages = []
     if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
+        if session:
+            session.set_system_prompt(system_prompt)
+        else:
+            messages.append({"role": "system", "content": system_prompt})
+    user_message = None
     if args.attach:
         attachments = []
         for an_attach in args.attach:
@@ -218,13 +262,22 @@ if __name__ == "__main__":
             if os.path.exists(an_attach):
                 attachments.append(an_attach)
         if attachments:
-            messages.append(get_message_for_attachments(user_prompt, attachments))
+            user_message = get_message_for_attachments(user_prompt, attachments)
     elif user_prompt:
-        messages.append({"role": "user", "content": user_prompt})
+        user_message = {"role": "user", "content": user_prompt}
+    if session and user_message:
+        # the new turn is appended after the history
+        messages = session.get_messages(user_message)
+    elif user_message:
+        messages.append(user_message)
 
     try:
-        response_content, response = service.create_chat_completion(messages=messages, model=args.deployment)
-        print(response_content)
+        with Deadline(args.timeout).activate():
+            response_content, response = service.create_chat_completion(messages=messages, model=args.deployment, session_id=session.session_id if session else None)
+        if session and response_content is not None:
+            session.add_turn(messages[-1], response_content, get_usage(response) if response else None)
+        with Tracer.span("print"):
+            print(response_content)
         if response and args.verbose:
             print("")
             if "id" in response:
@@ -239,5 +292,11 @@ if __name__ == "__main__":
                     print(f'completion_tokens: {usage["completion_tokens"]}')
                 if "total_tokens" in usage:
                     print(f'total_tokens: {usage["total_tokens"]}')
+            cached_tokens = get_usage(response)["cached_tokens"]
+            if cached_tokens is not None:
+                print(f'cached_tokens: {cached_tokens}')
+            if session:
+                stats = session.get_stats()
+                print(f'session: {stats["turns"]} turns, cached {stats["cached_tokens"]}/{stats["prompt_tokens"]} prompt tokens')
     except Exception as e:
         print(e)
@@ -13,48 +13,200 @@
 #   limitations under the License.
 
 import argparse
+import hashlib
 import os
 import sys
+import threading
+from Tracer import Tracer
 from openai import AzureOpenAI
+from JobJournal import JobJournal
 
 def files_reader(files):
     result = ""
 
-    for path in files:
-        if os.path.exists( path ):
-          with open(path, 'r', encoding='UTF-8') as f:
-            result += f.read()
-            f.close()
+    with Tracer.span("files_reader", files=len(files)):
+        for path in files:
+            if os.path.exists( path ):
+              with open(path, 'r', encoding='UTF-8') as f:
+                result += f.read()
+                f.close()
 
     return result
 
+DIFF_PROMPT = "The following is the diff with the enclosing definitions of the changes and the signatures of the referenced definitions. Please focus on the changed lines (- and +).\n"
+
+def get_messages(codes):
+    return [
+        {"role": "system", "content": "You're the world class best programmer and you're doing pair programming. You're requeted to code-review. You need pointed out what's problem, the potential risk and the future expansion. And you need to explain how to solve with expected examples. Example code is expected as diff output manner as -:original code +:modified code"},
+        {"role": "user", "content": "Please review the following code and please explain the problem and please show the better code about the problematic part.\n"+codes}
+    ]
+
+def get_diff_contexts(diff_text, is_each=False):
+    # only the hunks with the enclosing definitions instead of the whole files
+    from DiffContext import DiffContext
+    with Tracer.span("diff_context"):
+        context = DiffContext.new_for_repo()
+        search_paths = DiffContext.get_git_files(context.base_dir)
+        if is_each:
+            return {path: DIFF_PROMPT + text for path, text in context.build_each(diff_text, search_paths).items()}
+        return DIFF_PROMPT + context.build(diff_text, search_paths)
+
+def review(client, deployment, codes):
+    with Tracer.span("request", model=deployment):
+        response = client.chat.completions.create(
+            model= deployment, #"gpt-35-turbo-instruct", # model = "deployment_name".
+            messages=get_messages(codes)
+        )
+
+    #print(response)
+    #print(response.model_dump_json(indent=2))
+    return response.choices[0].message.content
+
+def review_streaming(client, deployment, codes, callback):
+    # callback(delta) returns False to cancel the review
+    stream = client.chat.completions.create(
+        model= deployment,
+        messages=get_messages(codes),
+        stream=True
+    )
+    result = ""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            result += chunk.choices[0].delta.content
+            if callback(chunk.choices[0].delta.content) is False:
+                stream.close()
+                return None
+    return result
+
+
+class ReviewWatcher:
+    def __init__(self, client, deployment):
+        self.client = client
+        self.deployment = deployment
+        self.hashes = {}
+        self.in_flight = {}
+        self._lock = threading.Lock()
+        self._print_lock = threading.Lock()
+
+    def _print(self, path, line):
+        with self._print_lock:
+            print(f"[{os.path.relpath(path)}] {line}", flush=True)
+
+    def set_initial_hashes(self, paths):
+        # the files aren't reviewed until the content is changed
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    self.hashes[path] = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                pass
+
+    def on_change(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            codes = data.decode("utf-8")
+        except (OSError, UnicodeDecodeError):
+            return
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if self.hashes.get(path) == content_hash:
+                return
+            self.hashes[path] = content_hash
+            # the newer version supersedes the in-flight review of the file
+            cancel = self.in_flight.get(path)
+            if cancel:
+                cancel.set()
+            cancel = self.in_flight[path] = threading.Event()
+        threading.Thread(target=self._review, args=(path, codes, cancel), daemon=True).start()
+
+    def _review(self, path, codes, cancel):
+        pending = {"text": ""}
+
+        def _callback(delta):
+            if cancel.is_set():
+                return False
+            lines = (pending["text"] + delta).split("\n")
+            pending["text"] = lines.pop()
+            for line in lines:
+                self._print(path, line)
+
+        self._print(path, "--- reviewing ---")
+        try:
+            result = review_streaming(self.client, self.deployment, codes, _callback)
+            if result is None:
+                self._print(path, "--- cancelled by the newer version ---")
+            elif pending["text"]:
+                self._print(path, pending["text"])
+        except Exception as e:
+            self._print(path, f"ERROR!!!: {e}")
+        with self._lock:
+            if self.in_flight.get(path) is cancel:
+                del self.in_flight[path]
+
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='Code review specified file with OpenAI LLM')
     parser.add_argument('args', nargs='*', help='files')
     parser.add_argument('-k', '--apikey', action='store', default=os.getenv("AZURE_OPENAI_API_KEY"), help='specify your API key or set it in AZURE_OPENAI_API_KEY env')
     parser.add_argument('-e', '--endpoint', action='store', default=os.getenv("AZURE_OPENAI_ENDPOINT"), help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
     parser.add_argument('-d', '--deployment', action='store', default=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"), help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env')
+    parser.add_argument('-j', '--journal', action='store', default=None, help='specify job journal path to review each file separately and skip the reviewed files at rerun')
+    parser.add_argument('-w', '--watch', action='store_true', default=False, help='specify to watch the files or directories and review the changed file on each save')
+    parser.add_argument('--debounce', action='store', type=float, default=0.3, help='specify seconds to wait the burst of saves in --watch')
+    parser.add_argument('--diff', action='store_true', default=False, help='specify if the input (files or stdin) is unified diff (e.g. git diff | llm-review.py --diff) to review the changes with the enclosing definitions')
+    Tracer.add_arguments(parser)
     args = parser.parse_args()
-
-    codes = ""
-    if len(args.args)>0:
-        codes = files_reader(args.args)
-    else:
-        codes = sys.stdin.read()
+    Tracer.start_from_args(args)
 
     client = AzureOpenAI(
       api_key = args.apikey,  
       api_version = "2024-02-01",
       azure_endpoint = args.endpoint
     )
-    response = client.chat.completions.create(
-        model= args.deployment, #"gpt-35-turbo-instruct", # model = "deployment_name".
-        messages=[
-            {"role": "system", "content": "You're the world class best programmer and you're doing pair programming. You're requeted to code-review. You need pointed out what's problem, the potential risk and the future expansion. And you need to explain how to solve with expected examples. Example code is expected as diff output manner as -:original code +:modified code"},
-            {"role": "user", "content": "Please review the following code and please explain the problem and please show the better code about the problematic part.\n"+codes}
-        ]
-    )
 
-    #print(response)
-    #print(response.model_dump_json(indent=2))
-    print(response.choices[0].message.content)
\ No newline at end of file
+    if args.watch:
+        from FileWatcher import FileWatcher
+        watcher = FileWatcher(args.args if args.args else [os.getcwd()], args.debounce)
+        reviewer = ReviewWatcher(client, args.deployment)
+        reviewer.set_initial_hashes(watcher.get_targets())
+        print(f"watching {len(watcher.get_targets())} files{'' if watcher.inotify else ' (polling)'}...", file=sys.stderr)
+        try:
+            watcher.watch(reviewer.on_change)
+        except KeyboardInterrupt:
+            pass
+        watcher.close()
+    elif args.diff:
+        diff_text = files_reader(args.args) if len(args.args)>0 else sys.stdin.read()
+        if args.journal:
+            # one work unit per changed file
+            with JobJournal(args.journal) as journal:
+                for path, codes in get_diff_contexts(diff_text, True).items():
+                    try:
+                        result = journal.run(path, JobJournal.make_hash(args.deployment, codes), lambda: review(client, args.deployment, codes))
+                        print(f"# {path}\n{result}\n")
+                    except Exception as e:
+                        print(f"ERROR!!!: {path}: {e}", file=sys.stderr)
+                print(f"journal: {journal.get_stats()}", file=sys.stderr)
+        else:
+            print(review(client, args.deployment, get_diff_contexts(diff_text)))
+    elif args.journal and len(args.args)>0:
+        # one work unit per file. the unchanged files reviewed already are skipped
+        with JobJournal(args.journal) as journal:
+            for path in args.args:
+                codes = files_reader([path])
+                try:
+                    result = journal.run(path, JobJournal.make_hash(args.deployment, codes), lambda: review(client, args.deployment, codes))
+                    print(f"# {path}\n{result}\n")
+                except Exception as e:
+                    print(f"ERROR!!!: {path}: {e}", file=sys.stderr)
+            print(f"journal: {journal.get_stats()}", file=sys.stderr)
+    else:
+        codes = ""
+        if len(args.args)>0:
+            codes = files_reader(args.args)
+        else:
+            with Tracer.span("read_stdin"):
+                codes = sys.stdin.read()
+        result = review(client, args.deployment, codes)
+        with Tracer.span("print"):
+            print(result)
\ No newline at end of file
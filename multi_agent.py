@@ -12,8 +12,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import argparse
+from Tracer import Tracer
 from openai import AzureOpenAI
 import os
+from GptHelper import IGpt
+from GptBudget import GptBudget, BudgetExceededError
+from GptSession import GptSession
 
 client = AzureOpenAI(
     api_version="2023-05-15",
@@ -21,38 +26,59 @@ client = AzureOpenAI(
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
 )
 
-def get_completion(messages, model="gpt-4o"):
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages
-    )
+# LLM_BUDGET_* env stops the loop before it burns the quota
+budget = GptBudget.get_default()
+# prompt tokens served from Azure's prompt cache thanks to the append-only messages
+cache_usage = {"prompt_tokens": 0, "cached_tokens": 0}
+
+def get_completion(messages, model="gpt-4o", job=None):
+    if budget:
+        prompt_tokens = sum(IGpt.estimate_tokens(m["content"]) for m in messages)
+        model, max_prompt_tokens = budget.plan(model, prompt_tokens, job, os.getenv("LLM_BUDGET_FALLBACK_MODEL"))
+        # shrink the context by dropping the oldest memories after the system, the last one is the task
+        while max_prompt_tokens and prompt_tokens > max_prompt_tokens and len(messages) > 2:
+            prompt_tokens -= IGpt.estimate_tokens(messages[1]["content"])
+            messages = messages[:1] + messages[2:]
+    with Tracer.span("request", model=model, job=job):
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages
+        )
+    usage = IGpt.get_usage(response)
+    cache_usage["prompt_tokens"] += usage["prompt_tokens"] or 0
+    cache_usage["cached_tokens"] += usage["cached_tokens"] or 0
+    if budget:
+        budget.charge(model, usage["prompt_tokens"], usage["completion_tokens"], job)
     return response.choices[0].message.content
 
 class Agent:
     def __init__(self, role, description):
         self.role = role
         self.description = description
-        self.memory = []
+        self.session = GptSession(system_prompt=f"You are a {self.role}. {self.description}")
 
     def act(self, task):
-        messages = [
-            {"role": "system", "content": f"You are a {self.role}. {self.description}"},
-            {"role": "user", "content": task}
-        ] + self.memory
-        response = get_completion(messages)
-        self.memory.append({"role": "assistant", "content": response})
+        # the new task is appended after the history, then the previous request is the prefix of this one
+        messages = self.session.get_messages(task)
+        response = get_completion(messages, job=self.role)
+        self.session.add_turn(messages[-1], response)
         return response
 
 def orchestrator(goal, agents):
     overall_memory = []
+    is_stopped = False
     
-    while True:
+    while not is_stopped:
         messages = [
             {"role": "system", "content": "You are an orchestrator. Your job is to coordinate multiple AI agents to achieve a goal."},
             {"role": "user", "content": f"Goal: {goal}\n\nAvailable agents: {', '.join([agent.role for agent in agents])}\n\nDecide the next step and which agent should perform it. If the goal is achieved, respond with 'GOAL ACHIEVED'."}
         ] + overall_memory
 
-        decision = get_completion(messages)
+        try:
+            decision = get_completion(messages, job="orchestrator")
+        except BudgetExceededError as e:
+            print(f"Stopped: {e}")
+            break
         
         if "GOAL ACHIEVED" in decision:
             print("Goal achieved!")
@@ -60,12 +86,27 @@ def orchestrator(goal, agents):
 
         for agent in agents:
             if agent.role.lower() in decision.lower():
-                result = agent.act(decision)
+                try:
+                    result = agent.act(decision)
+                except BudgetExceededError as e:
+                    # the orchestrator would pay for the next decision and pick the exhausted agent again
+                    print(f"{agent.role} is stopped: {e}")
+                    is_stopped = True
+                    break
                 overall_memory.append({"role": "assistant", "content": f"{agent.role}: {result}"})
                 print(f"{agent.role}: {result}")
                 break
 
+    if budget:
+        print(f"Spend: {budget.get_summary()}")
+    print(f"Cached prompt tokens: {cache_usage['cached_tokens']}/{cache_usage['prompt_tokens']}")
+
 if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='multi agent orchestration')
+    Tracer.add_arguments(parser)
+    args = parser.parse_args()
+    Tracer.start_from_args(args)
+
     researcher = Agent("Researcher", "You research and provide factual information.")
     writer = Agent("Writer", "You write creative and engaging content.")
     critic = Agent("Critic", "You provide constructive criticism and suggestions for improvement.")
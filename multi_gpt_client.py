@@ -13,15 +13,37 @@
 #   limitations under the License.
 
 import argparse
+import copy
 import os
 import sys
 import json
 import select
+import threading
+import time
+from Tracer import Tracer
 from GptHelper import GptClientFactory, IGpt
+from GptPricing import GptPricing
+from Deadline import Deadline, DeadlineExceededError, RequestCancelledError
+from CandidateSampler import CandidateSampler
+
+def read_diff_context(files):
+    # unified diff from the files or stdin -> the hunks with the enclosing definitions (e.g. git diff | multi_gpt_client.py -p codereview.json --diff)
+    from DiffContext import DiffContext
+    diff_text = ""
+    if files:
+        for path in files:
+            with open(path, 'r', encoding='UTF-8') as f:
+                diff_text += f.read()
+    elif select.select([sys.stdin], [], [], 0.0)[0]:
+        diff_text = sys.stdin.read()
+    with Tracer.span("diff_context"):
+        context = DiffContext.new_for_repo()
+        return context.build(diff_text, DiffContext.get_git_files(context.base_dir))
 
 class SimpleGptClient:
-    def __init__(self, client=None, promptfile=None):
+    def __init__(self, client=None, promptfile=None, candidates=1):
         self.client = client
+        self.candidates = candidates
         self.system_prompt = ""
         self.user_prompt = ""
         if promptfile:
@@ -32,6 +54,9 @@ class SimpleGptClient:
         response = None
 
         if self.client and user_prompt:
+            if self.candidates > 1:
+                # n answers at once, then the first non-empty one is used
+                return CandidateSampler(self.client, self.candidates).sample(system_prompt, user_prompt)
             content, response = self.client.query(system_prompt, user_prompt)
             return content, response
 
@@ -61,35 +86,188 @@ class SimpleGptClient:
 
         return content, response
 
+
+class GptComparator:
+    def __init__(self, clients, pricing=None, is_streaming=True):
+        # clients : {provider name: IGpt}
+        self.clients = clients
+        self.pricing = pricing if pricing else GptPricing.new_from_env()
+        self.is_streaming = is_streaming
+        self._print_lock = threading.Lock()
+
+    @staticmethod
+    def new_clients(args, providers):
+        # each provider is configured by its env as the end point, key and deployment are per provider
+        clients = {}
+        for provider in providers:
+            provider_args = copy.copy(args)
+            provider_args.gpt = provider
+            provider_args.useclaude = provider in ("calude3", "claude3", "claude")
+            provider_args.apikey = provider_args.endpoint = provider_args.deployment = None
+            try:
+                clients[provider] = GptClientFactory.new_client(provider_args)
+            except Exception as e:
+                print(f"ERROR!!!: {provider} is skipped: {e}", file=sys.stderr)
+        return clients
+
+    def _print(self, provider, line):
+        with self._print_lock:
+            print(f"[{provider}] {line}", flush=True)
+
+    def _run(self, provider, client, system_prompt, user_prompt, result, deadline=None):
+        pending = {"text": ""}
+
+        def _callback(delta):
+            result["deltas"] += 1
+            if result["ttft"] is None:
+                result["ttft"] = time.time() - result["start_time"]
+            if self.is_streaming:
+                lines = (pending["text"] + delta).split("\n")
+                pending["text"] = lines.pop()
+                for line in lines:
+                    self._print(provider, line)
+        try:
+            # the slow provider is timed out alone and the others' results are kept
+            with Deadline(None, deadline).activate():
+                result["content"], result["response"] = client.query(system_prompt, user_prompt, _callback)
+        except Exception as e:
+            result["error"] = e
+        result["latency"] = time.time() - result["start_time"]
+        if self.is_streaming and pending["text"]:
+            self._print(provider, pending["text"])
+
+    def compare(self, system_prompt, user_prompt):
+        # the same prompt goes to all of the providers at once, then the wall time is the slowest one
+        results = {}
+        threads = []
+        deadline = Deadline.current()
+        for provider, client in self.clients.items():
+            results[provider] = {"start_time": time.time(), "ttft": None, "latency": None, "content": None, "response": None, "error": None, "deltas": 0, "model": getattr(client, "model", None)}
+            thread = threading.Thread(target=self._run, args=(provider, client, system_prompt, user_prompt, results[provider], deadline), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for provider, result in results.items():
+            content = result["content"] if isinstance(result["content"], str) else "\n".join(result["content"] or [])
+            usage = IGpt.get_usage(result["response"])
+            result["is_estimated"] = usage["prompt_tokens"] is None or usage["completion_tokens"] is None
+            result["prompt_tokens"] = usage["prompt_tokens"] if usage["prompt_tokens"] is not None else IGpt.estimate_tokens(system_prompt) + IGpt.estimate_tokens(user_prompt)
+            result["completion_tokens"] = usage["completion_tokens"] if usage["completion_tokens"] is not None else IGpt.estimate_tokens(content)
+            result["cost"] = self.pricing.estimate_cost(result["model"], result["prompt_tokens"], result["completion_tokens"])
+            # the non-streaming backend (or the cache hit) calls back once with the whole content, then no ttft and decode speed
+            result["is_streamed"] = result["deltas"] > 1
+            if not result["is_streamed"]:
+                result["ttft"] = None
+            generation_time = result["latency"] - result["ttft"] if result["is_streamed"] else 0
+            result["tokens_per_sec"] = result["completion_tokens"] / generation_time if generation_time > 0 and result["completion_tokens"] else None
+        return results
+
+    @staticmethod
+    def print_table(results, file=sys.stdout):
+        print(f"{'provider':<12} {'model':<36} {'latency':>8} {'ttft':>7} {'tok/s':>7} {'prompt':>8} {'output':>8} {'cost($)':>10}", file=file)
+        for provider, result in results.items():
+            if result["error"]:
+                print(f"{provider:<12} ERROR: {result['error']}", file=file)
+                continue
+            mark = "*" if result["is_estimated"] else ""
+            ttft = f"{result['ttft']:.2f}" if result["ttft"] is not None else "-" if result["is_streamed"] else "n/a"
+            tokens_per_sec = f"{result['tokens_per_sec']:.1f}" if result["tokens_per_sec"] else "-" if result["is_streamed"] else "n/a"
+            cost = f"{result['cost']:.5f}" if result["cost"] is not None else "-"
+            print(f"{provider:<12} {str(result['model'])[:36]:<36} {result['latency']:>8.2f} {ttft:>7} {tokens_per_sec:>7} {str(result['prompt_tokens'])+mark:>8} {str(result['completion_tokens'])+mark:>8} {cost:>10}", file=file)
+        if any(result["is_estimated"] for result in results.values() if not result["error"]):
+            print("*: estimated as the backend didn't report the usage", file=file)
+        if any(not result["is_streamed"] for result in results.values() if not result["error"]):
+            print("n/a: not measured as the backend didn't stream the response", file=file)
+
+
 if __name__=="__main__":
     parser = argparse.ArgumentParser(description='multi gpt client')
     parser.add_argument('args', nargs='*', help='files file[:line]')
 
     parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3')
-    parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible')
+    parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible or router (backends in LLM_ROUTER)')
 
     parser.add_argument('-k', '--apikey', action='store', default=None, help='specify your API key or set it in AZURE_OPENAI_API_KEY env')
     parser.add_argument('-y', '--secretkey', action='store', default=os.getenv("AWS_SECRET_ACCESS_KEY"), help='specify your secret key or set it in AWS_SECRET_ACCESS_KEY env (for claude3)')
-    parser.add_argument('-e', '--endpoint', action='store', default=None, help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
+    parser.add_argument('-e', '--endpoint', action='store', default=None, help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env (openaicompatible accepts multiple replicas with ,)')
+    parser.add_argument('-l', '--policy', action='store', default=None, choices=['least_outstanding', 'ewma'], help='specify load balancing policy for multiple endpoints or set it in LLM_ENDPOINT_POLICY env')
     parser.add_argument('-d', '--deployment', action='store', default=None, help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env or model(s with ,)')
     parser.add_argument('-p', '--promptfile', action='store', default=None, help='specify prompt.json')
+    parser.add_argument('-t', '--maxtokens', action='store', type=int, default=None, help='specify output token budget per request (for claude3) or set it in AWS_BEDROCK_MAX_TOKENS env')
 
     parser.add_argument('-s', '--systemprompt', action='store', default=None, help='specify system prompt if necessary')
     parser.add_argument('-u', '--prompt', action='store', default=None, help='specify prompt')
     parser.add_argument('-H', '--header', action='append', default=[], help='Specify headers for http e.g. header_key:value (multiple --header are ok)')
     parser.add_argument('-v', '--verbose', action='store_true', default=False, help='enable verbose')
+    parser.add_argument('--semanticcache', action='store', default=None, help='specify semantic cache path to reuse answers of similar prompts')
+    parser.add_argument('--embeddingendpoint', action='store', default=os.getenv("LLM_EMBEDDING_ENDPOINT"), help='specify embedding end point (e.g. http://localhost:8080/v1/embeddings) or set it in LLM_EMBEDDING_ENDPOINT env (default: the gpt backend\'s embeddings)')
+    parser.add_argument('--cachethreshold', action='store', type=float, default=0.95, help='specify similarity threshold for semantic cache hit')
+    parser.add_argument('--rag', action='store', default=None, help='specify RAG index path created by RagHelper.py to inject the relevant contexts')
+    parser.add_argument('--raglimit', action='store', type=int, default=3, help='specify number of contexts to inject for RAG')
+    parser.add_argument('--ragthreshold', action='store', type=float, default=0.5, help='specify score threshold of the contexts for RAG')
+    parser.add_argument('--budgettokens', action='store', type=int, default=None, help='specify token ceiling of the run or set it in LLM_BUDGET_TOKENS env')
+    parser.add_argument('--budgetcost', action='store', type=float, default=None, help='specify cost ceiling (USD) of the run or set it in LLM_BUDGET_COST env')
+    parser.add_argument('--compare', action='store', default=None, help='specify providers to compare concurrently with , e.g. openai,claude3,local (each is configured by its env)')
+    parser.add_argument('--hedge', action='store', type=float, default=None, help='specify seconds to wait the first token before sending a hedged duplicate request')
+    parser.add_argument('--diff', action='store_true', default=False, help='specify if the input (files or stdin) is unified diff to send the changed hunks with the enclosing definitions instead of the whole files')
+    parser.add_argument('--timeout', action='store', type=float, default=None, help='specify seconds to give up the request including the retries and the failover (default: no deadline)')
+    parser.add_argument('--candidates', action='store', type=int, default=1, help='specify number of answers requested at once in each try to use the first valid one instead of the sequential retries')
+    Tracer.add_arguments(parser)
 
     args = parser.parse_args()
+    Tracer.start_from_args(args)
+
+    if args.compare:
+        comparator = GptComparator(GptComparator.new_clients(args, args.compare.split(",")))
+        system_prompt, user_prompt = IGpt.read_prompt_json(args.promptfile) if args.promptfile else ("", "")
+        if args.systemprompt is not None:
+            system_prompt = str(args.systemprompt)
+        if args.prompt is not None:
+            user_prompt += str(args.prompt)
+        if args.diff:
+            user_prompt += read_diff_context(args.args)
+        elif len(args.args) > 0:
+            user_prompt += IGpt.files_reader(args.args)
+        elif select.select([sys.stdin], [], [], 0.0)[0]:
+            user_prompt += sys.stdin.read()
+        start_time = time.time()
+        with Deadline(args.timeout).activate():
+            results = comparator.compare(system_prompt, user_prompt)
+        print("")
+        GptComparator.print_table(results)
+        print(f"wall time: {time.time()-start_time:.2f}s")
+        sys.exit(0)
 
-    client = GptClientFactory.new_client(args)
-    gpt_client = SimpleGptClient(client, args.promptfile)
+    client = embedder = GptClientFactory.new_client(args)
+    if args.hedge is not None:
+        from HedgedGpt import HedgedGpt
+        # the duplicate goes to the least loaded replica if multiple endpoints are given
+        client = HedgedGpt([client, client], initial_delay=args.hedge)
+    if args.rag:
+        from EmbeddingHelper import OpenAICompatibleEmbedding
+        from RagHelper import RagGpt, RagRetriever
+        # the gpt backend's embed() is used if no embedding end point
+        rag_embedder = OpenAICompatibleEmbedding.new_from_env(endpoint=args.embeddingendpoint) or embedder
+        client = RagGpt(client, RagRetriever(rag_embedder, args.rag, args.raglimit, args.ragthreshold))
+    semantic_cache = None
+    if args.semanticcache:
+        from EmbeddingHelper import OpenAICompatibleEmbedding
+        from SemanticCache import SemanticCacheGpt
+        cache_embedder = OpenAICompatibleEmbedding.new_from_env(endpoint=args.embeddingendpoint) or embedder
+        client = semantic_cache = SemanticCacheGpt(client, cache_embedder, args.semanticcache, args.cachethreshold)
+    gpt_client = SimpleGptClient(client, args.promptfile, args.candidates)
 
     additional_prompt = ""
-    if len(args.args) > 0:
+    if args.diff:
+        additional_prompt = read_diff_context(args.args)
+    elif len(args.args) > 0:
         additional_prompt = IGpt.files_reader(args.args)
     else:
         if select.select([sys.stdin], [], [], 0.0)[0]:
-            additional_prompt = sys.stdin.read()
+            with Tracer.span("read_stdin"):
+                additional_prompt = sys.stdin.read()
 
     if args.systemprompt is not None:
     	gpt_client.system_prompt = str(args.systemprompt)
@@ -98,11 +276,21 @@ if __name__=="__main__":
         gpt_client.user_prompt += str(args.prompt)
 
 
-    contents, responses = gpt_client.query(additional_prompt)
+    try:
+        with Deadline(args.timeout).activate():
+            contents, responses = gpt_client.query(additional_prompt)
+    except (DeadlineExceededError, RequestCancelledError) as e:
+        print(f"ERROR!!!: {e}", file=sys.stderr)
+        if semantic_cache:
+            semantic_cache.close()
+        sys.exit(1)
+    if semantic_cache:
+        semantic_cache.close()
     if not isinstance(contents, list):
         contents = [contents]
-    for content in contents:
-        print(content)
+    with Tracer.span("print"):
+        for content in contents:
+            print(content)
 
     if responses and args.verbose:
         if not isinstance(responses, list):